@@ -3,25 +3,54 @@ import sys
 import threading
 import time
 import io
+import json
+import hashlib
+import sqlite3
 import logging
 import tkinter as tk
 from tkinter import messagebox, ttk, simpledialog, END
 import platform
+import queue
+import re
+import random
+import argparse
+import datetime
+from collections import deque
 import subprocess
+import functools
+import shutil
+import zipfile
+import urllib.parse
+import urllib.request
+import urllib.error
+from collections import OrderedDict
+from array import array
+import concurrent.futures
+import multiprocessing
+import tempfile
+import tkinter.font as tkfont
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import darkdetect
 import sv_ttk
 
 try:
-    from PyPDF2 import PdfMerger
+    from PyPDF2 import PdfMerger, PdfReader, PdfWriter, PageObject
+    from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, NameObject,
+                                NumberObject, StreamObject)
 except ImportError:
     print("PyPDF2 not found. Please install it using: pip install PyPDF2")
     sys.exit(1)
 
+try:
+    from PIL import Image # Optional: only needed to recompress page images (see PDF_PROFILES)
+except ImportError:
+    Image = None
+
 try:
     from google.oauth2 import service_account
     from googleapiclient.discovery import build
     from googleapiclient.errors import HttpError
-    from googleapiclient.http import MediaIoBaseDownload
 except ImportError:
     print("Google API libraries not found. Please install them using:")
     print("pip install --upgrade google-api-python-client google-auth-httplib2 google-auth-oauthlib")
@@ -30,14 +59,1395 @@ except ImportError:
 
 # The scope defines the level of access. Read-only is safest.
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
+APP_NAME = "Shas Downloader (Google Drive Edition)"
 SERVICE_ACCOUNT_FILE = 'assets\\service_account.json'
 
 # --- IMPORTANT: PASTE YOUR FOLDER ID HERE ---
 DRIVE_FOLDER_ID = '1L94Vy-FQblxPG7XoqIjPWe-ebhRYIs3x'
 
+# Optional override for the Drive API host, e.g. the local stand-in from
+# fake_drive_server.py ("http://127.0.0.1:8765/drive/v3/"). Empty means Google.
+DRIVE_API_ENDPOINT = os.environ.get('SHAS_DRIVE_ENDPOINT', '')
+
+# Retry policy for throttled (429) and transient (5xx) Drive responses.
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0 # seconds, doubled on every attempt
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Buffer size for streamed reads and copies; pause/cancel requests are honoured between reads.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Drive media requests: files up to DOWNLOAD_SINGLE_REQUEST_LIMIT are fetched in one request,
+# larger ones in about eight ranged requests of at most DOWNLOAD_MAX_CHUNK_SIZE each.
+# SHAS_CHUNK_SIZE_KB fixes the request size instead (mainly for benchmarking).
+DOWNLOAD_SINGLE_REQUEST_LIMIT = 8 * 1024 * 1024
+DOWNLOAD_MAX_CHUNK_SIZE = 32 * 1024 * 1024
+DRIVE_CHUNK_SIZE = int(os.environ.get('SHAS_CHUNK_SIZE_KB') or 0) * 1024
+
+# Pages downloaded at once. Each worker thread gets its own Drive connection.
+DOWNLOAD_WORKERS = 4
+
+# A job starting in a folder deletes .part files left by a run that died mid-write, but only
+# ones untouched for this long; newer ones may belong to another job (e.g. the Daf Yomi prefetch).
+STALE_PART_FILE_AGE = 15 * 60 # seconds
+
+# When a selection covers at least this fraction of a masechet and its Drive folder has a
+# pre-built bundle ("<Masechet>.zip" of amud PDFs, or "<Masechet>_Full.pdf" with a page per
+# amud), the bundle is downloaded in one request and split locally instead.
+BUNDLE_MIN_FRACTION = float(os.environ.get('SHAS_BUNDLE_MIN_FRACTION') or 0.6)
+# Smaller selections of at least this many pages read only their byte ranges from the bundle,
+# RANGE_BLOCK_SIZE bytes at a time, on sources that support ranged reads (Drive does).
+# So do selections of any size when the masechet has no amud files at all.
+BUNDLE_RANGE_MIN_PAGES = 10
+RANGE_BLOCK_SIZE = 256 * 1024
+
+# Daf Yomi prefetch: how many days ahead (today included) to keep on disk, and how often to check.
+PREFETCH_DAYS = int(os.environ.get('SHAS_PREFETCH_DAYS') or 2)
+PREFETCH_INTERVAL = 6 * 60 * 60 # seconds
+PREFETCH_BUSY_POLL = 5.0 # seconds between checks for the end of a user download it gave way to
+
+# LAN caching server. Clients set SHAS_CACHE_SERVER (e.g. "http://10.0.0.5:8780/") to
+# download through it instead of from Drive; the server is started with --serve.
+CACHE_SERVER_URL = os.environ.get('SHAS_CACHE_SERVER', '')
+CACHE_SERVER_PORT = 8780
+CACHE_DIR = "page_cache"
+CACHE_MAX_BYTES = int(os.environ.get('SHAS_CACHE_MAX_MB') or 2048) * 1024 * 1024
+
+# Fallback page source: HebrewBooks' page feed (id is the first value in masechtos_info_static,
+# page is the 1-based amud number). Pages come from it while Drive is throttled or failing.
+PAGEFEED_URL = "https://beta.hebrewbooks.org/pagefeed/hebrewbooks_org_{id}_{page}.pdf"
+PAGEFEED_FALLBACK = os.environ.get('SHAS_PAGEFEED_FALLBACK', '1') != '0'
+FAILOVER_RETRIES = 1 # Drive retries per request when there is a fallback to turn to instead
+SOURCE_COOLDOWN = 30.0 # seconds a failing source is skipped, doubled per consecutive failure
+SOURCE_COOLDOWN_MAX = 600.0
+
+# Hedged downloads: a Drive download still running after this percentile of recent download
+# times (kept across runs) gets a duplicate request, and whichever finishes first is used.
+# Only amud-sized files (one request, at most DOWNLOAD_SINGLE_REQUEST_LIMIT) are hedged or timed;
+# bundles never are, since a duplicate of a large single request would transfer it all again.
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_DELAY = 0.5 # seconds; never hedge sooner than this
+HEDGE_MIN_SAMPLES = 20 # no hedging until this many downloads have been timed
+LATENCY_WINDOW = 200 # recent download times kept
+
+# Durations kept per phase for the timing summary's percentiles. Bounded, since a long-lived
+# Instrumentation (e.g. the --serve client's) would otherwise grow with every request.
+PHASE_SAMPLE_WINDOW = 1000
+
+# Optional JSON-lines file that receives one event per timed phase of each run.
+TRACE_FILE = os.environ.get('SHAS_TRACE_FILE', '')
+
+# Port for the local Prometheus-style /metrics endpoint. Empty or 0 disables it.
+METRICS_PORT = int(os.environ.get('SHAS_METRICS_PORT') or 0)
+
 DOWNLOADS_DIR = "downloads"
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 
+# Output profiles for merged PDFs: name -> (max image DPI, JPEG quality), or None to keep the
+# pages exactly as downloaded. The other profiles also deflate page content streams.
+PDF_PROFILES = {
+    'archival': None,
+    'screen': (150, 75),
+    'mobile': (100, 55),
+}
+PDF_PROFILE = os.environ.get('SHAS_PDF_PROFILE', 'archival')
+PDF_WORKERS = os.cpu_count() or 2 # processes recompressing pages or imposing dapim during a merge
+
+# How "Merge Amudim into Dapim" lays out a daf: 'pages' keeps amud a and amud b as two pages,
+# 'spread' places them side by side on one page, amud b on the left as in a printed gemara.
+DAF_LAYOUTS = ('pages', 'spread')
+
+# Colour of Individual-list entries that are already downloaded.
+AVAILABLE_COLOR = "#2e8b57"
+
+# How often the progress bar and status are repainted while a job runs.
+PROGRESS_FPS = 10
+
+
+class MetricsRegistry:
+    """Process-wide counters, gauges and duration histograms, rendered in the Prometheus text format.
+    Unlike Instrumentation it lives for the whole process, so a mirror job can be watched across runs.
+    """
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    HELP = {
+        'shas_pages_total': ('counter', "Pages processed, by result."),
+        'shas_bytes_total': ('counter', "Bytes written to disk by downloads."),
+        'shas_api_calls_total': ('counter', "Drive API requests issued."),
+        'shas_retries_total': ('counter', "Drive requests retried after a throttled or transient error."),
+        'shas_drive_errors_total': ('counter', "Drive API errors, by HTTP status."),
+        'shas_cache_hits_total': ('counter', "Lookups answered from a local cache, by cache."),
+        'shas_cache_misses_total': ('counter', "Lookups that missed a local cache, by cache."),
+        'shas_coalesced_requests_total': ('counter', "Requests that shared an identical in-flight fetch, by cache."),
+        'shas_source_pages_total': ('counter', "Page downloads attempted per page source, by result."),
+        'shas_source_up': ('gauge', "1 if a page source is currently considered healthy, else 0."),
+        'shas_hedged_requests_total': ('counter', "Duplicate downloads started because the first was slower than usual."),
+        'shas_hedge_wins_total': ('counter', "Hedged downloads where the duplicate finished first."),
+        'shas_cache_hit_ratio': ('gauge', "Hits / (hits + misses) per cache since start."),
+        'shas_queue_depth': ('gauge', "Pages still waiting in the current run."),
+        'shas_inflight_requests': ('gauge', "Drive requests currently in flight."),
+        'shas_download_bytes_per_second': ('gauge', "Download throughput over the last minute."),
+        'shas_last_progress_timestamp_seconds': ('gauge', "Unix time of the last completed page."),
+        'shas_phase_duration_seconds': ('histogram', "Duration of timed phases (page, download, merge, ...)."),
+    }
+    THROUGHPUT_WINDOW = 60.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {} # (name, labels) -> value
+        self._gauges = {}
+        self._histograms = {} # (name, labels) -> [bucket counts..., count, sum]
+        self._recent_bytes = [] # (monotonic time, bytes) for the throughput gauge
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            if name == 'shas_bytes_total':
+                now = time.monotonic()
+                self._recent_bytes.append((now, amount))
+                while self._recent_bytes and self._recent_bytes[0][0] < now - self.THROUGHPUT_WINDOW:
+                    self._recent_bytes.pop(0)
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def add_gauge(self, name, delta, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.setdefault(key, [0] * (len(self.BUCKETS) + 2))
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += seconds
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+            now = time.monotonic()
+            recent = sum(b for t, b in self._recent_bytes if t >= now - self.THROUGHPUT_WINDOW)
+        gauges[('shas_download_bytes_per_second', ())] = recent / self.THROUGHPUT_WINDOW
+        for (name, labels), hits in list(counters.items()):
+            if name == 'shas_cache_hits_total':
+                misses = counters.get(('shas_cache_misses_total', labels), 0)
+                gauges[('shas_cache_hit_ratio', labels)] = hits / (hits + misses)
+
+        lines = []
+        for name, (kind, help_text) in self.HELP.items():
+            source = histograms if kind == 'histogram' else counters if kind == 'counter' else gauges
+            series = sorted((labels, value) for (n, labels), value in source.items() if n == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind == 'histogram':
+                    for bound, count in zip(self.BUCKETS, value):
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {value[-2]}")
+                    lines.append(f"{name}_count{self._labels(labels)} {value[-2]}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {value[-1]:.6f}")
+                else:
+                    lines.append(f"{name}{self._labels(labels)} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, registry=METRICS, host='127.0.0.1'):
+    """Serves registry at http://host:port/metrics from a daemon thread and returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Metrics available at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def percentile(values, q):
+    """The q-th quantile (0..1) of values, by the nearest-rank method."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))]
+
+
+class Instrumentation:
+    """Collects per-phase timings and counters for one download run.
+    Phases nest (e.g. 'disk_write' inside 'download' inside 'page'), so their totals overlap.
+    If trace_path is given, every phase and event is appended to it as a JSON line.
+    """
+
+    # Instrumentation counter -> (metric name, labels) in the process-wide registry
+    METRIC_NAMES = {
+        'pages_downloaded': ('shas_pages_total', {'result': 'downloaded'}),
+        'pages_existing': ('shas_pages_total', {'result': 'existing'}),
+        'pages_from_bundle': ('shas_pages_total', {'result': 'from_bundle'}),
+        'pages_failed': ('shas_pages_total', {'result': 'failed'}),
+        'bytes': ('shas_bytes_total', {}),
+        'api_calls': ('shas_api_calls_total', {}),
+        'retries': ('shas_retries_total', {}),
+        'cache_hits': ('shas_cache_hits_total', {'cache': 'folder_ids'}),
+        'cache_misses': ('shas_cache_misses_total', {'cache': 'folder_ids'}),
+        'file_id_hits': ('shas_cache_hits_total', {'cache': 'file_ids'}),
+        'file_id_misses': ('shas_cache_misses_total', {'cache': 'file_ids'}),
+        'coalesced': ('shas_coalesced_requests_total', {'cache': 'downloads'}),
+        'store_hits': ('shas_cache_hits_total', {'cache': 'page_store'}),
+        'hedged': ('shas_hedged_requests_total', {}),
+        'hedge_wins': ('shas_hedge_wins_total', {}),
+        'merge_cache_hits': ('shas_cache_hits_total', {'cache': 'merges'}),
+        'merge_cache_misses': ('shas_cache_misses_total', {'cache': 'merges'}),
+    }
+
+    def __init__(self, trace_path=None, metrics=METRICS):
+        self.timers = {}   # phase -> [count, total seconds, max seconds]
+        self.samples = {}  # phase -> the last PHASE_SAMPLE_WINDOW durations, for percentiles
+        self.counters = {}
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._trace = open(trace_path, 'a', encoding='utf-8') if trace_path else None
+
+    @contextmanager
+    def phase(self, name, **fields):
+        """Times the enclosed block under the given phase name."""
+        start = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self.timers.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+                if name not in self.samples:
+                    self.samples[name] = deque(maxlen=PHASE_SAMPLE_WINDOW)
+                self.samples[name].append(elapsed)
+            if self.metrics is not None:
+                self.metrics.observe('shas_phase_duration_seconds', elapsed, phase=name)
+            self.event('phase', phase=name, seconds=round(elapsed, 6), ok=ok, **fields)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        if self.metrics is None:
+            return
+        if name.startswith('http_'):
+            self.metrics.inc('shas_drive_errors_total', amount, status=name[5:])
+        elif name in self.METRIC_NAMES:
+            metric, labels = self.METRIC_NAMES[name]
+            self.metrics.inc(metric, amount, **labels)
+        if name.startswith('pages_'):
+            self.metrics.set_gauge('shas_last_progress_timestamp_seconds', time.time())
+
+    @contextmanager
+    def in_flight(self):
+        """Tracks a network request in the in-flight gauge."""
+        if self.metrics is not None:
+            self.metrics.add_gauge('shas_inflight_requests', 1)
+        try:
+            yield
+        finally:
+            if self.metrics is not None:
+                self.metrics.add_gauge('shas_inflight_requests', -1)
+
+    def set_queue_depth(self, depth):
+        if self.metrics is not None:
+            self.metrics.set_gauge('shas_queue_depth', depth)
+
+    def event(self, event, **fields):
+        """Writes a free-form event to the trace file, if one is open."""
+        if self._trace is None:
+            return
+        record = {'ts': round(time.time(), 6), 'event': event}
+        record.update(fields)
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._trace.write(line + '\n')
+
+    def summary_table(self):
+        """Returns a plain-text table of phase timings and counters."""
+        wall = time.perf_counter() - self.started
+        lines = [f"{'Phase':<14}{'Count':>8}{'Total s':>10}{'Avg ms':>10}{'P50 ms':>10}{'P95 ms':>10}{'Max ms':>10}"]
+        with self._lock:
+            for name, (count, total, longest) in sorted(self.timers.items(), key=lambda item: -item[1][1]):
+                p50, p95 = (percentile(self.samples[name], q) * 1000 for q in (0.5, 0.95))
+                lines.append(f"{name:<14}{count:>8}{total:>10.2f}{total / count * 1000:>10.1f}"
+                             f"{p50:>10.1f}{p95:>10.1f}{longest * 1000:>10.1f}")
+            lines.append(f"{'wall clock':<14}{'':>8}{wall:>10.2f}")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name:<22}{value:>10}")
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._trace is not None:
+            with self._lock:
+                self._trace.close()
+                self._trace = None
+
+
+class _TimedWriter:
+    """File wrapper that times writes and counts bytes, so disk time is separate from network time.
+    Also keeps an MD5 of everything written so downloads can be verified without re-reading them.
+    """
+
+    def __init__(self, fh, instrumentation):
+        self._fh = fh
+        self._instrumentation = instrumentation
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        with self._instrumentation.phase('disk_write'):
+            written = self._fh.write(data)
+        self.md5.update(data)
+        self.size += len(data)
+        self._instrumentation.count('bytes', len(data))
+        return written
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once the user has cancelled it."""
+
+
+class JobControl:
+    """Cooperative cancel and pause flags shared between the UI and a running job."""
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        self.on_pause = None # Called from the job's thread when it stops at a checkpoint
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set() # Wake a paused job so it can exit
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def checkpoint(self):
+        """Blocks while paused and raises JobCancelled if cancelled. Call between units of work."""
+        if not self._running.is_set() and self.on_pause is not None:
+            self.on_pause()
+        self._running.wait()
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+
+class _AttemptControl(JobControl):
+    """Control for one of several racing attempts at the same download. It stops when
+    its own attempt loses (cancel()) as well as when the job is paused or cancelled."""
+
+    def __init__(self, parent):
+        super().__init__()
+        self.parent = parent
+
+    @property
+    def cancelled(self):
+        return JobControl.cancelled.fget(self) or (self.parent is not None and self.parent.cancelled)
+
+    def checkpoint(self):
+        if self.parent is not None:
+            self.parent.checkpoint()
+        super().checkpoint()
+
+
+class LatencyTracker:
+    """Recent Drive download times, saved between runs, from which the hedging delay is taken."""
+    FILE = 'download_latency.json'
+
+    def __init__(self, path=None, window=LATENCY_WINDOW):
+        self.path = path
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self._unsaved = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self._samples.extend(float(x) for x in json.load(f))
+            except (ValueError, TypeError, OSError) as e:
+                print(f"[WARN] Ignoring latency history {path}: {e}")
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def shared(cls):
+        """The process-wide tracker, persisted in the app data folder."""
+        return cls(get_app_data_path(cls.FILE))
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._unsaved += 1
+            save = self._unsaved >= 20
+        if save:
+            self.save()
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None while there is too little history."""
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            return max(HEDGE_MIN_DELAY, percentile(self._samples, HEDGE_PERCENTILE))
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = list(self._samples)
+            self._unsaved = 0
+        part = self.path + '.part'
+        with open(part, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(part, self.path)
+
+
+def build_drive_service(creds=None, endpoint=None):
+    """Builds a Drive v3 service, pointed at DRIVE_API_ENDPOINT when one is configured.
+    A custom endpoint is assumed to be a local stand-in and is used without credentials.
+    """
+    endpoint = DRIVE_API_ENDPOINT if endpoint is None else endpoint
+    if endpoint:
+        import httplib2
+        return build('drive', 'v3', http=httplib2.Http(), static_discovery=True,
+                     client_options={'api_endpoint': endpoint})
+    return build('drive', 'v3', credentials=creds)
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time. Callers that arrive while a call for their
+    key is in flight wait for it and share its result (or exception) instead of repeating it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {} # key -> Future of the in-flight call
+
+    def do(self, key, fn):
+        """Returns (fn's result, shared), where shared is True if another caller's call produced it."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            return call.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+def link_or_copy(src, dst):
+    """Makes dst a hard link to src, or a copy where links aren't possible (e.g. across drives).
+    Any existing dst is replaced."""
+    part = dst + '.part'
+    try:
+        os.remove(part)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, part)
+    except OSError:
+        shutil.copyfile(src, part)
+    os.replace(part, dst)
+
+
+def drive_service_factory():
+    """Returns a callable that builds a Drive service with the app's credentials.
+    Raises FileNotFoundError if the service account key file is missing."""
+    if DRIVE_API_ENDPOINT:
+        return build_drive_service
+    service_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), SERVICE_ACCOUNT_FILE)
+    if not os.path.exists(service_path):
+        raise FileNotFoundError(service_path)
+    creds = service_account.Credentials.from_service_account_file(service_path, scopes=SCOPES)
+    return functools.partial(build_drive_service, creds)
+
+
+class PageSource:
+    """Somewhere amud PDFs can be downloaded from. This is all DownloadJob needs of a source:
+    download() returns {'file_id', 'size', 'md5'} or raises FileNotFoundError, and
+    list_masechta_files() may fill file_ids/file_md5s ahead of time where the source can list.
+    """
+    name = 'source'
+    parallel = False # True if download() may be called from several threads at once
+
+    def __init__(self):
+        self.file_ids = {}   # masechta -> {filename: file id}
+        self.file_md5s = {}  # file id -> expected MD5
+        self.instrumentation = Instrumentation()
+
+    def list_masechta_files(self, masechta_name):
+        return self.file_ids.setdefault(masechta_name, {})
+
+    def download(self, masechta_name, filename, save_path, control=None):
+        raise NotImplementedError
+
+    def open_range(self, masechta_name, filename):
+        """Returns a RangeFile over the file, or None if this source can't read byte ranges."""
+        return None
+
+
+def _http_download(url, save_path, control, instrumentation, timeout):
+    """Streams url to save_path via a .part file, checkpointing between chunks.
+    Returns {'file_id': None, 'size', 'md5'}; a 404 raises FileNotFoundError."""
+    part_path = save_path + '.part'
+    instrumentation.count('api_calls')
+    try:
+        with instrumentation.phase('download', url=url), instrumentation.in_flight(), \
+                urllib.request.urlopen(url, timeout=timeout) as response, io.FileIO(part_path, 'wb') as fh:
+            writer = _TimedWriter(fh, instrumentation)
+            while True:
+                if control is not None:
+                    control.checkpoint()
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+        os.replace(part_path, save_path)
+        return {'file_id': None, 'size': writer.size, 'md5': writer.md5.hexdigest()}
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            raise FileNotFoundError(os.path.basename(save_path)) from e
+        raise
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+class RangeFile(io.RawIOBase):
+    """Read-only, seekable view of a remote file that downloads only the parts that are read.
+    fetch(offset, length) returns those bytes. Blocks of block_size are cached, and a read
+    spanning several missing blocks fetches them in one request.
+    """
+
+    def __init__(self, fetch, size, block_size=RANGE_BLOCK_SIZE):
+        super().__init__()
+        self._fetch = fetch
+        self.size = size
+        self.block_size = block_size
+        self.requests = 0
+        self._blocks = {} # block index -> bytes
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self.size}[whence]
+        if base + offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = base + offset
+        return self._pos
+
+    def readinto(self, buffer):
+        end = min(self._pos + len(buffer), self.size)
+        if self._pos >= end:
+            return 0
+        first, last = self._pos // self.block_size, (end - 1) // self.block_size
+        self._load(first, last)
+        data = b''.join(self._blocks[i] for i in range(first, last + 1))
+        start = self._pos - first * self.block_size
+        count = end - self._pos
+        buffer[:count] = data[start:start + count]
+        self._pos = end
+        return count
+
+    def _load(self, first, last):
+        missing = [i for i in range(first, last + 1) if i not in self._blocks]
+        if not missing:
+            return
+        lo, hi = missing[0], missing[-1]
+        offset = lo * self.block_size
+        data = self._fetch(offset, min((hi + 1) * self.block_size, self.size) - offset)
+        self.requests += 1
+        for i in range(lo, hi + 1):
+            self._blocks[i] = data[(i - lo) * self.block_size:(i - lo + 1) * self.block_size]
+
+
+def chunk_size_for(total):
+    """Bytes per media request for a file of total bytes: all of it for amud-sized files,
+    otherwise about an eighth, so large files still report progress and honour pause/cancel."""
+    if total <= DOWNLOAD_SINGLE_REQUEST_LIMIT:
+        return max(total, 1)
+    return min(DOWNLOAD_MAX_CHUNK_SIZE, max(DOWNLOAD_SINGLE_REQUEST_LIMIT, -(-total // 8)))
+
+
+def _preallocate(fh, size):
+    """Reserves the file's final size up front, so it is laid out in one piece and a full
+    disk fails before the download rather than in the middle of it."""
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fh.fileno(), 0, size)
+    except (AttributeError, OSError): # Windows, or a filesystem without fallocate
+        fh.truncate(size)
+
+
+class DriveClient(PageSource):
+    """Finds and downloads amud PDFs in the shared Drive folder.
+    Has no UI dependencies so it can be driven from tests and benchmarks.
+    httplib2 connections are not thread-safe, so the client is only used from several
+    threads when it has a service_factory to build a service for each of them.
+    Simultaneous downloads of one Drive file, from any client in the process, share one transfer.
+    """
+    name = 'drive'
+    _downloads = SingleFlight() # keyed by Drive file id
+
+    def __init__(self, service, root_folder_id=DRIVE_FOLDER_ID, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF,
+                 service_factory=None, latency=None, chunk_size=DRIVE_CHUNK_SIZE):
+        super().__init__()
+        self.chunk_size = chunk_size # bytes per media request; 0 picks one per file (chunk_size_for)
+        self.file_sizes = {} # file id -> size reported by Drive
+        self.latency = latency # LatencyTracker; enables hedged downloads when the client is parallel
+        self._pool = None # threads for hedged download attempts, created on first use
+        self._pool_lock = threading.Lock()
+        self._service = service
+        self._owner = threading.get_ident()
+        self._local = threading.local()
+        self.service_factory = service_factory
+        self.root_folder_id = root_folder_id
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.folder_ids = {}
+
+    @property
+    def parallel(self):
+        """True if the client may be used from several threads at once."""
+        return self.service_factory is not None
+
+    @property
+    def service(self):
+        """The Drive service for the calling thread."""
+        if self.service_factory is None or threading.get_ident() == self._owner:
+            return self._service
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._local.service = self.service_factory()
+        return service
+
+    def _with_retries(self, call):
+        """Runs call(), retrying throttled and transient errors with exponential backoff."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return call()
+            except HttpError as error:
+                self.instrumentation.count(f'http_{error.resp.status}')
+                if error.resp.status not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise
+                print(f"[WARN] Drive returned {error.resp.status}, retrying (attempt {attempt + 1}/{self.max_retries})")
+            except (ConnectionError, TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f"[WARN] Connection problem ({e}), retrying (attempt {attempt + 1}/{self.max_retries})")
+            self.instrumentation.count('retries')
+            time.sleep(self.backoff * (2 ** attempt) * (1 + random.random() / 2))
+
+    def _list(self, query, fields='files(id)'):
+        request = self.service.files().list(q=query, corpora='allDrives', includeItemsFromAllDrives=True, supportsAllDrives=True, fields=fields)
+        self.instrumentation.count('api_calls')
+        with self.instrumentation.phase('metadata'), self.instrumentation.in_flight():
+            return self._with_retries(request.execute).get('files', [])
+
+    def _list_all(self, query, fields='nextPageToken, files(id, name)'):
+        """Like _list, but follows nextPageToken until every match has been returned."""
+        items = []
+        page_token = None
+        while True:
+            request = self.service.files().list(q=query, corpora='allDrives', includeItemsFromAllDrives=True, supportsAllDrives=True,
+                                                fields=fields, pageSize=1000, pageToken=page_token)
+            self.instrumentation.count('api_calls')
+            with self.instrumentation.phase('metadata'), self.instrumentation.in_flight():
+                results = self._with_retries(request.execute)
+            items.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return items
+
+    def list_masechta_files(self, masechta_name):
+        """Lists the masechta's Drive folder once and caches every file id by name.
+        Returns the {filename: file id} map.
+        """
+        parent_folder_id = self.get_folder_id(masechta_name)
+        prefix = masechta_name.replace("'", "\\'")
+        if parent_folder_id != self.root_folder_id:
+            query = f"'{parent_folder_id}' in parents and trashed = false"
+        else:
+            query = f"name contains '{prefix}_' and '{parent_folder_id}' in parents and trashed = false"
+        files = self.file_ids.setdefault(masechta_name, {})
+        for item in self._list_all(query, fields='nextPageToken, files(id, name, md5Checksum, size)'):
+            files.setdefault(item['name'], item['id'])
+            self._remember(item)
+        return files
+
+    def _remember(self, item):
+        """Caches the checksum and size Drive reported for a file."""
+        if item.get('md5Checksum'):
+            self.file_md5s[item['id']] = item['md5Checksum']
+        if item.get('size'):
+            self.file_sizes[item['id']] = int(item['size'])
+
+    def get_folder_id(self, masechta_name):
+        """Returns the id of the masechta's subfolder, or the root folder if it has none."""
+        parent_folder_id = self.folder_ids.get(masechta_name)
+        self.instrumentation.count('cache_hits' if parent_folder_id is not None else 'cache_misses')
+        if parent_folder_id is None:
+            folder_query = f"name = '{masechta_name}' and '{self.root_folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
+            folder_items = self._list(folder_query)
+            # Cache the result, including the fact that we should use the root folder
+            parent_folder_id = folder_items[0]['id'] if folder_items else self.root_folder_id
+            self.folder_ids[masechta_name] = parent_folder_id
+        return parent_folder_id
+
+    def find_file_id(self, masechta_name, filename):
+        """Looks for the file in the masechta subfolder, then falls back to the root folder."""
+        file_id = self.file_ids.get(masechta_name, {}).get(filename)
+        self.instrumentation.count('file_id_hits' if file_id else 'file_id_misses')
+        if file_id:
+            return file_id
+        parent_folder_id = self.get_folder_id(masechta_name)
+        fields = 'files(id, md5Checksum, size)'
+        items = self._list(f"name = '{filename}' and '{parent_folder_id}' in parents and trashed = false", fields)
+        if not items and parent_folder_id != self.root_folder_id:
+            items = self._list(f"name = '{filename}' and '{self.root_folder_id}' in parents and trashed = false", fields)
+        if not items:
+            return None
+        self.file_ids.setdefault(masechta_name, {})[filename] = items[0]['id']
+        self._remember(items[0])
+        return items[0]['id']
+
+    def download_file(self, file_id, save_path, control=None, hedge=True):
+        """Downloads a Drive file by id to save_path and returns {'file_id', 'size', 'md5'}.
+        The data is written to save_path + '.part' and only renamed once complete, so a
+        cancelled or failed download never leaves a half-written PDF behind. If Drive
+        reported an md5Checksum for the file, a mismatch raises IOError.
+        If the file is already being downloaded, waits for that download instead and
+        links (or copies) its result to save_path when the paths differ.
+        hedge=False never races a duplicate request (see _hedged_download).
+        """
+        while True:
+            try:
+                (info, path), shared = self._downloads.do(
+                    file_id, lambda: (self._hedged_download(file_id, save_path, control, hedge), save_path))
+            except JobCancelled:
+                if control is not None and control.cancelled:
+                    raise
+                continue # The shared download belonged to a job that was cancelled; start our own
+            if shared:
+                self.instrumentation.count('coalesced')
+                if os.path.abspath(path) != os.path.abspath(save_path):
+                    link_or_copy(path, save_path)
+            return dict(info)
+
+    def _hedged_download(self, file_id, save_path, control, hedge=True):
+        """Runs _download_file, and if it is still going after the usual tail latency, races a
+        duplicate request against it. Each attempt runs on the attempt pool and writes its own
+        file; the first to finish is renamed to save_path and the other is cancelled at its
+        next chunk, removing its file when it stops. Files of unknown size or larger than one
+        request are downloaded once and left out of the latency history."""
+        size = self.file_sizes.get(file_id)
+        timed = self.latency is not None and hedge and size is not None and size <= DOWNLOAD_SINGLE_REQUEST_LIMIT
+        delay = self.latency.hedge_delay() if timed and self.parallel else None
+        start = time.perf_counter()
+        if delay is None:
+            info = self._download_file(file_id, save_path, control)
+            if timed:
+                self.latency.record(time.perf_counter() - start)
+            return info
+
+        lock = threading.Lock()
+        winner = []
+        controls = [_AttemptControl(control), _AttemptControl(control)]
+
+        def attempt(index):
+            path = f"{save_path}.{index}"
+            info = self._download_file(file_id, path, controls[index])
+            with lock:
+                won = not winner
+                if won:
+                    winner.append(index)
+                    os.replace(path, save_path)
+            if not won:
+                os.remove(path)
+            return info
+
+        pool = self._attempt_pool()
+        futures = [pool.submit(attempt, 0)]
+        done, _ = concurrent.futures.wait(futures, timeout=delay)
+        if not done:
+            self.instrumentation.count('hedged')
+            futures.append(pool.submit(attempt, 1))
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for attempt_control in controls:
+                        attempt_control.cancel() # stops the loser, if any
+                    if futures.index(future) == 1:
+                        self.instrumentation.count('hedge_wins')
+                    self.latency.record(time.perf_counter() - start)
+                    return future.result()
+        raise futures[0].exception()
+
+    def _attempt_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=2 * DOWNLOAD_WORKERS,
+                                                                   thread_name_prefix='drive-attempt')
+            return self._pool
+
+    def _download_file(self, file_id, save_path, control):
+        """Fetches the file with as few ranged GETs as its size allows, into a preallocated
+        .part file. Each response body is written to the file as-is, with no intermediate buffer."""
+        part_path = save_path + '.part'
+        request = self.service.files().get_media(fileId=file_id)
+        total = self.file_sizes.get(file_id)
+        chunk = self.chunk_size or (chunk_size_for(total) if total is not None else DOWNLOAD_SINGLE_REQUEST_LIMIT)
+        try:
+            with self.instrumentation.phase('download', file_id=file_id), io.FileIO(part_path, 'wb') as fh:
+                writer = _TimedWriter(fh, self.instrumentation)
+                if total:
+                    _preallocate(fh, total)
+                while total is None or writer.size < total:
+                    if control is not None:
+                        control.checkpoint()
+                    self.instrumentation.count('api_calls')
+                    with self.instrumentation.in_flight():
+                        resp, content = self._with_retries(lambda: self._fetch_range(request, writer.size, chunk))
+                    if resp.status == 416: # empty file
+                        break
+                    if total is None:
+                        content_range = resp.get('content-range', '')
+                        total = int(content_range.rsplit('/', 1)[1]) if '/' in content_range else len(content)
+                        _preallocate(fh, total)
+                        chunk = self.chunk_size or chunk_size_for(total)
+                    if not content:
+                        break
+                    writer.write(content)
+                    if resp.status == 200: # whole body in one response
+                        break
+            if total is not None and writer.size != total:
+                raise IOError(f"Incomplete download of {os.path.basename(save_path)} ({writer.size} of {total} bytes)")
+            md5 = writer.md5.hexdigest()
+            expected = self.file_md5s.get(file_id)
+            if expected and expected != md5:
+                self.instrumentation.count('checksum_errors')
+                raise IOError(f"Checksum mismatch for {os.path.basename(save_path)}")
+            os.replace(part_path, save_path)
+            return {'file_id': file_id, 'size': writer.size, 'md5': md5}
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+    @staticmethod
+    def _fetch_range(request, offset, length):
+        """One ranged GET of a media request. Raises HttpError for error statuses (except 416)."""
+        headers = dict(request.headers)
+        headers['range'] = f'bytes={offset}-{offset + length - 1}'
+        resp, content = request.http.request(request.uri, method='GET', headers=headers)
+        if resp.status >= 300 and resp.status != 416:
+            raise HttpError(resp, content, uri=request.uri)
+        return resp, content
+
+    def download(self, masechta_name, filename, save_path, control=None):
+        """Downloads filename for the masechta and returns its {'file_id', 'size', 'md5'}.
+        Raises FileNotFoundError if Drive doesn't have it."""
+        file_id = self.find_file_id(masechta_name, filename)
+        if file_id is None:
+            raise FileNotFoundError(filename)
+        return self.download_file(file_id, save_path, control, hedge=filename not in bundle_names(masechta_name))
+
+    def open_range(self, masechta_name, filename):
+        """Returns a RangeFile that reads the Drive file with ranged GETs.
+        Raises FileNotFoundError if it isn't on Drive."""
+        file_id = self.find_file_id(masechta_name, filename)
+        if not file_id or file_id not in self.file_sizes:
+            raise FileNotFoundError(filename)
+        request = self.service.files().get_media(fileId=file_id)
+
+        def fetch(offset, length):
+            self.instrumentation.count('api_calls')
+            with self.instrumentation.phase('download', file_id=file_id, offset=offset), self.instrumentation.in_flight():
+                _, content = self._with_retries(lambda: self._fetch_range(request, offset, length))
+            self.instrumentation.count('bytes', len(content))
+            return content
+        return RangeFile(fetch, self.file_sizes[file_id])
+
+
+class PageCatalog:
+    """SQLite catalog of the amud PDFs on disk, indexed by (masechet, page).
+    Stores path, size, MD5, Drive file id and download time, so planning, cleanup and
+    the UI can ask "which pages do we have?" in one query instead of a stat per page.
+    The catalog is checked against the folder with one directory scan per masechet
+    per session (reconcile), which also picks up files that were added or removed by hand.
+    It lives with the app's other data (see open), not among the downloads, and one file
+    serves every downloads folder: each row belongs to the folder (root) it was recorded for.
+    """
+    FILE = 'page_catalog.sqlite3'
+    LEGACY_FILE = '.page_catalog.sqlite3' # kept in the downloads folder by earlier versions
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+        self._reconciled = set()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS pages (
+                root TEXT NOT NULL, masechet TEXT NOT NULL, page INTEGER NOT NULL, path TEXT NOT NULL,
+                size INTEGER NOT NULL, md5 TEXT, file_id TEXT, downloaded_at REAL,
+                PRIMARY KEY (root, masechet, page)) WITHOUT ROWID""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS pages_by_path ON pages (root, path)")
+
+    @classmethod
+    def open(cls, downloads_dir=None):
+        """The app's catalog, scoped to downloads_dir (DOWNLOADS_DIR by default)."""
+        downloads_dir = downloads_dir or DOWNLOADS_DIR
+        legacy = os.path.join(downloads_dir, cls.LEGACY_FILE)
+        if os.path.exists(legacy):
+            os.remove(legacy) # only a cache of the folder; rebuilt by reconcile
+        return cls(get_app_data_path(cls.FILE), downloads_dir)
+
+    def record(self, masechet, page, path, size, md5=None, file_id=None, downloaded_at=None):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (self.root, masechet, page, path, size, md5, file_id, downloaded_at or time.time()))
+
+    def present_pages(self, masechet):
+        """Returns {page: path} for every catalogued page of the masechet."""
+        with self._lock:
+            rows = self._db.execute("SELECT page, path FROM pages WHERE root = ? AND masechet = ?",
+                                    (self.root, masechet)).fetchall()
+        return dict(rows)
+
+    def get(self, masechet, page):
+        """Returns the full row for one page as a dict, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT path, size, md5, file_id, downloaded_at FROM pages "
+                                   "WHERE root = ? AND masechet = ? AND page = ?", (self.root, masechet, page)).fetchone()
+        return dict(zip(('path', 'size', 'md5', 'file_id', 'downloaded_at'), row)) if row else None
+
+    def forget_paths(self, paths):
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM pages WHERE root = ? AND path = ?", [(self.root, p) for p in paths])
+
+    def reconcile(self, masechet, folder):
+        """Brings the masechet's rows in line with the folder using a single directory scan.
+        Rows whose file is gone or changed size are dropped; untracked amud files are added.
+        """
+        on_disk = {}
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.pdf') and entry.is_file():
+                        on_disk[entry.name] = entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            rows = self._db.execute("SELECT page, path, size FROM pages WHERE root = ? AND masechet = ?",
+                                    (self.root, masechet)).fetchall()
+        known = {}
+        stale = []
+        for page, path, size in rows:
+            name = os.path.basename(path)
+            if on_disk.get(name) == size and os.path.dirname(path) == folder:
+                known[name] = page
+            else:
+                stale.append((self.root, masechet, page))
+        new_rows = []
+        filenames = masechet_table(masechet).filenames if masechet in MasechetDownloader.masechtos_info_static else ('',)
+        for page in range(1, len(filenames)):
+            name = filenames[page]
+            if name in on_disk and name not in known:
+                new_rows.append((self.root, masechet, page, os.path.join(folder, name), on_disk[name], None, None, None))
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM pages WHERE root = ? AND masechet = ? AND page = ?", stale)
+            self._db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", new_rows)
+        self._reconciled.add((masechet, folder))
+
+    def ensure_reconciled(self, masechet, folder):
+        """Reconciles the masechet once per session."""
+        if (masechet, folder) not in self._reconciled:
+            self.reconcile(masechet, folder)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class MasechetTable:
+    """Everything derived from a masechet's page numbers, worked out once (see masechet_table)
+    instead of per page: each sequence is indexed by page number (1 = 2a; index 0 is unused).
+    dafs doubles as the merge group, since amudim are merged into their daf.
+    """
+    __slots__ = ('name', 'total_pages', 'dafs', 'labels', 'filenames', 'daf_labels', '_pages_by_label')
+
+    def __init__(self, masechta_name):
+        _, total_pages = MasechetDownloader.masechtos_info_static[masechta_name]
+        self.name = masechta_name
+        self.total_pages = total_pages
+        self.dafs = array('H', [0] + [2 + (page - 1) // 2 for page in range(1, total_pages + 1)])
+        self.labels = ('',) + tuple(f"{self.dafs[page]}{'ab'[(page - 1) % 2]}" for page in range(1, total_pages + 1))
+        self.filenames = ('',) + tuple(f"{masechta_name}_Daf{label[:-1]}_Amud{label[-1]}.pdf" for label in self.labels[1:])
+        self.daf_labels = tuple(str(daf) for daf in range(2, self.dafs[-1] + 1))
+        self._pages_by_label = {label: page for page, label in enumerate(self.labels) if page}
+
+    def page(self, label):
+        """Page number of an amud label such as "15b". Raises ValueError if the masechet has no such amud."""
+        try:
+            return self._pages_by_label[label]
+        except KeyError:
+            raise ValueError(f"{self.name} has no amud {label}") from None
+
+    def daf_filename(self, daf):
+        return f"{self.name}_Daf{daf}.pdf"
+
+
+@functools.lru_cache(maxsize=None)
+def masechet_table(masechta_name):
+    """The MasechetTable for a masechet, built on first use. Raises KeyError for unknown names."""
+    return MasechetTable(masechta_name)
+
+
+class BlobStore:
+    """Content-addressed store of downloaded pages and merged outputs under downloads/.store.
+    Files are kept by their MD5 under objects/, and merges/ maps the MD5s of a merge's inputs
+    to the MD5 of its output. The files in the downloads/ tree are hard links into the store,
+    so a page shared by several exports or a re-merge costs no extra disk space or network.
+    Where the filesystem can't link, files are not stored at all rather than kept twice.
+    A stored file shares its inode with the PDFs linked to it, so one edited in place no
+    longer matches its MD5; it is checked before every reuse and dropped if it changed.
+    A job releases the copies of files it deletes; collect_garbage() sweeps up the rest
+    (files deleted by hand) when asked to.
+    """
+    DIR = '.store'
+
+    def __init__(self, root):
+        self.root = root
+
+    def object_path(self, md5):
+        return os.path.join(self.root, 'objects', md5[:2], md5 + '.pdf')
+
+    def merge_path(self, key):
+        """The file holding the output MD5 of the merge with this key."""
+        return os.path.join(self.root, 'merges', key[:2], key)
+
+    def has(self, md5):
+        """True if md5 is stored and the stored file still has that content."""
+        if not md5:
+            return False
+        stored = self.object_path(md5)
+        try:
+            if file_md5(stored) == md5:
+                return True
+            print(f"[WARN] {os.path.basename(stored)} was edited in place; it will not be reused")
+            os.remove(stored) # the edited PDF keeps the inode
+        except OSError:
+            pass
+        return False
+
+    def ingest(self, path, md5):
+        """Adds a freshly written file with content md5 to the store. If the content is already
+        stored, path is replaced by a link to the stored copy, so the bytes are kept once."""
+        stored = self.object_path(md5)
+        if self.has(md5):
+            link_or_copy(stored, path)
+            return
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        try:
+            os.link(path, stored)
+        except FileExistsError: # stored by another job in the meantime
+            pass
+        except OSError: # no hard links here (e.g. FAT32); a copy would only double the disk used
+            pass
+
+    def materialize(self, md5, path):
+        """Puts the stored content at path. Returns False if it isn't stored."""
+        if not self.has(md5):
+            return False
+        try:
+            link_or_copy(self.object_path(md5), path)
+        except FileNotFoundError: # released by another job in the meantime
+            return False
+        return True
+
+    def release(self, md5):
+        """Removes the stored copy of md5 if no file under downloads/ links to it any more.
+        Call after deleting such a file. Returns the number of bytes freed."""
+        stored = self.object_path(md5)
+        try:
+            stat = os.stat(stored)
+            if stat.st_nlink > 1:
+                return 0
+            os.remove(stored)
+        except OSError:
+            return 0
+        return stat.st_size
+
+    def collect_garbage(self):
+        """Removes every stored file that no file under downloads/ links to any more, and merge
+        records whose output is gone. Walks the whole store, so it only runs on request
+        (--clean-store). Returns the number of bytes freed."""
+        freed = 0
+        for folder, _, names in os.walk(os.path.join(self.root, 'objects')):
+            for name in names:
+                freed += self.release(name[:-len('.pdf')])
+        for folder, _, names in os.walk(os.path.join(self.root, 'merges')):
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    if name.endswith('.pdf'): # merge output stored before merges/ held MD5s
+                        stat = os.stat(path)
+                        if stat.st_nlink == 1:
+                            os.remove(path)
+                            freed += stat.st_size
+                    elif not os.path.exists(self.object_path(self._merged_md5(path) or '0')):
+                        os.remove(path)
+                except OSError:
+                    continue
+        return freed
+
+    @staticmethod
+    def _merged_md5(path):
+        try:
+            with open(path, encoding='ascii') as f:
+                return f.read().strip()
+        except (OSError, ValueError):
+            return None
+
+    def _reuse_merge(self, key, output_filename):
+        """Puts the stored output of the merge with this key at output_filename. Returns False if there is none."""
+        md5 = self._merged_md5(self.merge_path(key))
+        return md5 is not None and self.materialize(md5, output_filename)
+
+    def _store_merge(self, key, output_filename):
+        md5 = file_md5(output_filename)
+        self.ingest(output_filename, md5)
+        record = self.merge_path(key)
+        os.makedirs(os.path.dirname(record), exist_ok=True)
+        with open(record + '.part', 'w', encoding='ascii') as f:
+            f.write(md5)
+        os.replace(record + '.part', record)
+
+    def merge(self, reporter, pdf_files, output_filename, snapshot=None, profile='archival'):
+        """Merges pdf_files into output_filename, reusing an earlier merge of identical inputs
+        with the same output profile. A DirectorySnapshot of the inputs' folder saves a stat per input.
+        Returns True if the result came from the store."""
+        size = snapshot.size if snapshot is not None else _size_or_none
+        md5 = snapshot.md5 if snapshot is not None else file_md5
+        inputs = [p for p in pdf_files if (size(p) or 0) > 0]
+        if not inputs:
+            return False
+        # Archival merges keep the keys they had before there were profiles
+        key_parts = [md5(p) for p in inputs] if profile == 'archival' else [profile] + [md5(p) for p in inputs]
+        key = hashlib.md5(' '.join(key_parts).encode('ascii')).hexdigest()
+        if self._reuse_merge(key, output_filename):
+            return True
+        MasechetDownloader.merge_pdfs(reporter, inputs, output_filename, verified=True, profile=profile)
+        if os.path.exists(output_filename):
+            self._store_merge(key, output_filename)
+        return False
+
+    def impose(self, reporter, dapim, snapshot=None, profile='archival'):
+        """Lays out each (amud a path, amud b path, output) of dapim as a two-up spread page,
+        in parallel worker processes, reusing earlier spreads of identical amudim.
+        Yields whether each output came from the store, in the order of dapim, as soon as
+        it and every output before it are ready. A daf that can't be imposed is merged as
+        two pages instead. Closing the generator early cancels the spreads not yet started."""
+        md5 = snapshot.md5 if snapshot is not None else file_md5
+        pending = []
+        for amud_a, amud_b, output in dapim:
+            key_parts = ['spread', profile] + [md5(p) if p else '-' for p in (amud_a, amud_b)]
+            key = hashlib.md5(' '.join(key_parts).encode('ascii')).hexdigest()
+            if self._reuse_merge(key, output):
+                pending.append((key, None))
+                continue
+            try:
+                future = _pdf_pool().submit(_impose_spread, amud_a, amud_b, output, profile)
+            except concurrent.futures.BrokenExecutor:
+                _pdf_pool.cache_clear()
+                raise
+            pending.append((key, future))
+
+        try:
+            for (amud_a, amud_b, output), (key, future) in zip(dapim, pending):
+                if future is None:
+                    yield True
+                    continue
+                try:
+                    future.result()
+                except Exception as e:
+                    if isinstance(e, concurrent.futures.BrokenExecutor):
+                        _pdf_pool.cache_clear()
+                    print(f"[WARN] Could not lay out {os.path.basename(output)} as a spread, merging its amudim instead: {e}")
+                    MasechetDownloader.merge_pdfs(reporter, [p for p in (amud_a, amud_b) if p], output,
+                                                  verified=True, profile=profile)
+                    yield False
+                    continue
+                self._store_merge(key, output)
+                yield False
+        finally:
+            for _, future in pending:
+                if future is not None:
+                    future.cancel()
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_md5(path, size, mtime_ns):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def file_md5(path):
+    """MD5 of a file's contents, remembered while the file's size and mtime stay the same."""
+    stat = os.stat(path)
+    return _cached_md5(path, stat.st_size, stat.st_mtime_ns)
+
+
+def _size_or_none(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class DirectorySnapshot:
+    """What a download folder holds, from a single os.scandir, kept current as the job writes
+    and deletes files there. Existence checks become dictionary lookups instead of a stat per
+    page, which matters on network shares where every stat is a round trip. Sizes come from the
+    scan's DirEntry (no extra call on Windows) or from what the job wrote. Paths outside the
+    folder are checked on disk as usual.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        # name -> DirEntry from the scan, (size, md5) of a file the job wrote, or its os.stat_result
+        self._entries = {}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self._entries[entry.name] = entry
+
+    def _entry(self, path):
+        """(name, entry); name is None for paths outside the folder, entry None if there is no such file."""
+        folder, name = os.path.split(path)
+        if folder != self.folder:
+            return None, None
+        with self._lock:
+            return name, self._entries.get(name)
+
+    def names(self):
+        with self._lock:
+            return list(self._entries)
+
+    def exists(self, path):
+        name, entry = self._entry(path)
+        return os.path.exists(path) if name is None else entry is not None
+
+    def size(self, path):
+        """Size of the file, or None if it doesn't exist."""
+        name, entry = self._entry(path)
+        if name is None:
+            return _size_or_none(path)
+        if entry is None:
+            return None
+        if isinstance(entry, os.stat_result): # a tuple too, so checked first
+            return entry.st_size
+        return entry[0] if isinstance(entry, tuple) else entry.stat().st_size
+
+    def md5(self, path):
+        name, entry = self._entry(path)
+        if entry is None:
+            return file_md5(path)
+        if isinstance(entry, tuple) and not isinstance(entry, os.stat_result):
+            return entry[1]
+        stat = entry if isinstance(entry, os.stat_result) else entry.stat()
+        return _cached_md5(path, stat.st_size, stat.st_mtime_ns)
+
+    def record(self, path, size=None, md5=None):
+        """Notes a file the job has just written. Without its size and md5, it is stat'ed once now."""
+        folder, name = os.path.split(path)
+        if folder == self.folder:
+            entry = (size, md5) if size is not None and md5 is not None else os.stat(path)
+            with self._lock:
+                self._entries[name] = entry
+
+    def forget(self, path):
+        folder, name = os.path.split(path)
+        if folder == self.folder:
+            with self._lock:
+                self._entries.pop(name, None)
 
 
 def get_app_data_path(filename):
@@ -71,6 +1481,1825 @@ def get_app_data_path(filename):
             os.makedirs(fallback_path, exist_ok=True)
         return os.path.join(fallback_path, filename)
 
+class JobJournal:
+    """Append-only write-ahead log of a DownloadJob's progress, one JSON record per line.
+    Every step (planned pages, downloaded page, merged daf, pending and finished deletions)
+    is flushed to disk before the job moves on, so replaying the log after a crash
+    rebuilds the job exactly where it stopped. A torn last line is ignored. The first record
+    also lists the jobs queued behind this one, so a typed selection survives a restart whole.
+    """
+    FILE = 'download_job.journal'
+
+    def __init__(self, path, mode):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fh = open(path, mode, encoding='utf-8')
+
+    @classmethod
+    def create(cls, path, job, queued=()):
+        """Starts a new journal whose first record is the job's complete current state."""
+        journal = cls(path, 'w')
+        journal.append('plan', job=job.to_dict(), queued=[queued_job.to_dict() for queued_job in queued])
+        job.journal = journal
+        return journal
+
+    def append(self, op, **fields):
+        fields['op'] = op
+        line = json.dumps(fields)
+        with self._lock:
+            self._fh.write(line + '\n')
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+    @staticmethod
+    def replay(path):
+        """Rebuilds the unfinished job recorded in path, or returns None if there is none."""
+        job = None
+        try:
+            with open(path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+        for line_number, line in enumerate(lines, 1):
+            try:
+                record = json.loads(line)
+                op = record['op']
+                if op == 'plan':
+                    job = DownloadJob.from_dict(record['job'])
+                elif job is None:
+                    raise ValueError("record before plan")
+                elif op == 'file_ids':
+                    job.file_ids.update(record['file_ids'])
+                elif op == 'page':
+                    job.completed.add(record['page'])
+                elif op == 'stage':
+                    job.stage = record['stage']
+                elif op == 'daf_merged':
+                    job.merged_dapim[record['daf']] = record['path']
+                    job.files_to_delete.extend(p for p in record['delete'] if p not in job.files_to_delete)
+                elif op == 'deleted':
+                    if record['path'] in job.files_to_delete:
+                        job.files_to_delete.remove(record['path'])
+                elif op == 'done':
+                    job = None
+            except (ValueError, KeyError, TypeError) as e:
+                if line_number < len(lines):
+                    print(f"[WARN] Ignoring corrupt journal {path} (line {line_number}: {e})")
+                    return None
+                # Torn final write from a crash; everything before it is intact
+        return job
+
+    @staticmethod
+    def replay_queue(path):
+        """Rebuilds the jobs that were queued behind the one recorded in path."""
+        try:
+            with open(path, encoding='utf-8') as f:
+                record = json.loads(f.readline())
+            return [DownloadJob.from_dict(data) for data in record.get('queued', ())]
+        except FileNotFoundError:
+            return []
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"[WARN] Ignoring the queued jobs in corrupt journal {path}: {e}")
+            return []
+
+    @staticmethod
+    def discard(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class PageSet:
+    """A set of page numbers kept as a bitmap (bit n set = page n present), so a whole
+    masechet is a few dozen bytes and union, intersection and difference are single integer
+    operations. Iterates in page order. Mutable via add/discard; the operators return new sets.
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, pages=()):
+        if isinstance(pages, PageSet):
+            self.bits = pages.bits
+            return
+        if isinstance(pages, range) and pages.step == 1:
+            self.bits = self.from_intervals([(pages.start, pages.stop - 1)]).bits if pages else 0
+            return
+        bits = 0
+        for page in pages:
+            bits |= 1 << page
+        self.bits = bits
+
+    @classmethod
+    def from_intervals(cls, intervals):
+        """Builds the set from (first, last) page intervals, in time proportional to their number."""
+        page_set = cls()
+        for first, last in intervals:
+            if first <= last:
+                page_set.bits |= ((1 << (last - first + 1)) - 1) << first
+        return page_set
+
+    @classmethod
+    def _of(cls, bits):
+        page_set = cls()
+        page_set.bits = bits
+        return page_set
+
+    def intervals(self):
+        """The set as sorted, maximal [first, last] runs (JSON-friendly)."""
+        runs = []
+        bits = self.bits
+        while bits:
+            first = (bits & -bits).bit_length() - 1
+            # Adding the lowest set bit carries through the run that starts there
+            last = ((bits + (1 << first)) & -(bits + (1 << first))).bit_length() - 2
+            runs.append([first, last])
+            bits &= ~(((1 << (last - first + 1)) - 1) << first)
+        return runs
+
+    def add(self, page):
+        self.bits |= 1 << page
+
+    def discard(self, page):
+        self.bits &= ~(1 << page)
+
+    def first(self):
+        """The lowest page, or None if the set is empty."""
+        return (self.bits & -self.bits).bit_length() - 1 if self.bits else None
+
+    def last(self):
+        return self.bits.bit_length() - 1 if self.bits else None
+
+    def below(self, page):
+        """The pages lower than page."""
+        return self._of(self.bits & ((1 << page) - 1))
+
+    def __contains__(self, page):
+        return page >= 0 and bool(self.bits >> page & 1)
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __bool__(self):
+        return bool(self.bits)
+
+    def __or__(self, other):
+        return self._of(self.bits | other.bits)
+
+    def __and__(self, other):
+        return self._of(self.bits & other.bits)
+
+    def __sub__(self, other):
+        return self._of(self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, PageSet) and self.bits == other.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return f"PageSet({format_pages(self)!r})"
+
+
+class PageScheduler:
+    """Thread-safe queue of the pages a job still needs.
+    Pages come out in reading order, except that pages of pinned dapim jump the queue,
+    so the start of a selection (or the daf the user wants now) arrives first.
+    """
+
+    def __init__(self, pages, pinned_dapim=()):
+        self._lock = threading.Lock()
+        self._pending = PageSet(pages)
+        self._pinned = PageSet()
+        self._closed = False
+        self.pin(pinned_dapim)
+
+    def pin(self, dapim):
+        """Moves the remaining pages of these dapim to the front of the queue."""
+        with self._lock:
+            for daf in dapim:
+                self._pinned.add(amud_page(daf, 'a'))
+                self._pinned.add(amud_page(daf, 'b'))
+
+    def get(self):
+        """Returns the next page to download, or None when there is nothing left."""
+        with self._lock:
+            if self._closed or not self._pending:
+                return None
+            page = (self._pending & self._pinned).first() or self._pending.first()
+            self._pending.discard(page)
+            return page
+
+    def close(self):
+        """Stops handing out pages, e.g. after a worker failed."""
+        with self._lock:
+            self._closed = True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+
+# One item of a selection expression: a daf or amud ("15", "15a") or a range of them ("20b-22a")
+# Longest "Selection_..." part of a merged filename; longer selections are cut short and told
+# apart by a hash of the whole selection, keeping the basename well under 255 characters.
+SELECTION_SUFFIX_MAX = 100
+SELECTION_ITEM = re.compile(r'(\d+)([ab]?)(?:\s*-\s*(\d+)([ab]?))?')
+
+
+def amud_page(daf, amud):
+    """Page number of an amud; 2a is page 1."""
+    return 2 * (daf - 2) + (1 if amud == 'a' else 2)
+
+
+def merge_intervals(intervals):
+    """Sorts (first, last) page intervals and joins overlapping or adjacent ones."""
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _split_masechta(clause):
+    """Splits "Bava Kamma 2-10" into ("Bava Kamma", "2-10"). Names are matched ignoring case."""
+    lowered = clause.lower()
+    for masechta_name in sorted(MasechetDownloader.masechtos_info_static, key=len, reverse=True):
+        name = masechta_name.lower()
+        if lowered.startswith(name) and (len(clause) == len(name) or clause[len(name)].isspace()):
+            return masechta_name, clause[len(name):].strip()
+    raise ValueError(f"Unknown masechet in \"{clause}\"")
+
+
+def parse_selection(text):
+    """Compiles a selection expression such as "Brachos 2-10, 15a, 20b-22a; Shabbos all" into
+    {masechet: [(first page, last page), ...]}, with each masechet's intervals sorted and merged.
+    Clauses are separated by ';' or new lines; a masechet with nothing after it means all of it.
+    A daf stands for both its amudim, so 2-10 runs from 2a to 10b and 20b-22a from 20b to 22a.
+    The work done is proportional to the number of items, not of pages.
+    Raises ValueError describing the first part it can't read.
+    """
+    plan = {}
+    for clause in re.split(r'[;\n]', text):
+        clause = clause.strip()
+        if not clause:
+            continue
+        masechta_name, items = _split_masechta(clause)
+        table = masechet_table(masechta_name)
+        total_pages = table.total_pages
+        intervals = plan.setdefault(masechta_name, [])
+        for item in (items or 'all').split(','):
+            item = item.strip().lower()
+            if item == 'all':
+                intervals.append((1, total_pages))
+                continue
+            match = SELECTION_ITEM.fullmatch(item)
+            if not match:
+                raise ValueError(f"Can't read \"{item}\" in \"{clause}\"")
+            first_daf, first_amud, last_daf, last_amud = match.groups()
+            if last_daf is None:
+                last_daf, last_amud = first_daf, first_amud
+            first = amud_page(int(first_daf), first_amud or 'a')
+            last = amud_page(int(last_daf), last_amud or 'b')
+            if not last_amud and last == total_pages + 1:
+                last = total_pages # the masechet ends on an amud a
+            if first > last:
+                raise ValueError(f"{masechta_name} {item} ends before it starts")
+            if int(first_daf) < 2 or last > total_pages:
+                raise ValueError(f"{masechta_name} {item} is not within 2a-{table.labels[total_pages]}")
+            intervals.append((first, last))
+    if not plan:
+        raise ValueError("Nothing selected")
+    return {masechta_name: merge_intervals(intervals) for masechta_name, intervals in plan.items()}
+
+
+def format_intervals(masechta_name, intervals):
+    """The items of a selection expression for one masechet's intervals, e.g. "2-10, 15a, 20b-22a"."""
+    table = masechet_table(masechta_name)
+    total_pages = table.total_pages
+    if intervals == [(1, total_pages)]:
+        return "all"
+    labels = table.labels
+    items = []
+    for first, last in intervals:
+        whole_dapim = first % 2 == 1 and (last % 2 == 0 or last == total_pages)
+        if whole_dapim:
+            first_daf, last_daf = table.dafs[first], table.dafs[last]
+            items.append(str(first_daf) if first_daf == last_daf else f"{first_daf}-{last_daf}")
+        else:
+            items.append(labels[first] if first == last else f"{labels[first]}-{labels[last]}")
+    return ", ".join(items)
+
+
+def format_selection(plan):
+    """Inverse of parse_selection."""
+    return "; ".join(f"{masechta_name} {format_intervals(masechta_name, intervals)}" for masechta_name, intervals in plan.items())
+
+
+def selection_suffix(items):
+    """The merged-filename suffix for a formatted selection, e.g. "Selection_2a-5b_7"."""
+    suffix = "Selection_" + re.sub(r'[^0-9ab-]+', '_', items)
+    if len(suffix) > SELECTION_SUFFIX_MAX:
+        digest = hashlib.md5(items.encode('ascii')).hexdigest()[:8]
+        suffix = suffix[:SELECTION_SUFFIX_MAX - len(digest) - 1].rstrip('_-') + "_" + digest
+    return suffix
+
+
+def selection_jobs(plan, merge_all=True, merge_amudim=False, keep_individuals=False, profile=PDF_PROFILE,
+                   layout='pages'):
+    """One DownloadJob per masechet of a compiled selection."""
+    jobs = []
+    for masechta_name, intervals in plan.items():
+        items = format_intervals(masechta_name, intervals)
+        suffix = "All" if items == "all" else selection_suffix(items)
+        pages = PageSet.from_intervals(intervals)
+        jobs.append(DownloadJob(masechta_name, pages, merge_all, merge_amudim, keep_individuals, suffix,
+                                use_bundle=wants_bundle(masechta_name, pages), profile=profile,
+                                layout=layout))
+    return jobs
+
+
+def bundle_names(masechta_name):
+    """Filenames a full-masechet bundle may have in the Drive folder, in order of preference."""
+    return (f"{masechta_name}.zip", f"{masechta_name}_Full.pdf")
+
+
+def wants_bundle(masechta_name, pages):
+    """True if pages cover enough of the masechet that fetching its bundle beats fetching each amud."""
+    _, total_pages = MasechetDownloader.masechtos_info_static[masechta_name]
+    return len(pages) >= BUNDLE_MIN_FRACTION * total_pages
+
+
+class BundleReader:
+    """Reads amud PDFs out of a full-masechet bundle: a ZIP of the amud files, or one PDF with
+    a page per amud (page 1 = 2a). source is a path or a seekable file such as a RangeFile;
+    only the parts needed for the extracted amudim are read. Use as a context manager."""
+
+    def __init__(self, source, masechta_name):
+        self.source = source
+        self.masechta_name = masechta_name
+        self._zip = None
+        self._members = {}
+        self._pdf = None
+
+    def __enter__(self):
+        if zipfile.is_zipfile(self.source):
+            self._zip = zipfile.ZipFile(self.source)
+            self._members = {os.path.basename(name): name for name in self._zip.namelist()}
+        else:
+            self._pdf = PdfReader(self.source)
+            _, total_pages = MasechetDownloader.masechtos_info_static[self.masechta_name]
+            count = self._pdf.trailer['/Root']['/Pages']['/Count']
+            if count != total_pages:
+                raise ValueError(f"The {self.masechta_name} bundle has {count} pages, expected {total_pages}")
+        return self
+
+    def __exit__(self, *exc):
+        if self._zip is not None:
+            self._zip.close()
+
+    def extract(self, page_num, filename, fh):
+        """Writes the amud to fh. Returns False if the bundle doesn't have it."""
+        if self._zip is not None:
+            member = self._members.get(filename)
+            if member is None:
+                return False
+            with self._zip.open(member) as src:
+                shutil.copyfileobj(src, fh, DOWNLOAD_CHUNK_SIZE)
+            return True
+        writer = PdfWriter()
+        writer.add_page(pdf_page(self._pdf, page_num - 1))
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        fh.write(buffer.getvalue())
+        return True
+
+
+def pdf_page(reader, index):
+    """reader.pages[index] without loading every page object first, as reader.pages does.
+    Only the page tree nodes on the way to the page are read, and a node whose kids are
+    all pages is indexed directly."""
+    inheritable = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+    inherited = {}
+    node = reader.trailer['/Root']['/Pages'].get_object()
+    while True:
+        inherited.update((key, node[key]) for key in inheritable if key in node)
+        kids = node['/Kids']
+        if node['/Count'] == len(kids):
+            reference = kids[index]
+            break
+        for kid in kids:
+            kid_node = kid.get_object()
+            count = kid_node['/Count'] if kid_node.get('/Type') == '/Pages' else 1
+            if index < count:
+                break
+            index -= count
+        if kid_node.get('/Type') != '/Pages':
+            reference = kid
+            break
+        node = kid_node
+    page = PageObject(reader, reference)
+    page.update(reference.get_object())
+    for key, value in inherited.items():
+        page.setdefault(NameObject(key), value)
+    return page
+
+
+class DownloadJob:
+    """A planned download: which pages, how to merge them, and how far it has got.
+    Progress is recorded in an optional JobJournal, so a paused, interrupted or crashed
+    job resumes later without re-planning or re-listing Drive.
+    """
+
+    def __init__(self, masechta_name, pages, merge_all=True, merge_amudim=False, keep_individuals=False,
+                 merged_suffix="Individual_Selection", pinned_dapim=(), use_bundle=False, profile=PDF_PROFILE,
+                 layout='pages'):
+        self.masechta_name = masechta_name
+        self.table = masechet_table(masechta_name)
+        self.pages = PageSet(pages)
+        self.merge_all = merge_all
+        self.merge_amudim = merge_amudim
+        self.keep_individuals = keep_individuals
+        self.merged_suffix = merged_suffix
+        self.stage = 'download' # download -> merge -> cleanup -> done
+        self.completed = PageSet() # pages on disk at page_path(page)
+        self.merged_dapim = {}  # daf -> merged daf PDF
+        self.files_to_delete = []
+        self.file_ids = {}      # filename -> Drive file id
+        self.pinned_dapim = sorted(pinned_dapim) # downloaded before the rest of the selection
+        self.use_bundle = use_bundle # try the masechet's bundle before per-page downloads
+        self.profile = profile # PDF_PROFILES key for merged output
+        self.layout = layout # DAF_LAYOUTS entry for merged dapim
+        self.journal = None
+        self.snapshot = None # DirectorySnapshot of download_dir, taken when run() starts
+        # Called (from a download thread) with the paths of the longest finished run of
+        # pages from the start of the selection, each time that run grows
+        self.on_prefix_ready = None
+        self._lock = threading.Lock()
+        self._hook_lock = threading.Lock() # keeps prefix hooks in order
+        self._boundary = self.pages.first() # first page not yet settled
+        self._settled = PageSet()
+
+    @property
+    def download_dir(self):
+        return os.path.join(DOWNLOADS_DIR, self.masechta_name)
+
+    def page_path(self, page_num):
+        return os.path.join(self.download_dir, self.table.filenames[page_num])
+
+    @property
+    def store(self):
+        return BlobStore(os.path.join(DOWNLOADS_DIR, BlobStore.DIR))
+
+    @property
+    def merged_filename(self):
+        return os.path.join(DOWNLOADS_DIR, f"{self.masechta_name}_{self.merged_suffix}_Full.pdf")
+
+    def to_dict(self):
+        return {
+            'masechta_name': self.masechta_name, 'pages': self.pages.intervals(), 'merge_all': self.merge_all,
+            'merge_amudim': self.merge_amudim, 'keep_individuals': self.keep_individuals,
+            'merged_suffix': self.merged_suffix, 'stage': self.stage,
+            'completed': self.completed.intervals(),
+            'merged_dapim': {str(k): v for k, v in self.merged_dapim.items()},
+            'files_to_delete': self.files_to_delete, 'file_ids': self.file_ids,
+            'pinned_dapim': self.pinned_dapim, 'use_bundle': self.use_bundle, 'profile': self.profile,
+            'layout': self.layout,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['masechta_name'], cls._page_set(data['pages']), data['merge_all'], data['merge_amudim'],
+                  data['keep_individuals'], data['merged_suffix'], data.get('pinned_dapim', ()),
+                  data.get('use_bundle', False), data.get('profile', 'archival'), data.get('layout', 'pages'))
+        job.stage = data['stage']
+        job.completed = cls._page_set(data['completed'])
+        job.merged_dapim = {int(k): v for k, v in data['merged_dapim'].items()}
+        job.files_to_delete = list(data['files_to_delete'])
+        job.file_ids = dict(data['file_ids'])
+        return job
+
+    @staticmethod
+    def _page_set(value):
+        """Reads pages saved by to_dict; older journals have page lists and {page: path} maps."""
+        if isinstance(value, dict):
+            return PageSet(int(page) for page in value)
+        if value and isinstance(value[0], int):
+            return PageSet(value)
+        return PageSet.from_intervals(value)
+
+    def _log(self, op, **fields):
+        if self.journal is not None:
+            self.journal.append(op, **fields)
+
+    def run(self, client, control, reporter, instrumentation, catalog=None, workers=DOWNLOAD_WORKERS):
+        """Runs whatever stages are left, reporting to a ProgressAggregator.
+        Pages are downloaded by up to workers threads (one, unless client has a service_factory).
+        Pages already on disk are found with one query to a PageCatalog, or else from a single
+        scan of the folder (a DirectorySnapshot), instead of a stat each.
+        Raises JobCancelled if control is cancelled; the job can then be resumed from its journal.
+        """
+        os.makedirs(self.download_dir, exist_ok=True)
+        self.snapshot = DirectorySnapshot(self.download_dir)
+        # Leftovers from a run that died mid-write; they are never valid output
+        for name in self.snapshot.names():
+            if name.endswith('.part'):
+                path = os.path.join(self.download_dir, name)
+                try:
+                    if time.time() - os.stat(path).st_mtime < STALE_PART_FILE_AGE:
+                        continue # still being written by another job
+                    os.remove(path)
+                except OSError: # gone already, or still open (Windows)
+                    continue
+                self.snapshot.forget(path)
+        if self.file_ids:
+            client.file_ids.setdefault(self.masechta_name, {}).update(self.file_ids)
+        elif self.stage == 'download':
+            reporter.set_status(f"Listing {self.masechta_name} on Google Drive...")
+            try:
+                self.file_ids = dict(client.list_masechta_files(self.masechta_name))
+                self._log('file_ids', file_ids=self.file_ids)
+            except HttpError as error:
+                # Not fatal: each page falls back to its own lookup
+                print(f"[WARN] Could not list {self.masechta_name} on Drive: {error}")
+
+        if self.stage == 'download':
+            self._download_pages(client, control, reporter, instrumentation, catalog, workers)
+            self._set_stage('merge')
+        if self.stage == 'merge':
+            self._merge(control, reporter, instrumentation)
+            self._set_stage('cleanup')
+        if self.stage == 'cleanup':
+            with instrumentation.phase('cleanup', files=len(self.files_to_delete)):
+                while self.files_to_delete:
+                    control.checkpoint()
+                    path = self.files_to_delete[-1]
+                    try:
+                        md5 = self.snapshot.md5(path)
+                    except OSError: # deleted before an interrupted run could log it
+                        md5 = None
+                    MasechetDownloader.clean_up(reporter, [path])
+                    if md5:
+                        self.store.release(md5)
+                    self.snapshot.forget(path)
+                    if catalog is not None:
+                        catalog.forget_paths([path])
+                    self._log('deleted', path=path)
+                    self.files_to_delete.pop()
+            self._set_stage('done')
+            self._log('done')
+
+    def _set_stage(self, stage):
+        self.stage = stage
+        self._log('stage', stage=stage)
+
+    def _download_pages(self, client, control, reporter, instrumentation, catalog, workers):
+        present = {}
+        if catalog is not None:
+            catalog.ensure_reconciled(self.masechta_name, self.download_dir)
+            present = catalog.present_pages(self.masechta_name)
+        reporter.start(len(self.pages), done=len(self.completed))
+        self._settled = PageSet(self.completed)
+        self._download_bundle(client, control, reporter, instrumentation, catalog, present)
+        scheduler = PageScheduler(self.pages - self.completed, self.pinned_dapim)
+        instrumentation.set_queue_depth(len(scheduler))
+        self._advance_prefix()
+        if not client.parallel:
+            workers = 1
+        workers = max(1, min(workers, len(scheduler)))
+
+        def worker():
+            try:
+                while True:
+                    control.checkpoint()
+                    page_num = scheduler.get()
+                    if page_num is None:
+                        return
+                    self._download_page(page_num, client, control, reporter, instrumentation, catalog, present)
+                    instrumentation.set_queue_depth(len(scheduler))
+            except BaseException:
+                scheduler.close()
+                raise
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download') as pool:
+            futures = [pool.submit(worker) for _ in range(workers)]
+        for future in futures:
+            future.result()
+
+    def _download_page(self, page_num, client, control, reporter, instrumentation, catalog, present):
+        local_path = self.page_path(page_num)
+        filename = os.path.basename(local_path)
+
+        reporter.set_status(f"Downloading {filename}...")
+        reporter.page_started()
+        with instrumentation.phase('page', page=page_num, filename=filename):
+            exists = self._on_disk(page_num, catalog, present)
+            info = None
+            if not exists:
+                info = self._from_store(client, filename, local_path, instrumentation) or \
+                    self._fetch(client, control, reporter, filename, local_path)
+            success = exists or info is not None
+        if info is not None:
+            self.snapshot.record(local_path, info['size'], info['md5'])
+        if info is not None and catalog is not None:
+            catalog.record(self.masechta_name, page_num, local_path, info['size'], info['md5'], info['file_id'])
+        if exists:
+            instrumentation.count('pages_existing')
+        elif success:
+            instrumentation.count('pages_downloaded')
+        else:
+            instrumentation.count('pages_failed')
+            reporter.set_status(f"Failed to download {filename}. Skipping.")
+        with self._lock:
+            if success:
+                self.completed.add(page_num)
+                self._log('page', page=page_num)
+            self._settled.add(page_num)
+        reporter.page_finished(info['size'] if info else 0, ok=success)
+        self._advance_prefix()
+
+    def _download_bundle(self, client, control, reporter, instrumentation, catalog, present):
+        """Gets the missing pages out of the masechet's bundle, if its folder has one: the whole
+        bundle in one request when enough pages are missing, otherwise just their byte ranges
+        (see BUNDLE_RANGE_MIN_PAGES). Anything it doesn't provide is left to the per-page downloads."""
+        missing = [p for p in self.pages - self.completed if not self._on_disk(p, catalog, present)]
+        listing = client.file_ids.get(self.masechta_name, {})
+        name = next((n for n in bundle_names(self.masechta_name) if n in listing), None)
+        if name is None or not missing:
+            return
+        if self.use_bundle and wants_bundle(self.masechta_name, missing):
+            bundle_path = os.path.join(self.download_dir, name)
+            reporter.set_status(f"Downloading {name}...")
+            with instrumentation.phase('bundle', filename=name):
+                info = self._from_store(client, name, bundle_path, instrumentation) or \
+                    self._fetch(client, control, reporter, name, bundle_path)
+            if info is None:
+                return
+            try:
+                self._split_bundle(bundle_path, name, missing, control, reporter, instrumentation, catalog)
+            finally:
+                os.remove(bundle_path)
+                self.store.release(info['md5']) # the split pages are what's kept
+            return
+        has_amudim = any('_Amud' in filename for filename in listing)
+        if len(missing) < BUNDLE_RANGE_MIN_PAGES and has_amudim:
+            return
+        try:
+            remote = client.open_range(self.masechta_name, name)
+        except (FileNotFoundError, HttpError) as e:
+            print(f"[WARN] Could not open {name} for ranged reads: {e}")
+            return
+        if remote is not None:
+            reporter.set_status(f"Reading {len(missing)} pages from {name}...")
+            with instrumentation.phase('bundle', filename=name, pages=len(missing)):
+                self._split_bundle(remote, name, missing, control, reporter, instrumentation, catalog)
+
+    def _split_bundle(self, source, name, pages, control, reporter, instrumentation, catalog):
+        try:
+            with BundleReader(source, self.masechta_name) as bundle:
+                for page_num in pages:
+                    control.checkpoint()
+                    self._split_page(bundle, page_num, reporter, instrumentation, catalog)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            print(f"[WARN] Could not split {name}, downloading pages one by one: {e}")
+
+    def _on_disk(self, page_num, catalog, present):
+        """True if the page is in the folder scan, and in the catalog too when there is one.
+        The catalog is only reconciled once a session, so on its own it can miss a later deletion."""
+        local_path = self.page_path(page_num)
+        if catalog is not None and present.get(page_num) != local_path:
+            return False
+        return self.snapshot.exists(local_path)
+
+    def _split_page(self, bundle, page_num, reporter, instrumentation, catalog):
+        local_path = self.page_path(page_num)
+        filename = os.path.basename(local_path)
+        part_path = local_path + '.part'
+        reporter.page_started()
+        try:
+            with io.FileIO(part_path, 'wb') as fh:
+                writer = _TimedWriter(fh, instrumentation)
+                found = bundle.extract(page_num, filename, writer)
+            if found:
+                os.replace(part_path, local_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        if not found:
+            return
+        md5 = writer.md5.hexdigest()
+        self.store.ingest(local_path, md5)
+        self.snapshot.record(local_path, writer.size, md5)
+        if catalog is not None:
+            catalog.record(self.masechta_name, page_num, local_path, writer.size, md5)
+        instrumentation.count('pages_from_bundle')
+        with self._lock:
+            self.completed.add(page_num)
+            self._log('page', page=page_num)
+            self._settled.add(page_num)
+        reporter.page_finished(writer.size)
+        self._advance_prefix()
+
+    def _advance_prefix(self):
+        """Fires on_prefix_ready if more pages from the start of the selection are now settled.
+        Failed pages count as settled, since the merged output will skip them anyway."""
+        with self._hook_lock:
+            with self._lock:
+                if self._boundary is None:
+                    return
+                unsettled = self.pages - self._settled
+                boundary = unsettled.first() if unsettled else self.pages.last() + 1
+                if boundary == self._boundary or self.on_prefix_ready is None:
+                    return
+                self._boundary = boundary
+                paths = [self.page_path(p) for p in self.completed.below(boundary)]
+            self.on_prefix_ready(paths)
+
+    def first_daf_ready(self):
+        """Paths of the downloaded amudim of the first daf that has any, once every selected
+        amud of that daf is settled (downloaded or failed); None until then."""
+        with self._lock:
+            if self._boundary is None:
+                return None
+            boundary = self._boundary
+            settled = self.completed.below(boundary)
+        if not settled:
+            return None
+        daf_end = amud_page(self.table.dafs[settled.first()] + 1, 'a')
+        if boundary < min(daf_end, self.pages.last() + 1):
+            return None
+        return [self.page_path(p) for p in settled.below(daf_end)]
+
+    def _from_store(self, client, filename, local_path, instrumentation):
+        """Links the page from the BlobStore if Drive's checksum for it is already stored.
+        Returns its info, or None if it has to be downloaded."""
+        file_id = client.file_ids.get(self.masechta_name, {}).get(filename)
+        md5 = client.file_md5s.get(file_id)
+        if not self.store.materialize(md5, local_path):
+            return None
+        instrumentation.count('store_hits')
+        return {'file_id': file_id, 'size': os.path.getsize(local_path), 'md5': md5}
+
+    def _fetch(self, client, control, reporter, filename, local_path):
+        """Downloads one page and returns its info, reporting (rather than raising) anything but cancellation.
+        Returns None on failure."""
+        try:
+            info = client.download(self.masechta_name, filename, local_path, control)
+            self.store.ingest(local_path, info['md5'])
+            return info
+        except FileNotFoundError:
+            print(f"[WARN] File not found in Drive: {filename}")
+            reporter.set_status(f"File not found in Drive: {filename}")
+        except HttpError as error:
+            print(f"[ERROR] An HTTP error occurred: {error}")
+            reporter.set_status(f"[ERROR] An HTTP error occurred: {error}")
+        except JobCancelled:
+            raise
+        except Exception as e:
+            print(f"[ERROR] An unexpected error occurred: {e}")
+            reporter.set_status(f"[ERROR] An unexpected error occurred: {e}")
+        return None
+
+    def _merge(self, control, reporter, instrumentation):
+        """Handles all PDF merging operations based on the job's options."""
+        files_for_final_merge = []
+
+        if self.merge_amudim:
+            reporter.set_status("Merging Amudim into Dapim...")
+            daf_to_files = {}
+            for page_num in self.completed:
+                daf = self.table.dafs[page_num]
+                if daf not in daf_to_files: daf_to_files[daf] = []
+                daf_to_files[daf].append(self.page_path(page_num))
+
+            unmerged = []
+            for daf, paths in sorted(daf_to_files.items()):
+                daf_filename = os.path.join(self.download_dir, self.table.daf_filename(daf))
+                if daf not in self.merged_dapim:
+                    unmerged.append((daf, sorted(paths), daf_filename))
+                files_for_final_merge.append(daf_filename)
+            if self.layout == 'spread':
+                self._impose_dapim(control, reporter, instrumentation, unmerged)
+            else:
+                for daf, paths, daf_filename in unmerged:
+                    control.checkpoint()
+                    self._merge_files(reporter, instrumentation, paths, daf_filename, self.profile)
+                    self._daf_merged(daf, paths, daf_filename)
+        else:
+            # PageSet iterates in page order
+            files_for_final_merge.extend(self.page_path(p) for p in self.completed)
+
+        if self.merge_all:
+            control.checkpoint()
+            reporter.set_status("Merging selection into a single PDF...")
+            # Daf files were already recompressed; doing it again would only lose quality
+            profile = 'archival' if self.merge_amudim else self.profile
+            self._merge_files(reporter, instrumentation, files_for_final_merge, self.merged_filename, profile)
+
+    def _impose_dapim(self, control, reporter, instrumentation, unmerged):
+        """Lays out each daf of unmerged as one two-up page, all dapim at once in worker processes."""
+        dapim = []
+        for daf, paths, daf_filename in unmerged:
+            amudim = dict(zip((p[-len('a.pdf')] for p in paths), paths)) # ..._Amuda.pdf / ..._Amudb.pdf
+            dapim.append((amudim.get('a'), amudim.get('b'), daf_filename))
+        with instrumentation.phase('impose', dapim=len(dapim), profile=self.profile):
+            results = self.store.impose(reporter, dapim, self.snapshot, self.profile)
+            try:
+                for (daf, paths, daf_filename), reused in zip(unmerged, results):
+                    instrumentation.count('merge_cache_hits' if reused else 'merge_cache_misses')
+                    self._daf_merged(daf, paths, daf_filename)
+                    control.checkpoint()
+            finally:
+                results.close() # a cancelled job doesn't leave spreads queued in the pool
+
+    def _daf_merged(self, daf, paths, daf_filename):
+        self.snapshot.record(daf_filename)
+        self.merged_dapim[daf] = daf_filename
+        delete = [] if self.keep_individuals else [p for p in paths if p not in self.files_to_delete]
+        self.files_to_delete.extend(delete)
+        self._log('daf_merged', daf=daf, path=daf_filename, delete=delete)
+
+    def _merge_files(self, reporter, instrumentation, paths, output_filename, profile):
+        with instrumentation.phase('merge', output=output_filename, inputs=len(paths), profile=profile):
+            reused = self.store.merge(reporter, paths, output_filename, self.snapshot, profile)
+        instrumentation.count('merge_cache_hits' if reused else 'merge_cache_misses')
+
+
+# Daf Yomi cycle 14 began with Brachos 2 on this date; a cycle is 2711 days.
+DAF_YOMI_CYCLE_START = datetime.date(2020, 1, 5)
+# Kinnim, Tamid and Middos are learned after Meilah (as Meilah 22-37) but have no files here.
+DAF_YOMI_EXTRA_MEILAH_DAYS = 15
+
+
+@functools.lru_cache(maxsize=None)
+def _daf_yomi_cycle():
+    """Returns ((first day index, masechta, days), ...) for one Daf Yomi cycle, in learning order."""
+    schedule = []
+    day = 0
+    for masechta_name, (_, total_pages) in MasechetDownloader.masechtos_info_static.items():
+        days = (total_pages + 1) // 2
+        if masechta_name == "Meilah":
+            days += DAF_YOMI_EXTRA_MEILAH_DAYS
+        schedule.append((day, masechta_name, days))
+        day += days
+    return tuple(schedule)
+
+
+def daf_yomi(date):
+    """Returns the (masechta, daf) learned on date, computed locally from the cycle start."""
+    cycle = _daf_yomi_cycle()
+    cycle_length = cycle[-1][0] + cycle[-1][2]
+    day = (date - DAF_YOMI_CYCLE_START).days % cycle_length
+    for first_day, masechta_name, days in reversed(cycle):
+        if day >= first_day:
+            return masechta_name, 2 + day - first_day
+
+
+def daf_pages(masechta_name, daf):
+    """Returns the page numbers of a daf that exist for the masechet (none for Kinnim, Tamid and Middos)."""
+    total_pages = masechet_table(masechta_name).total_pages
+    return [p for p in (amud_page(daf, 'a'), amud_page(daf, 'b')) if p <= total_pages]
+
+
+class DafYomiPrefetcher:
+    """Background daemon that keeps the next days' Daf Yomi downloaded and merged on disk.
+    Each daf goes through the usual DownloadJob, ending up as downloads/<masechet>/<masechet>_Daf<n>.pdf
+    next to its amudim, so opening today's daf needs no network.
+    """
+
+    def __init__(self, client, catalog=None, days=PREFETCH_DAYS, interval=PREFETCH_INTERVAL, is_busy=None,
+                 busy_poll=PREFETCH_BUSY_POLL):
+        self.client = client
+        self.catalog = catalog
+        self.days = days
+        self.interval = interval
+        self.is_busy = is_busy # e.g. the GUI's "a user download is running"; prefetching waits for it
+        self.busy_poll = busy_poll
+        self.control = JobControl() # of the current prefetch job
+        self.interrupted = False # the last run_once gave way to a user download
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def run_once(self, today=None):
+        """Prefetches the next self.days dapim. Returns the merged daf files that were created."""
+        today = today or datetime.date.today()
+        created = []
+        self.interrupted = False
+        for offset in range(self.days):
+            # Replaced before the checks, so a stop() or yield_to_user() after them still cancels it
+            self.control = JobControl()
+            if self._stopped.is_set():
+                break
+            if self.is_busy is not None and self.is_busy():
+                self.interrupted = True
+                break
+            masechta_name, daf = daf_yomi(today + datetime.timedelta(days=offset))
+            pages = daf_pages(masechta_name, daf)
+            job = DownloadJob(masechta_name, pages, merge_all=False, merge_amudim=True, keep_individuals=True)
+            daf_filename = os.path.join(job.download_dir, job.table.daf_filename(daf))
+            if not pages or os.path.exists(daf_filename):
+                continue
+            instrumentation = Instrumentation(TRACE_FILE or None)
+            self.client.instrumentation = instrumentation
+            try:
+                job.run(self.client, self.control, ProgressAggregator(), instrumentation, self.catalog)
+            except JobCancelled:
+                self.interrupted = not self._stopped.is_set()
+                break
+            except Exception as e:
+                print(f"[WARN] Daf Yomi prefetch of {masechta_name} {daf} failed: {e}")
+                continue
+            finally:
+                instrumentation.close()
+            if len(job.completed) == len(pages):
+                print(f"[INFO] Prefetched Daf Yomi {masechta_name} {daf}")
+                created.append(daf_filename)
+        return created
+
+    def run_forever(self):
+        """Prefetches now and then every self.interval seconds until stop() is called.
+        A run that gave way to a user download is retried as soon as that download is over."""
+        while not self._stopped.is_set():
+            self.run_once()
+            if not self.interrupted:
+                self._stopped.wait(self.interval)
+                continue
+            while not self._stopped.wait(self.busy_poll) and self.is_busy is not None and self.is_busy():
+                pass
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name='daf-yomi-prefetch', daemon=True)
+        self._thread.start()
+        return self
+
+    def yield_to_user(self):
+        """Cancels the prefetch job in progress, so a user download can have the folder (and the
+        connection) to itself. Prefetching picks up again once is_busy says the user is done."""
+        self.control.cancel()
+
+    def stop(self):
+        self._stopped.set()
+        self.control.cancel()
+
+
+class DiskLRUCache:
+    """Files on disk, evicted least-recently-used first once they exceed max_bytes.
+    Recency survives restarts through file modification times, which are bumped on every hit.
+    Pinned entries are never evicted, so the cache may run over max_bytes while they are in use.
+    """
+
+    def __init__(self, root, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._entries = OrderedDict() # key -> size, least recently used first
+        self._pins = {} # key -> number of pinned() blocks using it
+        self.size = 0
+        os.makedirs(root, exist_ok=True)
+        found = []
+        for folder, _, files in os.walk(root):
+            for name in files:
+                path = os.path.join(folder, name)
+                if name.endswith('.part'):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, os.path.relpath(path, root).replace(os.sep, '/'), stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.size += size
+
+    def path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Bad cache key: {key}")
+        return path
+
+    def get(self, key):
+        """Returns the cached file's path (marking it recently used), or None."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.size -= self._entries.pop(key, 0)
+            return None
+        return path
+
+    def fetch(self, key, fill):
+        """Returns the path of key, calling fill(part_path) to create it on a miss.
+        Concurrent misses for the same key share one fill."""
+        path = self.get(key)
+        METRICS.inc('shas_cache_hits_total' if path else 'shas_cache_misses_total', cache='proxy')
+        if path:
+            return path
+        path, shared = self._flight.do(key, lambda: self._fill(key, fill))
+        if shared:
+            METRICS.inc('shas_coalesced_requests_total', cache='proxy')
+        return path
+
+    def _fill(self, key, fill):
+        path = self.get(key) # filled by a call that finished just before ours started
+        if path:
+            return path
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = path + '.part'
+        try:
+            fill(part_path)
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        with self._lock:
+            self.size += os.path.getsize(path) - self._entries.pop(key, 0)
+            self._entries[key] = os.path.getsize(path)
+            self._evict()
+        return path
+
+    @contextmanager
+    def pinned(self, keys):
+        """Keeps keys (cached now or fetched within the block) from being evicted until the block ends."""
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._pins[key] -= 1
+                    if not self._pins[key]:
+                        del self._pins[key]
+                self._evict()
+
+    def _evict(self):
+        # The newest entry always stays: it was just filled for a caller
+        for key in [key for key in list(self._entries)[:-1] if key not in self._pins]:
+            if self.size <= self.max_bytes:
+                break
+            self.size -= self._entries.pop(key)
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # e.g. open in another process on Windows; it is picked up again on restart
+                print(f"[WARN] Could not evict {key} from the cache: {e}")
+
+
+def format_pages(pages):
+    """Formats page numbers compactly, e.g. [1, 2, 3, 7] -> "1-3,7"."""
+    runs = []
+    for page in sorted(set(pages)):
+        if runs and page == runs[-1][1] + 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return ','.join(str(a) if a == b else f"{a}-{b}" for a, b in runs)
+
+
+def parse_pages(spec, total_pages):
+    """Inverse of format_pages, as a PageSet. Raises ValueError on malformed input or on any
+    page outside 1..total_pages, before building anything, so a huge range costs nothing."""
+    intervals = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        first, last = int(first), int(last or first)
+        if not 1 <= first <= last <= total_pages:
+            raise ValueError(f"pages {part} are not within 1-{total_pages}")
+        intervals.append((first, last))
+    return PageSet.from_intervals(intervals)
+
+
+class _CacheServerHandler(BaseHTTPRequestHandler):
+    """GET /pages/<masechet>/            -> {"files": {filename: md5}}
+       GET /pages/<masechet>/<filename>  -> the amud PDF
+       GET /merged/<masechet>?pages=1-10 -> those pages merged into one PDF
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(p) for p in url.path.strip('/').split('/')]
+        try:
+            if parts[0] == 'pages' and len(parts) == 2:
+                self._send_json({'files': self.server.list_files(parts[1])})
+            elif parts[0] == 'pages' and len(parts) == 3:
+                self._send_file(self.server.page(parts[1], parts[2]))
+            elif parts[0] == 'merged' and len(parts) == 2:
+                query = urllib.parse.parse_qs(url.query)
+                _, total_pages = MasechetDownloader.masechtos_info_static[parts[1]]
+                self._send_file(self.server.merged(parts[1], parse_pages(query['pages'][0], total_pages)))
+            else:
+                self.send_error(404)
+        except FileNotFoundError as e:
+            self.send_error(404, f"Not found: {e}")
+        except (ValueError, KeyError) as e:
+            self.send_error(400, f"Bad request: {e}")
+        except HttpError as e:
+            self.send_error(502, f"Drive error: {e.resp.status}")
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, path):
+        with open(path, 'rb') as f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK_SIZE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CacheServer(ThreadingHTTPServer):
+    """LAN caching server in front of the Drive folder. Only this machine needs the service
+    account; clients fetch amud PDFs and merged ranges from it over HTTP (see ProxyClient).
+    Pages are kept in a DiskLRUCache and simultaneous requests for one file share a single download.
+    """
+    daemon_threads = True
+
+    def __init__(self, client, cache, host='0.0.0.0', port=CACHE_SERVER_PORT):
+        super().__init__((host, port), _CacheServerHandler)
+        self.client = client
+        self.cache = cache
+        self._listings = SingleFlight()
+        self._thread = None
+
+    def list_files(self, masechta_name):
+        """Returns {filename: md5 or None} for the masechet, listing Drive at most once per process."""
+        if masechta_name not in MasechetDownloader.masechtos_info_static:
+            raise FileNotFoundError(masechta_name)
+        if masechta_name not in self.client.file_ids:
+            self._listings.do(masechta_name, lambda: self.client.list_masechta_files(masechta_name))
+        return {name: self.client.file_md5s.get(file_id) for name, file_id in self.client.file_ids[masechta_name].items()}
+
+    @staticmethod
+    def page_key(masechta_name, filename):
+        return f"{masechta_name}/{filename}"
+
+    def page(self, masechta_name, filename):
+        """An amud PDF, or the masechet's bundle (see bundle_names), from the cache."""
+        if os.path.basename(filename) != filename or \
+                not (filename.endswith('.pdf') or filename in bundle_names(masechta_name)):
+            raise ValueError(filename)
+        self.list_files(masechta_name)
+        return self.cache.fetch(self.page_key(masechta_name, filename),
+                                lambda part_path: self.client.download(masechta_name, filename, part_path))
+
+    def merged(self, masechta_name, pages):
+        _, total_pages = MasechetDownloader.masechtos_info_static.get(masechta_name, (None, 0))
+        pages = PageSet(pages)
+        if not pages or pages.first() < 1 or pages.last() > total_pages:
+            raise ValueError("pages out of range")
+        paths = []
+        filenames = masechet_table(masechta_name).filenames
+        # A range bigger than the cache would otherwise evict its first pages before the merge reads them
+        with self.cache.pinned(self.page_key(masechta_name, filenames[page_num]) for page_num in pages):
+            for page_num in pages:
+                try:
+                    paths.append(self.page(masechta_name, filenames[page_num]))
+                except FileNotFoundError:
+                    print(f"[WARN] {masechta_name} page {page_num} is not on Drive; leaving it out of the merge")
+            return self.cache.fetch(f"merged/{masechta_name}/{format_pages(pages)}.pdf",
+                                    lambda part_path: MasechetDownloader.merge_pdfs(None, paths, part_path))
+
+    def start(self):
+        """Serves in a background daemon thread and returns self."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+class ProxyClient(PageSource):
+    """Downloads pages through a CacheServer instead of from Drive.
+    The server addresses pages by name, so file ids here are filenames.
+    """
+    name = 'cache_server'
+    parallel = True
+
+    def __init__(self, base_url=CACHE_SERVER_URL, timeout=60):
+        super().__init__()
+        self.base_url = base_url.rstrip('/') + '/'
+        self.timeout = timeout
+
+    def _url(self, *parts, query=None):
+        url = self.base_url + '/'.join(urllib.parse.quote(p) for p in parts)
+        return f"{url}?{urllib.parse.urlencode(query)}" if query else url
+
+    def list_masechta_files(self, masechta_name):
+        self.instrumentation.count('api_calls')
+        with self.instrumentation.phase('metadata'), self.instrumentation.in_flight():
+            with urllib.request.urlopen(self._url('pages', masechta_name, ''), timeout=self.timeout) as response:
+                listing = json.load(response)['files']
+        files = self.file_ids.setdefault(masechta_name, {})
+        for name, md5 in listing.items():
+            files[name] = name
+            if md5:
+                self.file_md5s[name] = md5
+        return files
+
+    def download(self, masechta_name, filename, save_path, control=None):
+        """Downloads one amud through the server and returns its {'file_id', 'size', 'md5'}.
+        Raises FileNotFoundError if the server (i.e. Drive) doesn't have it."""
+        info = self._download(self._url('pages', masechta_name, filename), save_path, control)
+        expected = self.file_md5s.get(filename)
+        if expected and expected != info['md5']:
+            os.remove(save_path)
+            raise IOError(f"Checksum mismatch for {filename}")
+        info['file_id'] = filename
+        return info
+
+    def download_merged(self, masechta_name, pages, save_path, control=None):
+        """Has the server merge the pages and downloads the result."""
+        return self._download(self._url('merged', masechta_name, query={'pages': format_pages(pages)}), save_path, control)
+
+    def _download(self, url, save_path, control):
+        return _http_download(url, save_path, control, self.instrumentation, self.timeout)
+
+
+class PagefeedSource(PageSource):
+    """Fetches amudim from HebrewBooks' per-page PDF feed, the source the original downloader used.
+    It can't list or checksum ahead of time; a response that isn't a PDF counts as a failure.
+    """
+    name = 'hebrewbooks'
+    parallel = True
+    FILENAME = re.compile(r'_Daf(\d+)_Amud([ab])\.pdf$')
+
+    def __init__(self, url_template=PAGEFEED_URL, timeout=30):
+        super().__init__()
+        self.url_template = url_template
+        self.timeout = timeout
+
+    def download(self, masechta_name, filename, save_path, control=None):
+        match = self.FILENAME.search(filename)
+        if masechta_name not in MasechetDownloader.masechtos_info_static or not match:
+            raise FileNotFoundError(filename)
+        masechta_id, _ = MasechetDownloader.masechtos_info_static[masechta_name]
+        try:
+            page = masechet_table(masechta_name).page(f"{int(match.group(1))}{match.group(2)}")
+        except ValueError:
+            raise FileNotFoundError(filename) from None
+        info = _http_download(self.url_template.format(id=masechta_id, page=page), save_path, control,
+                              self.instrumentation, self.timeout)
+        with open(save_path, 'rb') as f:
+            if f.read(5) != b'%PDF-':
+                os.remove(save_path)
+                raise IOError(f"HebrewBooks returned something other than a PDF for {filename}")
+        info['file_id'] = f"hebrewbooks:{masechta_id}_{page}"
+        return info
+
+
+class SourceHealth:
+    """Recent track record of one page source. Consecutive failures take it out of rotation
+    for an exponentially growing cooldown; a success puts it straight back."""
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.down_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.down_until = 0.0
+        METRICS.inc('shas_source_pages_total', source=self.name, result='ok')
+        METRICS.set_gauge('shas_source_up', 1, source=self.name)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            cooldown = min(SOURCE_COOLDOWN_MAX, SOURCE_COOLDOWN * 2 ** (self.failures - 1))
+            self.down_until = time.monotonic() + cooldown
+        METRICS.inc('shas_source_pages_total', source=self.name, result='failed')
+        METRICS.set_gauge('shas_source_up', 0, source=self.name)
+        print(f"[WARN] Page source {self.name} is failing; using other sources for {cooldown:.0f}s")
+
+
+class FailoverSource(PageSource):
+    """Tries page sources in order of preference, skipping ones that are cooling down after
+    failures (throttling, server errors, bad data). Listings and checksums come from the
+    first source, which is normally Drive.
+    """
+    name = 'failover'
+
+    def __init__(self, sources):
+        self.sources = list(sources)
+        self.health = {source.name: SourceHealth(source.name) for source in self.sources}
+
+    @property
+    def parallel(self):
+        return all(source.parallel for source in self.sources)
+
+    @property
+    def file_ids(self):
+        return self.sources[0].file_ids
+
+    @property
+    def file_md5s(self):
+        return self.sources[0].file_md5s
+
+    @property
+    def instrumentation(self):
+        return self.sources[0].instrumentation
+
+    def open_range(self, masechta_name, filename):
+        primary = self.sources[0]
+        return primary.open_range(masechta_name, filename) if self.health[primary.name].available else None
+
+    @instrumentation.setter
+    def instrumentation(self, instrumentation):
+        for source in self.sources:
+            source.instrumentation = instrumentation
+
+    def _ordered(self):
+        """Healthy sources in preference order, then the rest by how soon they recover."""
+        healthy = [s for s in self.sources if self.health[s.name].available]
+        cooling = sorted((s for s in self.sources if s not in healthy), key=lambda s: self.health[s.name].down_until)
+        return healthy + cooling
+
+    def list_masechta_files(self, masechta_name):
+        primary = self.sources[0]
+        if self.health[primary.name].available:
+            try:
+                return primary.list_masechta_files(masechta_name)
+            except (HttpError, urllib.error.URLError, ConnectionError, TimeoutError) as e:
+                print(f"[WARN] Could not list {masechta_name} from {primary.name}: {e}")
+                self.health[primary.name].record_failure()
+        return self.file_ids.setdefault(masechta_name, {})
+
+    def download(self, masechta_name, filename, save_path, control=None):
+        not_found = None
+        for source in self._ordered():
+            try:
+                info = source.download(masechta_name, filename, save_path, control)
+            except JobCancelled:
+                raise
+            except FileNotFoundError as e:
+                not_found = e
+                continue
+            except (HttpError, urllib.error.URLError, ConnectionError, TimeoutError, OSError) as e:
+                if is_client_error(e):
+                    raise # a bad request; the source itself is fine and another may serve a different scan
+                print(f"[WARN] {source.name} failed for {filename}: {e}")
+                self.health[source.name].record_failure()
+                continue
+            self.health[source.name].record_success()
+            self.instrumentation.count(f'pages_from_{source.name}')
+            return info
+        if not_found is not None:
+            raise not_found
+        raise IOError(f"No page source could provide {filename}")
+
+
+def is_client_error(error):
+    """True for an HTTP 4xx that another attempt or source won't fix: the request itself was
+    wrong. Throttling (429, and Drive's 403 rate limits) and timeouts (408) don't count."""
+    if isinstance(error, urllib.error.HTTPError):
+        status = error.code
+    elif isinstance(error, HttpError):
+        status = error.resp.status
+    else:
+        return False
+    return 400 <= status < 500 and status not in (403, 408, 429)
+
+
+def make_drive_client(service_factory, service=None):
+    """A DriveClient with a Drive service per thread and hedging based on the shared latency history."""
+    return DriveClient(service or service_factory(), service_factory=service_factory, latency=LatencyTracker.shared())
+
+
+def with_fallback(primary):
+    """Puts the HebrewBooks page feed behind primary, unless SHAS_PAGEFEED_FALLBACK=0.
+    Drive then gives up after FAILOVER_RETRIES so a throttled page moves to the fallback quickly."""
+    if not PAGEFEED_FALLBACK:
+        return primary
+    if isinstance(primary, DriveClient):
+        primary.max_retries = min(primary.max_retries, FAILOVER_RETRIES)
+    return FailoverSource([primary, PagefeedSource()])
+
+
+def run_cache_server(port, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """--serve mode: runs the LAN caching server until interrupted."""
+    try:
+        factory = drive_service_factory()
+    except FileNotFoundError:
+        print(f"[ERROR] Service account key file not found: '{SERVICE_ACCOUNT_FILE}'")
+        sys.exit(1)
+    client = with_fallback(make_drive_client(factory))
+    server = CacheServer(client, DiskLRUCache(cache_dir, max_bytes), port=port)
+    print(f"[INFO] Serving Shas pages on port {server.server_address[1]} (cache: {cache_dir}, "
+          f"{max_bytes // (1024 * 1024)} MB). Clients set SHAS_CACHE_SERVER=http://<this machine>:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class VirtualListbox(ttk.Frame):
+    """A multiple-selection list that only creates Tk rows for the visible window.
+    Items, selection and highlighting live in Python, so swapping in a new item list
+    costs the same for a 25-amud masechet as for a 350-amud one.
+    Offers the subset of the tk.Listbox API the app uses (curselection, get, size).
+    """
+
+    def __init__(self, master, height=8, highlight_color=AVAILABLE_COLOR, **kwargs):
+        super().__init__(master, **kwargs)
+        self.items = ()
+        self.selected = set()
+        self.highlighted = frozenset()
+        self.highlight_color = highlight_color
+        self.top = 0
+        self.visible_rows = height
+        self.listbox = tk.Listbox(self, height=height, selectmode="multiple", exportselection=False, activestyle="none")
+        self.listbox.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self._on_scroll)
+        self.scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self._line_height = tkfont.Font(font=self.listbox['font']).metrics('linespace') + 1
+        self.listbox.bind("<<ListboxSelect>>", self._on_select)
+        self.listbox.bind("<Configure>", self._on_resize)
+        self.listbox.bind("<MouseWheel>", lambda e: self._scroll_by(-1 if e.delta > 0 else 1))
+        self.listbox.bind("<Button-4>", lambda e: self._scroll_by(-1))
+        self.listbox.bind("<Button-5>", lambda e: self._scroll_by(1))
+
+    # --- Listbox-compatible API ---
+    def curselection(self):
+        return tuple(sorted(self.selected))
+
+    def get(self, index):
+        return self.items[index]
+
+    def size(self):
+        return len(self.items)
+
+    def set_items(self, items):
+        """Replaces the items (a precomputed tuple) and clears the selection."""
+        self.items = items
+        self.selected = set()
+        self.highlighted = frozenset()
+        self.top = 0
+        self._render()
+
+    def set_highlighted(self, indices):
+        self.highlighted = frozenset(indices)
+        self._render()
+
+    # --- Rendering ---
+    def _render(self):
+        self.listbox.delete(0, tk.END)
+        window = self.items[self.top:self.top + self.visible_rows]
+        if window:
+            self.listbox.insert(0, *window)
+        for row in range(len(window)):
+            index = self.top + row
+            if index in self.selected:
+                self.listbox.selection_set(row)
+            if index in self.highlighted:
+                self.listbox.itemconfig(row, foreground=self.highlight_color)
+        if self.items:
+            self.scrollbar.set(self.top / len(self.items), min(1.0, (self.top + self.visible_rows) / len(self.items)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def _max_top(self):
+        return max(0, len(self.items) - self.visible_rows)
+
+    def _scroll_by(self, rows):
+        new_top = min(max(0, self.top + rows), self._max_top())
+        if new_top != self.top:
+            self.top = new_top
+            self._render()
+        return "break" # Keep the inner listbox from scrolling itself
+
+    def _on_scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            self.top = min(max(0, int(float(amount) * len(self.items))), self._max_top())
+            self._render()
+        elif action == "scroll":
+            step = self.visible_rows if unit == "pages" else 1
+            self._scroll_by(int(amount) * step)
+
+    def _on_resize(self, event):
+        rows = max(1, event.height // self._line_height)
+        if rows != self.visible_rows:
+            self.visible_rows = rows
+            self.top = min(self.top, self._max_top())
+            self._render()
+
+    def _on_select(self, event=None):
+        shown = range(self.top, min(self.top + self.visible_rows, len(self.items)))
+        self.selected.difference_update(shown)
+        self.selected.update(self.top + row for row in self.listbox.curselection())
+
+
+class ProgressAggregator:
+    """Collects progress events from worker threads; the UI reads a snapshot at a fixed frame rate.
+    Workers never touch Tk, and the UI cost per frame is the same however fast pages finish.
+    This is also the reporter a DownloadJob talks to (set_status, start, page_started, ...).
+    """
+    THROUGHPUT_WINDOW = 5.0 # seconds of history used for the rolling rates and ETA
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start(0)
+        self.status = "Ready."
+
+    def start(self, total, done=0):
+        """Begins a new progress run of total pages, done of which are already complete."""
+        with self._lock:
+            self.total = total
+            self.done = done
+            self.failed = 0
+            self.in_flight = 0
+            self.started_at = time.monotonic()
+            self._recent = deque() # (finish time, bytes) of recently finished pages
+
+    def set_status(self, text):
+        with self._lock:
+            self.status = text
+
+    def set_progress(self, value, maximum=None):
+        with self._lock:
+            self.done = value
+            if maximum is not None:
+                self.total = maximum
+
+    def page_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def page_finished(self, nbytes=0, ok=True):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.done += 1
+            if not ok:
+                self.failed += 1
+            self._recent.append((now, nbytes))
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._recent and self._recent[0][0] < now - self.THROUGHPUT_WINDOW:
+            self._recent.popleft()
+
+    def snapshot(self):
+        """Returns (done, total, status, stats_text) for the UI to paint."""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            window = min(self.THROUGHPUT_WINDOW, max(now - self.started_at, 1e-6))
+            pages_per_sec = len(self._recent) / window
+            mb_per_sec = sum(b for _, b in self._recent) / window / (1024 * 1024)
+            done, total, failed, in_flight, status = self.done, self.total, self.failed, self.in_flight, self.status
+        parts = []
+        if total:
+            parts.append(f"{done}/{total} pages")
+        if pages_per_sec:
+            remaining = max(0, total - done)
+            eta = int(remaining / pages_per_sec)
+            parts.append(f"{pages_per_sec:.1f} pages/s, {mb_per_sec:.2f} MB/s")
+            parts.append(f"ETA {eta // 60}:{eta % 60:02d}")
+        if in_flight:
+            parts.append(f"{in_flight} in flight")
+        if failed:
+            parts.append(f"{failed} failed")
+        return done, total, status, " | ".join(parts)
+
+
+# Image encodings that are kept as they are, and why. Bilevel scans are already far smaller
+# than a JPEG of them would be.
+KEPT_IMAGE_FILTERS = {
+    '/CCITTFaxDecode': "bilevel (fax) scan",
+    '/JBIG2Decode': "bilevel (JBIG2) scan",
+    '/JPXDecode': "JPEG 2000, which Pillow may not read",
+}
+
+
+def _image_mode(image):
+    """Returns (the Pillow mode to recompress image in, None), or (None, why it is kept as it is)."""
+    if image.get('/Subtype') != '/Image':
+        return None, "not an image"
+    if image.get('/ImageMask') or image.get('/BitsPerComponent') != 8:
+        return None, "not 8 bits per component (bilevel or mask)"
+    if '/SMask' in image or '/Mask' in image:
+        return None, "has transparency"
+    filters = image.get('/Filter')
+    filters = [] if filters is None else [filters] if isinstance(filters, str) else list(filters)
+    for name in filters:
+        if name in KEPT_IMAGE_FILTERS:
+            return None, KEPT_IMAGE_FILTERS[name]
+    if filters not in ([], ['/FlateDecode'], ['/DCTDecode']):
+        return None, f"filters {' '.join(filters)}"
+    color_space = image.get('/ColorSpace')
+    color_space = color_space.get_object() if color_space is not None else None
+    if isinstance(color_space, list) and color_space and color_space[0] == '/ICCBased':
+        # An ICC profile with 1 or 3 components is close enough to grey or RGB for a JPEG
+        color_space = {1: '/DeviceGray', 3: '/DeviceRGB'}.get(color_space[1].get_object().get('/N'), color_space)
+    if color_space == '/DeviceRGB':
+        return 'RGB', None
+    if color_space == '/DeviceGray':
+        return 'L', None
+    return None, "colour space is not grey or RGB (e.g. palette or CMYK)"
+
+
+def _recompress_images(page, max_dpi, quality):
+    """Downsamples the page's 8-bit RGB/grey images to max_dpi (assuming they span the page width)
+    and re-encodes them as JPEG. Other images are left alone (see _image_mode)."""
+    resources = page.get('/Resources')
+    xobjects = resources.get_object().get('/XObject') if resources is not None else None
+    if xobjects is None:
+        return
+    page_inches = float(page.mediabox.width) / 72
+    for name in list(xobjects.get_object()):
+        image = xobjects.get_object()[name].get_object()
+        mode, _ = _image_mode(image)
+        if mode is None:
+            continue
+        width, height = image['/Width'], image['/Height']
+        scale = min(1.0, max_dpi * page_inches / width)
+        is_jpeg = image.get('/Filter') in ('/DCTDecode', ['/DCTDecode'])
+        if is_jpeg and scale == 1.0:
+            continue
+        if is_jpeg:
+            picture = Image.open(io.BytesIO(image._data)).convert(mode)
+        else:
+            picture = Image.frombytes(mode, (width, height), image.get_data())
+        if scale < 1.0:
+            picture = picture.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+        buffer = io.BytesIO()
+        picture.save(buffer, 'JPEG', quality=quality, optimize=True)
+        if scale == 1.0 and buffer.tell() >= len(image._data):
+            continue
+        image._data = buffer.getvalue()
+        image.pop('/DecodeParms', None)
+        image[NameObject('/Filter')] = NameObject('/DCTDecode')
+        image[NameObject('/ColorSpace')] = NameObject('/DeviceRGB' if mode == 'RGB' else '/DeviceGray')
+        image[NameObject('/Width')] = NumberObject(picture.width)
+        image[NameObject('/Height')] = NumberObject(picture.height)
+
+
+def _compress_pdf(source, destination, profile):
+    """Worker process body: writes source to destination with its content streams deflated and,
+    if the profile has image settings and Pillow is installed, its images recompressed."""
+    settings = PDF_PROFILES[profile]
+    writer = PdfWriter()
+    for page in PdfReader(source).pages:
+        page = writer.add_page(page)
+        if settings and Image is not None:
+            _recompress_images(page, *settings)
+        page.compress_content_streams()
+    with open(destination, 'wb') as f:
+        writer.write(f)
+
+
+@functools.lru_cache(maxsize=None)
+def _pdf_pool():
+    # Spawned, not forked: forking a process that runs Tk and download threads can deadlock the child
+    return concurrent.futures.ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_without_pillow():
+    print("[WARN] Pillow is not installed, so page images are not recompressed (pip install Pillow).")
+
+
+def compress_pdfs(pdf_files, profile, out_dir):
+    """Writes a copy of each PDF recompressed for profile into out_dir, one file per worker
+    process at a time, and returns the copies' paths. A file that can't be recompressed is
+    returned as it was."""
+    if PDF_PROFILES[profile] and Image is None:
+        _warn_without_pillow()
+    outputs = [os.path.join(out_dir, f"{index}.pdf") for index in range(len(pdf_files))]
+    try:
+        futures = [_pdf_pool().submit(_compress_pdf, source, output, profile)
+                   for source, output in zip(pdf_files, outputs)]
+    except concurrent.futures.BrokenExecutor:
+        _pdf_pool.cache_clear()
+        raise
+    results = []
+    for source, output, future in zip(pdf_files, outputs, futures):
+        try:
+            future.result()
+            results.append(output)
+        except Exception as e:
+            if isinstance(e, concurrent.futures.BrokenExecutor):
+                _pdf_pool.cache_clear()
+            print(f"[WARN] Could not recompress {os.path.basename(source)}, using it as it is: {e}")
+            results.append(source)
+    return results
+
+
+def _page_form(writer, page):
+    """Wraps page as a form XObject in writer, so it can be drawn anywhere on another page
+    without re-rendering it. The page's resources come along with it."""
+    contents = page.get('/Contents')
+    contents = contents.get_object() if contents is not None else None
+    if isinstance(contents, StreamObject):
+        # A single content stream is copied still encoded, as scanned pages usually have
+        form = StreamObject()
+        form._data = contents._data
+        for key in ('/Filter', '/DecodeParms'):
+            if key in contents:
+                form[NameObject(key)] = contents[key].clone(writer)
+    else:
+        form = DecodedStreamObject()
+        form.set_data(page.get_contents().get_data() if contents is not None else b'')
+        form = form.flate_encode()
+    form[NameObject('/Type')] = NameObject('/XObject')
+    form[NameObject('/Subtype')] = NameObject('/Form')
+    form[NameObject('/BBox')] = ArrayObject(FloatObject(v) for v in page.mediabox)
+    form[NameObject('/Resources')] = page['/Resources'].clone(writer) if '/Resources' in page else DictionaryObject()
+    return writer._add_object(form)
+
+
+def _impose_spread(amud_a, amud_b, destination, profile):
+    """Worker process body: writes a one-page PDF with amud_b on the left and amud_a on the right.
+    Either may be None (a daf with only one amud selected); its half of the page is left blank."""
+    settings = PDF_PROFILES[profile]
+    pages = [PdfReader(path).pages[0] if path else None for path in (amud_b, amud_a)]
+    if settings:
+        for page in filter(None, pages):
+            if Image is not None:
+                _recompress_images(page, *settings)
+            page.compress_content_streams()
+    present = next(page for page in pages if page is not None)
+    widths = [float((page or present).mediabox.width) for page in pages]
+    height = max(float(page.mediabox.height) for page in pages if page is not None)
+
+    writer = PdfWriter()
+    spread = PageObject.create_blank_page(None, sum(widths), height)
+    xobjects = DictionaryObject()
+    drawing = []
+    x = 0.0
+    for name, page, width in zip(('/AmudB', '/AmudA'), pages, widths):
+        if page is not None:
+            xobjects[NameObject(name)] = _page_form(writer, page)
+            left, bottom = float(page.mediabox.left), float(page.mediabox.bottom)
+            drawing.append(f"q 1 0 0 1 {x - left:g} {-bottom:g} cm {name} Do Q")
+        x += width
+    content = DecodedStreamObject()
+    content.set_data('\n'.join(drawing).encode('ascii'))
+    spread[NameObject('/Contents')] = writer._add_object(content)
+    spread[NameObject('/Resources')] = DictionaryObject({NameObject('/XObject'): xobjects})
+    writer.add_page(spread)
+    part = destination + '.part'
+    with open(part, 'wb') as f:
+        writer.write(f)
+    os.replace(part, destination)
+
+
+def open_path(path):
+    """Opens a file or folder with the system's default application."""
+    if platform.system() == "Windows":
+        os.startfile(path)
+    elif platform.system() == "Darwin":
+        subprocess.Popen(["open", path])
+    else:
+        subprocess.Popen(["xdg-open", path])
+
+
 class MasechetDownloader:
 
     # --- Static Class Data and Methods ---
@@ -110,38 +3339,69 @@ class MasechetDownloader:
 
         return daf, amud
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def selection_labels(masechta_name, select_type):
+        """Returns the (cached) tuple of list labels for a masechet: "2", "3", ... for Dapim
+        or "2a", "2b", ... for Amudim."""
+        table = masechet_table(masechta_name)
+        return table.daf_labels if select_type == "Dapim" else table.labels[1:]
+
     def __init__(self, root):
         self.root = root
         self.root.title("Masechet Downloader (Google Drive Edition)")
         self.root.geometry("550x600")
 
-        self.drive_service = self.authenticate_google_drive()
-        if not self.drive_service:
-            self.root.destroy()
-            return
-
-        self.masechta_folder_ids = {}
+        self.service_factory = None
+        if CACHE_SERVER_URL:
+            # The caching server holds the credentials; this machine never talks to Drive
+            print(f"[INFO] Downloading through the cache server at {CACHE_SERVER_URL}")
+            self.drive_service = None
+            self.drive_client = with_fallback(ProxyClient(CACHE_SERVER_URL))
+        else:
+            self.drive_service = self.authenticate_google_drive()
+            if not self.drive_service:
+                self.root.destroy()
+                return
+            self.drive_client = with_fallback(make_drive_client(self.service_factory, self.drive_service))
+        self.instrumentation = self.drive_client.instrumentation
+        self.catalog = PageCatalog.open()
+        self.journal_path = get_app_data_path(JobJournal.FILE)
+        self.job_control = None
+        self.job_thread = None
+        self.queued_jobs = deque() # further masechtos of a typed selection, run one after another
+        self._closing = False
+        self._ui_queue = queue.Queue() # 'finished' notifications from the worker thread
+        self.progress = ProgressAggregator()
+        self._painted = None
+        self.prefetcher = None
+        self.preview_dir = None # temporary folder of "Open when ready" previews
+        if PREFETCH_DAYS:
+            if CACHE_SERVER_URL:
+                prefetch_client = with_fallback(ProxyClient(CACHE_SERVER_URL))
+            else:
+                prefetch_client = with_fallback(make_drive_client(self.service_factory))
+            self.prefetcher = DafYomiPrefetcher(prefetch_client, self.catalog,
+                                                is_busy=lambda: self.job_thread is not None).start()
         self.theme_auto()
         self.create_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(1000 // PROGRESS_FPS, self._repaint)
+        self.root.after(300, self._offer_resume)
 
     def authenticate_google_drive(self):
         """Authenticates with the Google Drive API using a Service Account."""
-
-        if getattr(sys, 'frozen', False):
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-        else:
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-        service_path = os.path.join(base_dir, SERVICE_ACCOUNT_FILE)
-        
-        if not os.path.exists(service_path): #os.path.join(base_dir, SERVICE_ACCOUNT_FILE)): #os.path.abspath(SERVICE_ACCOUNT_FILE)):
-            messagebox.showerror("Authentication Error", f"Service account key file not found: '{SERVICE_ACCOUNT_FILE}'\nPlease follow the setup instructions.")
-            return None
+        if DRIVE_API_ENDPOINT:
+            print(f"[INFO] Using Drive API endpoint {DRIVE_API_ENDPOINT} without authentication.")
         try:
-            creds = service_account.Credentials.from_service_account_file(
-                service_path, scopes=SCOPES)
-            service = build('drive', 'v3', credentials=creds)
-            print("[INFO] Successfully authenticated with Google Drive via Service Account.")
+            self.service_factory = drive_service_factory()
+            service = self.service_factory()
+            if not DRIVE_API_ENDPOINT:
+                print("[INFO] Successfully authenticated with Google Drive via Service Account.")
             return service
+        except FileNotFoundError:
+            messagebox.showerror("Authentication Error", f"Service account key file not found: '{SERVICE_ACCOUNT_FILE}'\nPlease follow the setup instructions.")
+            return None
         except HttpError as error:
             messagebox.showerror("API Error", f'An error occurred building the Drive service: {error}')
             return None
@@ -168,6 +3428,7 @@ class MasechetDownloader:
         self.masechet_combo = ttk.Combobox(masechet_frame, textvariable=self.masechet_var, values=masechtos, state="readonly")
         self.masechet_combo.grid(row=0, column=1, padx=5, pady=5, sticky=(tk.W, tk.E))
         self.masechet_combo.bind("<<ComboboxSelected>>", self.update_ui_for_masechet)
+        ttk.Button(masechet_frame, text="Today's Daf", command=self.select_todays_daf).grid(row=0, column=2, padx=5, pady=5)
 
         # --- Selection Options ---
         options_frame = ttk.LabelFrame(main_frame, text="Download Options")
@@ -179,8 +3440,8 @@ class MasechetDownloader:
         type_frame = ttk.Frame(options_frame)
         type_frame.grid(row=0, column=0, pady=5, sticky=tk.W)
         ttk.Label(type_frame, text="By:").grid(row=0, column=0, padx=5)
-        ttk.Radiobutton(type_frame, text="Dapim", variable=self.select_type_var, value="Dapim", command=self.toggle_selection_widgets).grid(row=0, column=1, padx=5)
-        ttk.Radiobutton(type_frame, text="Amudim", variable=self.select_type_var, value="Amudim", command=self.toggle_selection_widgets).grid(row=0, column=2, padx=5)
+        ttk.Radiobutton(type_frame, text="Dapim", variable=self.select_type_var, value="Dapim", command=self.update_ui_for_masechet).grid(row=0, column=1, padx=5)
+        ttk.Radiobutton(type_frame, text="Amudim", variable=self.select_type_var, value="Amudim", command=self.update_ui_for_masechet).grid(row=0, column=2, padx=5)
 
         # --- Selection Mode ---
         self.selection_mode_var = tk.StringVar(value="Range")
@@ -190,6 +3451,7 @@ class MasechetDownloader:
         ttk.Radiobutton(mode_frame, text="All", variable=self.selection_mode_var, value="All", command=self.toggle_selection_widgets).grid(row=0, column=1, padx=5)
         ttk.Radiobutton(mode_frame, text="Range", variable=self.selection_mode_var, value="Range", command=self.toggle_selection_widgets).grid(row=0, column=2, padx=5)
         ttk.Radiobutton(mode_frame, text="Individual", variable=self.selection_mode_var, value="Individual", command=self.toggle_selection_widgets).grid(row=0, column=3, padx=5)
+        ttk.Radiobutton(mode_frame, text="Typed", variable=self.selection_mode_var, value="Typed", command=self.toggle_selection_widgets).grid(row=0, column=4, padx=5)
 
         # --- Range Frame ---
         self.range_frame = ttk.Frame(options_frame)
@@ -197,22 +3459,30 @@ class MasechetDownloader:
         self.range_start_var = tk.StringVar()
         self.range_end_var = tk.StringVar()
         ttk.Label(self.range_frame, text="From:").grid(row=0, column=0, padx=5)
-        self.range_start_combo = ttk.Combobox(self.range_frame, textvariable=self.range_start_var, width=10)
+        # The value lists are only filled in when a dropdown is opened (see _fill_range_values)
+        self.range_start_combo = ttk.Combobox(self.range_frame, textvariable=self.range_start_var, width=10,
+                                              postcommand=lambda: self._fill_range_values(self.range_start_combo))
         self.range_start_combo.grid(row=0, column=1, padx=5)
         ttk.Label(self.range_frame, text="To:").grid(row=0, column=2, padx=5)
-        self.range_end_combo = ttk.Combobox(self.range_frame, textvariable=self.range_end_var, width=10)
+        self.range_end_combo = ttk.Combobox(self.range_frame, textvariable=self.range_end_var, width=10,
+                                            postcommand=lambda: self._fill_range_values(self.range_end_combo))
         self.range_end_combo.grid(row=0, column=3, padx=5)
 
         # --- Individual Selection Frame ---
         self.individual_frame = ttk.Frame(options_frame)
         self.individual_frame.grid(row=2, column=0, pady=5, sticky=(tk.W, tk.E, tk.N, tk.S))
-        self.individual_listbox = tk.Listbox(self.individual_frame, selectmode="multiple", height=8)
+        self.individual_listbox = VirtualListbox(self.individual_frame, height=8)
         self.individual_listbox.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         self.individual_frame.columnconfigure(0, weight=1)
         self.individual_frame.rowconfigure(0, weight=1)
-        scrollbar = ttk.Scrollbar(self.individual_frame, orient="vertical", command=self.individual_listbox.yview)
-        scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
-        self.individual_listbox.config(yscrollcommand=scrollbar.set)
+
+        # --- Typed Selection Frame ---
+        self.expression_frame = ttk.Frame(options_frame)
+        self.expression_frame.grid(row=2, column=0, pady=5, sticky=(tk.W, tk.E))
+        self.expression_frame.columnconfigure(0, weight=1)
+        self.expression_var = tk.StringVar()
+        ttk.Entry(self.expression_frame, textvariable=self.expression_var).grid(row=0, column=0, padx=5, sticky=(tk.W, tk.E))
+        ttk.Label(self.expression_frame, text="e.g. Brachos 2-10, 15a, 20b-22a; Shabbos all").grid(row=1, column=0, padx=5, sticky=tk.W)
 
         # --- Merge Options ---
         merge_frame = ttk.LabelFrame(main_frame, text="Output Options")
@@ -226,12 +3496,33 @@ class MasechetDownloader:
         self.merge_amudim_check.grid(row=1, column=0, sticky=tk.W, padx=5)
         self.keep_individuals_check = ttk.Checkbutton(merge_frame, text="Keep individual Amud PDFs after merging", variable=self.keep_individuals_var)
         self.keep_individuals_check.grid(row=2, column=0, sticky=tk.W, padx=5)
+        self.spread_var = tk.BooleanVar(value=False)
+        self.spread_check = ttk.Checkbutton(merge_frame, text="Both amudim side by side on one page", variable=self.spread_var)
+        self.spread_check.grid(row=3, column=0, sticky=tk.W, padx=5)
+        self.open_when_ready_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(merge_frame, text="Open the first daf as soon as it is ready",
+                        variable=self.open_when_ready_var).grid(row=4, column=0, sticky=tk.W, padx=5)
+        pin_frame = ttk.Frame(merge_frame)
+        pin_frame.grid(row=5, column=0, sticky=tk.W, padx=5, pady=(0, 5))
+        ttk.Label(pin_frame, text="Download these dapim first:").grid(row=0, column=0)
+        self.pinned_var = tk.StringVar()
+        ttk.Entry(pin_frame, textvariable=self.pinned_var, width=15).grid(row=0, column=1, padx=5)
+        profile_frame = ttk.Frame(merge_frame)
+        profile_frame.grid(row=6, column=0, sticky=tk.W, padx=5, pady=(0, 5))
+        ttk.Label(profile_frame, text="Merged PDF quality:").grid(row=0, column=0)
+        self.profile_var = tk.StringVar(value=PDF_PROFILE)
+        ttk.Combobox(profile_frame, textvariable=self.profile_var, values=list(PDF_PROFILES), state="readonly",
+                     width=10).grid(row=0, column=1, padx=5)
 
         # --- Action Buttons ---
         action_frame = ttk.Frame(main_frame)
         action_frame.grid(row=3, column=0, columnspan=2, sticky=(tk.E), pady=10)
+        self.pause_button = ttk.Button(action_frame, text="Pause", command=self.toggle_pause, state=tk.DISABLED)
+        self.pause_button.grid(row=0, column=1, padx=5)
+        self.cancel_button = ttk.Button(action_frame, text="Cancel", command=self.cancel_download, state=tk.DISABLED)
+        self.cancel_button.grid(row=0, column=2, padx=5)
         self.download_button = ttk.Button(action_frame, text="Start Download", command=self.start_download, state=tk.DISABLED)
-        self.download_button.grid(row=0, column=1, padx=5)
+        self.download_button.grid(row=0, column=3, padx=5)
         ttk.Button(action_frame, text="Open Downloads Folder", command=self.open_output_folder).grid(row=0, column=0, padx=5)
 
         # --- Progress Bar & Status ---
@@ -242,51 +3533,74 @@ class MasechetDownloader:
         self.progress_bar.grid(row=0, column=0, sticky=(tk.W, tk.E))
         self.status_label = ttk.Label(status_frame, text="Ready.")
         self.status_label.grid(row=1, column=0, sticky=tk.W)
+        self.stats_label = ttk.Label(status_frame, text="")
+        self.stats_label.grid(row=2, column=0, sticky=tk.W)
 
         self.toggle_selection_widgets()
         self.toggle_keep_option()
 
     def update_ui_for_masechet(self, event=None):
-        """Update range and individual lists when a masechet is selected."""
+        """Update range and individual lists when a masechet or selection type is chosen.
+        Uses the cached label tuples, so this costs the same for any masechet size."""
         masechta_name = self.masechet_var.get()
         if not masechta_name:
             self.download_button.config(state=tk.DISABLED)
             return
 
+        self.range_start_var.set("")
+        self.range_end_var.set("")
+        self.individual_listbox.set_items(self.selection_labels(masechta_name, self.select_type_var.get()))
+
+        self._mark_available_items()
+        self.download_button.config(state=tk.NORMAL if self.job_thread is None else tk.DISABLED)
+
+    def select_todays_daf(self):
+        """Selects today's Daf Yomi as a one-daf range. If it was prefetched, downloading it is a local read."""
+        masechta_name, daf = daf_yomi(datetime.date.today())
+        if not daf_pages(masechta_name, daf):
+            messagebox.showinfo("Today's Daf", f"Today's daf ({masechta_name} {daf}: Kinnim, Tamid or Middos) is not available for download.")
+            return
+        self.masechet_var.set(masechta_name)
+        self.select_type_var.set("Dapim")
+        self.update_ui_for_masechet()
+        self.selection_mode_var.set("Range")
+        self.toggle_selection_widgets()
+        self.range_start_var.set(str(daf))
+        self.range_end_var.set(str(daf))
+
+    def _fill_range_values(self, combo):
+        """Gives a range dropdown the labels for the current masechet just before it opens."""
+        masechta_name = self.masechet_var.get()
+        combo['values'] = self.selection_labels(masechta_name, self.select_type_var.get()) if masechta_name else ()
+
+    def _mark_available_items(self):
+        """Highlights the Individual-list entries whose pages are already on disk (per the page catalog)."""
+        masechta_name = self.masechet_var.get()
+        if not masechta_name:
+            return
+        self.catalog.ensure_reconciled(masechta_name, os.path.join(DOWNLOADS_DIR, masechta_name))
+        present = self.catalog.present_pages(masechta_name)
         _, total_pages = self.masechtos_info_static[masechta_name]
-        max_daf = (total_pages + 1) // 2
-
-        # Populate Dapim options
-        daf_options = list(range(2, max_daf + 1))
-        # Populate Amudim options
-        amud_options = []
-        for p in range(1, total_pages + 1):
-            daf, amud = self.daf_amud_calculator(p)
-            amud_options.append(f"{daf}{amud}")
-
-        select_type = self.select_type_var.get()
-        if select_type == "Dapim":
-            self.range_start_combo['values'] = daf_options
-            self.range_end_combo['values'] = daf_options
-            self.individual_listbox.delete(0, tk.END)
-            for daf in daf_options:
-                self.individual_listbox.insert(tk.END, daf)
-        else: # Amudim
-            self.range_start_combo['values'] = amud_options
-            self.range_end_combo['values'] = amud_options
-            self.individual_listbox.delete(0, tk.END)
-            for amud in amud_options:
-                self.individual_listbox.insert(tk.END, amud)
-
-        self.download_button.config(state=tk.NORMAL)
+        if self.select_type_var.get() == "Dapim":
+            # Both amudim of the daf (or just amud a for a final daf without amud b)
+            available = [index for index in range(self.individual_listbox.size())
+                         if 2 * index + 1 in present and (2 * index + 2 in present or 2 * index + 2 > total_pages)]
+        else:
+            available = [page - 1 for page in present]
+        self.individual_listbox.set_highlighted(available)
 
     def toggle_selection_widgets(self, event=None):
-        """Show/hide widgets based on selection mode."""
+        """Show/hide widgets based on selection mode. The lists themselves are left alone."""
         mode = self.selection_mode_var.get()
         self.range_frame.grid_remove()
         self.individual_frame.grid_remove()
+        self.expression_frame.grid_remove()
+        if self.job_thread is None:
+            self.download_button.config(state=tk.NORMAL if mode == "Typed" or self.masechet_var.get() else tk.DISABLED)
 
-        if mode == "Range":
+        if mode == "Typed":
+            self.expression_frame.grid()
+        elif mode == "Range":
             self.range_frame.grid()
             if self.range_end_var:
                 self.range_end_var.set("")
@@ -295,73 +3609,81 @@ class MasechetDownloader:
         elif mode == "Individual":
             self.individual_frame.grid()
 
-        self.update_ui_for_masechet() # Refresh lists
-
     def toggle_keep_option(self):
-        """Enable/disable the 'keep individuals' checkbox."""
+        """Enable/disable the checkboxes that only apply when merging amudim into dapim."""
         if self.merge_amudim_var.get():
             self.keep_individuals_check.config(state=tk.NORMAL)
+            self.spread_check.config(state=tk.NORMAL)
         else:
             self.keep_individuals_check.config(state=tk.DISABLED)
             self.keep_individuals_var.set(False)
+            self.spread_check.config(state=tk.DISABLED)
+            self.spread_var.set(False)
 
-    def _calculate_pages_to_download(self):
+    @staticmethod
+    def calculate_pages(masechta_name, selection_mode, select_type, range_start="", range_end="", individual_items=()):
         """
-        Determines the set of page numbers to download based on user selection.
+        Determines the PageSet for a selection. Has no UI dependencies.
+        individual_items are the listbox strings ("5" for Dapim, "5a" for Amudim).
+        Raises ValueError if the selection is incomplete.
         """
-        pages = set()
-        masechta_name = self.masechet_var.get()
-        masechta_info = self.masechtos_info_static.get(masechta_name)
+        pages = PageSet()
+        masechta_info = MasechetDownloader.masechtos_info_static.get(masechta_name)
         if not masechta_info:
-            return set()
+            return pages
 
         _, total_pages = masechta_info
-        selection_mode = self.selection_mode_var.get()
-        select_type = self.select_type_var.get()
+        table = masechet_table(masechta_name)
 
         if selection_mode == "All":
-            pages.update(range(1, total_pages + 1))
+            pages = PageSet.from_intervals([(1, total_pages)])
 
         elif selection_mode == "Range":
-            start_val = self.range_start_var.get()
-            end_val = self.range_end_var.get()
-            if not start_val or not end_val:
-                messagebox.showerror("Input Error", "Please select a start and end for the range.")
-                return set()
+            if not range_start or not range_end:
+                raise ValueError("Please select a start and end for the range.")
 
             if select_type == "Dapim":
-                start_daf, end_daf = int(start_val), int(end_val)
-                for daf in range(start_daf, end_daf + 1):
-                    pages.add(2 * (daf - 2) + 1)
-                    pages.add(2 * (daf - 2) + 2)
+                start_daf, end_daf = int(range_start), int(range_end)
+                pages = PageSet.from_intervals([(amud_page(start_daf, 'a'), amud_page(end_daf, 'b'))])
             else:  # Amudim
-                start_page = [f"{d}{a}" for p in range(1, total_pages+1) for d,a in [self.daf_amud_calculator(p)]].index(start_val) + 1
-                end_page = [f"{d}{a}" for p in range(1, total_pages+1) for d,a in [self.daf_amud_calculator(p)]].index(end_val) + 1
-                for p in range(start_page, end_page + 1):
-                    pages.add(p)
+                start_page, end_page = table.page(range_start), table.page(range_end)
+                pages = PageSet.from_intervals([(start_page, end_page)])
 
         elif selection_mode == "Individual":
-            selected_indices = self.individual_listbox.curselection()
-            if not selected_indices:
-                messagebox.showerror("Input Error", "Please select individual items from the list.")
-                return set()
+            if not individual_items:
+                raise ValueError("Please select individual items from the list.")
 
             if select_type == "Dapim":
-                for i in selected_indices:
-                    daf = int(self.individual_listbox.get(i))
-                    pages.add(2 * (daf - 2) + 1)
-                    pages.add(2 * (daf - 2) + 2)
+                for item in individual_items:
+                    daf = int(item)
+                    pages.add(amud_page(daf, 'a'))
+                    pages.add(amud_page(daf, 'b'))
             else:  # Amudim
-                for i in selected_indices:
-                    amud_str = self.individual_listbox.get(i)
-                    page = [f"{d}{a}" for p in range(1, total_pages+1) for d,a in [self.daf_amud_calculator(p)]].index(amud_str) + 1
-                    pages.add(page)
+                for amud_str in individual_items:
+                    pages.add(table.page(amud_str))
 
         # Final validation to ensure no pages are out of bounds
-        return {p for p in pages if 1 <= p <= total_pages}
+        return pages & PageSet.from_intervals([(1, total_pages)])
+
+    def _calculate_pages_to_download(self):
+        """
+        Determines the set of page numbers to download based on user selection, and whether
+        the selection is big enough to fetch the masechet's bundle instead of each amud.
+        """
+        individual_items = [str(self.individual_listbox.get(i)) for i in self.individual_listbox.curselection()]
+        try:
+            pages = self.calculate_pages(self.masechet_var.get(), self.selection_mode_var.get(), self.select_type_var.get(),
+                                         self.range_start_var.get(), self.range_end_var.get(), individual_items)
+        except ValueError as e:
+            messagebox.showerror("Input Error", str(e))
+            return PageSet(), False
+        return pages, bool(pages) and wants_bundle(self.masechet_var.get(), pages)
 
     def start_download(self):
-        """Main logic to orchestrate the download and merge process."""
+        """Plans the download from the current selection and starts it in the background."""
+        if self.selection_mode_var.get() == "Typed":
+            self._start_typed_selection()
+            return
         masechta_name = self.masechet_var.get()
         if not masechta_name:
             messagebox.showerror("Error", "Please select a Masechet.")
@@ -371,205 +3693,371 @@ class MasechetDownloader:
             messagebox.showerror("Setup Error", "Please set the 'DRIVE_FOLDER_ID' variable in the script.")
             return
 
-        download_dir = os.path.join(DOWNLOADS_DIR, masechta_name)
-        os.makedirs(download_dir, exist_ok=True)
-
         self.status_label.config(text=f"Calculating pages for {masechta_name}...")
         self.root.update_idletasks()
 
-        valid_pages = self._calculate_pages_to_download()
+        valid_pages, use_bundle = self._calculate_pages_to_download()
 
         if not valid_pages:
             self.status_label.config(text="No valid pages selected.")
             return
 
-        self.status_label.config(text=f"Found {len(valid_pages)} pages to download.")
-        self.progress_bar['maximum'] = len(valid_pages)
-        self.progress_bar['value'] = 0
-        self.root.update_idletasks()
-
-        downloaded_files_map = {}
-        files_to_delete_later = set()
-
-        # --- Main Download Loop ---
-        for i, page_num in enumerate(sorted(list(valid_pages))):
-            daf, amud = self.daf_amud_calculator(page_num)
-            if daf is None: continue
-
-            filename = f"{masechta_name}_Daf{daf}_Amud{amud}.pdf"
-            local_path = os.path.join(download_dir, filename)
-
-            self.status_label.config(text=f"Downloading {filename}...")
-            self.root.update_idletasks()
-
-            if not os.path.exists(local_path):
-                success = self.download_from_drive(masechta_name, filename, local_path)
-                if success:
-                    downloaded_files_map[page_num] = local_path
-                else:
-                    self.status_label.config(text=f"Failed to download {filename}. Skipping.")
-                    time.sleep(2)
-            else:
-                downloaded_files_map[page_num] = local_path
-                self.status_label.config(text=f"File already exists: {filename}")
-                time.sleep(0.5)
+        if self.selection_mode_var.get() == "All":
+            suffix = "All"
+        elif self.selection_mode_var.get() == "Range":
+            suffix = f"Range_{self.range_start_var.get()}-{self.range_end_var.get()}"
+        else:
+            suffix = "Individual_Selection"
 
-            self.progress_bar['value'] = i + 1
-            self.root.update_idletasks()
+        try:
+            pinned = [int(daf) for daf in self.pinned_var.get().replace(',', ' ').split()]
+        except ValueError:
+            messagebox.showerror("Input Error", "Dapim to download first must be numbers, e.g. \"5, 12\".")
+            return
 
-        # --- Merging Logic ---
-        self._perform_merging(download_dir, downloaded_files_map, files_to_delete_later)
+        job = DownloadJob(masechta_name, valid_pages, self.merge_all_var.get(), self.merge_amudim_var.get(),
+                          self.keep_individuals_var.get(), suffix, pinned, use_bundle, self.profile_var.get(),
+                          self.daf_layout())
+        self.status_label.config(text=f"Found {len(valid_pages)} pages to download.")
+        self._start_job(job)
 
-        # --- Cleanup ---
-        if not self.keep_individuals_var.get() and self.merge_amudim_var.get():
-            self.clean_up(self, list(files_to_delete_later))
+    def daf_layout(self):
+        return 'spread' if self.spread_var.get() else 'pages'
 
-        self.status_label.config(text=f"Download finished for {masechta_name}. Files are in: {download_dir}")
-        messagebox.showinfo("Complete", f"Download and merge process for {masechta_name} is complete.")
+    def _start_typed_selection(self):
+        """Queues one job per masechet of the typed selection expression and starts the first."""
+        try:
+            plan = parse_selection(self.expression_var.get())
+        except ValueError as e:
+            messagebox.showerror("Input Error", str(e))
+            return
+        self.expression_var.set(format_selection(plan))
+        jobs = selection_jobs(plan, self.merge_all_var.get(), self.merge_amudim_var.get(), self.keep_individuals_var.get(),
+                              self.profile_var.get(), self.daf_layout())
+        self.queued_jobs.extend(jobs[1:])
+        self._start_job(jobs[0])
+
+    def _start_job(self, job):
+        """Runs job on a worker thread; the UI stays responsive and can pause or cancel it."""
+        # A fresh journal starts with the job's full state (and the queue behind it), which also
+        # compacts a resumed one
+        JobJournal.create(self.journal_path, job, self.queued_jobs)
+        self.job_control = JobControl()
+        self.job_control.on_pause = lambda: self._report_saved(job, "Paused.")
+        self.download_button.config(state=tk.DISABLED)
+        self.pause_button.config(state=tk.NORMAL, text="Pause")
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress.start(len(job.pages), done=len(job.completed))
+        if self.open_when_ready_var.get():
+            job.on_prefix_ready = functools.partial(self._open_when_ready, job, [])
+        self.job_thread = threading.Thread(target=self._run_job, args=(job, self.job_control), daemon=True)
+        if self.prefetcher is not None:
+            self.prefetcher.yield_to_user() # after job_thread is set, so it doesn't start another daf
+        self.job_thread.start()
+
+    def _open_when_ready(self, job, opened, paths):
+        """Prefix hook: once the first daf of the selection with a downloaded amud is settled,
+        merges it into a preview PDF and opens it while the rest keeps downloading.
+        Previews go to a temporary folder that is removed when the app closes."""
+        daf_paths = None if opened else job.first_daf_ready()
+        if not daf_paths:
+            return
+        opened.append(True)
+        if self.preview_dir is None:
+            self.preview_dir = tempfile.mkdtemp(prefix='shas_preview_')
+        preview = os.path.join(self.preview_dir, f"{job.masechta_name}_{job.merged_suffix}_Preview.pdf")
+        self.merge_pdfs(None, daf_paths, preview)
+        try:
+            open_path(preview)
+        except Exception as e:
+            print(f"[WARN] Could not open {preview}: {e}")
 
-    def _perform_merging(self, download_dir, downloaded_files_map, files_to_delete_later):
-        """Handles all PDF merging operations based on user preferences."""
-        files_for_final_merge = []
+    def _report_saved(self, job, status):
+        self.set_status(f"{status} Progress saved ({len(job.completed)}/{len(job.pages)} pages).")
 
-        if self.merge_amudim_var.get():
-            self.status_label.config(text="Merging Amudim into Dapim...")
-            self.root.update_idletasks()
-            daf_to_files = {}
-            for page_num, filepath in downloaded_files_map.items():
-                daf, _ = self.daf_amud_calculator(page_num)
-                if daf not in daf_to_files: daf_to_files[daf] = []
-                daf_to_files[daf].append(filepath)
+    def _run_job(self, job, control):
+        """Worker thread body. Talks to the UI only through the ProgressAggregator and the UI queue."""
+        self.instrumentation = Instrumentation(TRACE_FILE or None)
+        self.drive_client.instrumentation = self.instrumentation
+        self.instrumentation.event('run_start', masechet=job.masechta_name, pages=len(job.pages), stage=job.stage)
+        try:
+            job.run(self.drive_client, control, self.progress, self.instrumentation, self.catalog)
+        except JobCancelled:
+            job.journal.close()
+            if self._closing:
+                self._report_saved(job, "Stopped.")
+            else:
+                JobJournal.discard(self.journal_path)
+                self.set_status(f"Download of {job.masechta_name} cancelled.")
+            self._ui_queue.put(('finished', None))
+            return
+        except Exception as e:
+            # Keep the journal so the user can retry from where it stopped
+            job.journal.close()
+            self._report_saved(job, f"[ERROR] {e}.")
+            print(f"[ERROR] Download job failed: {e}")
+            self._ui_queue.put(('finished', None))
+            return
+        finally:
+            self.instrumentation.event('run_end', masechet=job.masechta_name, stage=job.stage)
+            print(f"[INFO] Timing summary for {job.masechta_name}:\n{self.instrumentation.summary_table()}")
+            self.instrumentation.close()
+
+        job.journal.close()
+        if not self.queued_jobs:
+            JobJournal.discard(self.journal_path) # else it holds the queue until the next job replaces it
+        self.set_status(f"Download finished for {job.masechta_name}. Files are in: {job.download_dir}")
+        self._ui_queue.put(('finished', ("Complete", f"Download and merge process for {job.masechta_name} is complete.")))
+
+    def toggle_pause(self):
+        if self.job_control is None:
+            return
+        if self.job_control.paused:
+            self.job_control.resume()
+            self.pause_button.config(text="Pause")
+            self.set_status("Resuming...")
+        else:
+            self.job_control.pause()
+            self.pause_button.config(text="Resume")
+            self.set_status("Pausing after the current step...")
 
-            for daf, paths in sorted(daf_to_files.items()):
-                daf_filename = os.path.join(download_dir, f"{self.masechet_var.get()}_Daf{daf}.pdf")
-                self.merge_pdfs(self, sorted(paths), daf_filename)
-                files_for_final_merge.append(daf_filename)
-                if not self.keep_individuals_var.get():
-                    files_to_delete_later.update(paths)
+    def cancel_download(self):
+        if self.job_control is None:
+            return
+        if messagebox.askyesno("Cancel Download", "Stop the current download? Pages already downloaded are kept."):
+            self.cancel_button.config(state=tk.DISABLED)
+            self.set_status("Cancelling...")
+            self.job_control.cancel()
+
+    def on_close(self):
+        """Stops a running job cleanly (saving it for next time) before closing the window."""
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.preview_dir is not None:
+            shutil.rmtree(self.preview_dir, ignore_errors=True) # a viewer may still hold one open on Windows
+        if self.job_thread is None:
+            self.root.destroy()
+            return
+        self._closing = True
+        self.set_status("Stopping the current download before closing...")
+        self.job_control.cancel()
+        self._wait_for_job_then_close()
+
+    def _wait_for_job_then_close(self):
+        if self.job_thread is not None and self.job_thread.is_alive():
+            self.root.after(100, self._wait_for_job_then_close)
         else:
-            # Sort by page number (dict key) to ensure correct order
-            sorted_items = sorted(downloaded_files_map.items())
-            files_for_final_merge.extend([item[1] for item in sorted_items])
-
-        if self.merge_all_var.get():
-            self.status_label.config(text="Merging selection into a single PDF...")
-            self.root.update_idletasks()
-            if self.selection_mode_var.get() == "All":
-                suffix = "All"
-            elif self.selection_mode_var.get() == "Range":
-                suffix = f"Range_{self.range_start_var.get()}-{self.range_end_var.get()}"
-            else:
-                suffix = "Individual_Selection"
+            self.root.destroy()
 
-            merged_filename = os.path.join(DOWNLOADS_DIR, f"{self.masechet_var.get()}_{suffix}_Full.pdf")
-            self.merge_pdfs(self, files_for_final_merge, merged_filename)
+    def _offer_resume(self):
+        """Offers to continue a job that was paused or interrupted in an earlier session."""
+        job = JobJournal.replay(self.journal_path)
+        queued = JobJournal.replay_queue(self.journal_path)
+        if (job is None and not queued) or self.job_thread is not None:
+            return
+        if job is None:
+            job = queued.pop(0) # the journaled job finished; the rest of the selection did not start
+        more = f"\n{len(queued)} more masechtos are queued after it." if queued else ""
+        if messagebox.askyesno("Resume Download",
+                               f"An unfinished download of {job.masechta_name} was found "
+                               f"({len(job.completed)}/{len(job.pages)} pages, stage: {job.stage}).{more}\n\nResume it?"):
+            self.queued_jobs.extend(queued)
+            self._start_job(job)
+        else:
+            JobJournal.discard(self.journal_path)
 
+    def set_status(self, text):
+        """Thread-safe status update; painted on the next frame."""
+        self.progress.set_status(text)
 
-    def download_from_drive(self, masechta_name, filename, save_path):
-        """Searches for a file on Google Drive and downloads it.
-        It first looks in a subfolder named after the masechta, then falls back to the main folder.
-        """
+    def _repaint(self):
+        """Runs PROGRESS_FPS times a second on the UI thread: paints progress and handles job completion."""
         try:
-            # Check cache for masechta folder ID
-            parent_folder_id = self.masechta_folder_ids.get(masechta_name)
-
-            if parent_folder_id is None:
-                # If not cached, search for the masechta subfolder
-                folder_query = f"name = '{masechta_name}' and '{DRIVE_FOLDER_ID}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-                folder_results = self.drive_service.files().list(q=folder_query, corpora='allDrives', includeItemsFromAllDrives=True, supportsAllDrives=True, fields='files(id)').execute()
-                folder_items = folder_results.get('files', [])
-
-                if folder_items:
-                    parent_folder_id = folder_items[0]['id']
-                    self.masechta_folder_ids[masechta_name] = parent_folder_id
-                else:
-                    # Cache the fact that we should use the root folder
-                    self.masechta_folder_ids[masechta_name] = DRIVE_FOLDER_ID
-                    parent_folder_id = DRIVE_FOLDER_ID
-            
-            # Search for the file in the determined folder (masechta subfolder or root)
-            query = f"name = '{filename}' and '{parent_folder_id}' in parents and trashed = false"
-            results = self.drive_service.files().list(q=query, corpora='allDrives', includeItemsFromAllDrives=True, supportsAllDrives=True, fields='files(id)').execute()
-            items = results.get('files', [])
-
-            # If not found in subfolder, and we were searching a subfolder, try the root folder as a fallback
-            if not items and parent_folder_id != DRIVE_FOLDER_ID:
-                query = f"name = '{filename}' and '{DRIVE_FOLDER_ID}' in parents and trashed = false"
-                results = self.drive_service.files().list(q=query, corpora='allDrives', includeItemsFromAllDrives=True, supportsAllDrives=True, fields='files(id)').execute()
-                items = results.get('files', [])
-
-            if not items:
-                print(f"[WARN] File not found in Drive: {filename}")
-                self.status_label.configure(text=f"File not found in Drive: {filename}")
-                return False
-
-            file_id = items[0]['id']
-            request = self.drive_service.files().get_media(fileId=file_id)
-
-            with io.FileIO(save_path, 'wb') as fh:
-                downloader = MediaIoBaseDownload(fh, request)
-                done = False
-                while not done:
-                    status, done = downloader.next_chunk()
-            return True
-        except HttpError as error:
-            print(f"[ERROR] An HTTP error occurred: {error}")
-            self.status_label.configure(text = f"[ERROR] An HTTP error occurred: {error}")
-            return False
-        except Exception as e:
-            print(f"[ERROR] An unexpected error occurred: {e}")
-            self.status_label.configure(text = f"[ERROR] An unexpected error occurred: {e}")
-            return False
+            while True:
+                kind, payload = self._ui_queue.get_nowait()
+                if kind == 'finished':
+                    self.job_thread = None
+                    self.job_control = None
+                    self.pause_button.config(state=tk.DISABLED, text="Pause")
+                    self.cancel_button.config(state=tk.DISABLED)
+                    self.download_button.config(state=tk.NORMAL if self.masechet_var.get() else tk.DISABLED)
+                    if payload and self.queued_jobs and not self._closing:
+                        self._start_job(self.queued_jobs.popleft())
+                        continue
+                    self.queued_jobs.clear()
+                    if self.selection_mode_var.get() == "Typed":
+                        self.download_button.config(state=tk.NORMAL)
+                    if not self._closing:
+                        self._mark_available_items()
+                    self._paint()
+                    if payload and not self._closing:
+                        messagebox.showinfo(*payload)
+        except queue.Empty:
+            pass
+        self._paint()
+        self.root.after(1000 // PROGRESS_FPS, self._repaint)
+
+    def _paint(self):
+        snapshot = self.progress.snapshot()
+        if snapshot == self._painted:
+            return
+        done, total, status, stats = snapshot
+        self.progress_bar['maximum'] = max(total, 1)
+        self.progress_bar['value'] = done
+        self.status_label.config(text=status)
+        self.stats_label.config(text=stats)
+        self._painted = snapshot
 
     @staticmethod
-    def merge_pdfs(self, pdf_files, output_filename):
-        """Merges a list of PDF files into a single output file."""
+    def merge_pdfs(self, pdf_files, output_filename, verified=False, profile='archival'):
+        """Merges a list of PDF files into a single output file.
+        self is anything with set_status (the app or a job reporter), or None (e.g. from benchmarks.py).
+        Missing and empty files are skipped, unless verified says the caller has already checked.
+        Pages are recompressed in parallel first for any profile other than 'archival' (see PDF_PROFILES).
+        The output is written to a temporary file first so an interrupted merge leaves nothing half-written."""
         if not pdf_files: return
+        if profile != 'archival':
+            if not verified:
+                pdf_files = [p for p in pdf_files if os.path.exists(p) and os.path.getsize(p) > 0]
+            work_dir = tempfile.mkdtemp(prefix='.compress_', dir=os.path.dirname(output_filename) or '.')
+            try:
+                MasechetDownloader.merge_pdfs(self, compress_pdfs(pdf_files, profile, work_dir), output_filename, verified=True)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            return
         merger = PdfMerger()
         for pdf_path in pdf_files:
-            if os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0:
+            if verified or (os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0):
                 try:
                     merger.append(pdf_path)
                 except Exception as e:
                     print(f"[ERROR] Could not append {os.path.basename(pdf_path)}: {e}")
-                    self.status_label.configure(text = f"[ERROR] Could not append {os.path.basename(pdf_path)}: {e}")
+                    if self: self.set_status(f"[ERROR] Could not append {os.path.basename(pdf_path)}: {e}")
+        part_filename = output_filename + '.part'
         try:
-            merger.write(output_filename)
+            merger.write(part_filename)
+            merger.close()
+            os.replace(part_filename, output_filename)
         except Exception as e:
             print(f"[ERROR] Could not write merged PDF {os.path.basename(output_filename)}: {e}")
-            self.status_label.configure(text = f"[ERROR] Could not write merged PDF {os.path.basename(output_filename)}: {e}")
+            if self: self.set_status(f"[ERROR] Could not write merged PDF {os.path.basename(output_filename)}: {e}")
         finally:
             merger.close()
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
 
     @staticmethod
     def clean_up(self, files_to_delete):
         """Deletes specified temporary files."""
         for file in files_to_delete:
             try:
-                if os.path.exists(file):
-                    os.remove(file)
+                os.remove(file)
+            except FileNotFoundError:
+                pass
             except OSError as e:
                 print(f"[ERROR] Could not delete file {os.path.basename(file)}: {e}")
-                self.status_label.configure(text = f"[ERROR] Could not delete file {os.path.basename(file)}: {e}")
+                if self: self.set_status(f"[ERROR] Could not delete file {os.path.basename(file)}: {e}")
 
     def open_output_folder(self):
         """Opens the main downloads directory."""
-        folder_path = DOWNLOADS_DIR
         try:
-            if platform.system() == "Windows":
-                os.startfile(folder_path)
-            elif platform.system() == "Darwin":
-                subprocess.Popen(["open", folder_path])
-            else:
-                subprocess.Popen(["xdg-open", folder_path])
+            open_path(DOWNLOADS_DIR)
         except Exception as e:
             messagebox.showerror("Error", f"Could not open folder: {e}")
 
     def theme_auto(self, theme=None):
         sv_ttk.set_theme(darkdetect.theme()) # type: ignore
 
+def _headless_client():
+    """The page source for modes without a window; exits if there are no credentials."""
+    if CACHE_SERVER_URL:
+        return with_fallback(ProxyClient(CACHE_SERVER_URL))
+    try:
+        factory = drive_service_factory()
+    except FileNotFoundError:
+        print(f"[ERROR] Service account key file not found: '{SERVICE_ACCOUNT_FILE}'")
+        sys.exit(1)
+    return with_fallback(make_drive_client(factory))
+
+
+def run_selection(expression, merge_all=True, merge_amudim=False, profile=PDF_PROFILE, layout='pages'):
+    """Headless mode: downloads a selection expression (see parse_selection), one masechet at a time."""
+    try:
+        plan = parse_selection(expression)
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(2)
+    client = _headless_client()
+    catalog = PageCatalog.open()
+    try:
+        for job in selection_jobs(plan, merge_all, merge_amudim, profile=profile, layout=layout):
+            print(f"[INFO] Downloading {job.masechta_name} {format_intervals(job.masechta_name, plan[job.masechta_name])} "
+                  f"({len(job.pages)} pages)...")
+            instrumentation = Instrumentation(TRACE_FILE or None)
+            client.instrumentation = instrumentation
+            try:
+                job.run(client, JobControl(), ProgressAggregator(), instrumentation, catalog)
+            finally:
+                print(f"[INFO] Timing summary for {job.masechta_name}:\n{instrumentation.summary_table()}")
+                instrumentation.close()
+            print(f"[INFO] {len(job.completed)}/{len(job.pages)} pages of {job.masechta_name} are in {job.download_dir}")
+    except KeyboardInterrupt:
+        print("[INFO] Stopped.")
+    finally:
+        catalog.close()
+
+
+def run_prefetch_daemon(days):
+    """Headless mode: keeps the next days' Daf Yomi on disk until interrupted."""
+    client = _headless_client()
+    catalog = PageCatalog.open()
+    prefetcher = DafYomiPrefetcher(client, catalog, days)
+    print(f"[INFO] Prefetching the next {days} days of Daf Yomi every {PREFETCH_INTERVAL // 3600} hours. Press Ctrl+C to stop.")
+    try:
+        prefetcher.run_forever()
+    except KeyboardInterrupt:
+        prefetcher.stop()
+    finally:
+        catalog.close()
+
+
 def main():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=APP_NAME)
+    parser.add_argument('--select', metavar='EXPRESSION',
+                        help="Download a selection without a window, e.g. \"Brachos 2-10, 15a; Shabbos all\".")
+    parser.add_argument('--no-merge', action='store_true', help="With --select, leave the amudim unmerged.")
+    parser.add_argument('--dapim', action='store_true', help="With --select, also merge amudim into dapim.")
+    parser.add_argument('--profile', choices=list(PDF_PROFILES), default=PDF_PROFILE,
+                        help="With --select, how merged PDFs are compressed (default %(default)s).")
+    parser.add_argument('--spread', action='store_true',
+                        help="With --select, merge each daf onto one page with its amudim side by side (implies --dapim).")
+    parser.add_argument('--clean-store', action='store_true',
+                        help="Free the space of stored pages and merges whose files you have deleted, then exit.")
+    parser.add_argument('--prefetch', action='store_true', help="Run without a window, prefetching the Daf Yomi.")
+    parser.add_argument('--days', type=int, default=PREFETCH_DAYS or 2, help="Days of Daf Yomi to prefetch (default %(default)s).")
+    parser.add_argument('--serve', action='store_true', help="Run the LAN caching server instead of the window.")
+    parser.add_argument('--port', type=int, default=CACHE_SERVER_PORT, help="Port for --serve (default %(default)s).")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help="Cache directory for --serve (default %(default)s).")
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_BYTES // (1024 * 1024),
+                        help="Cache size limit in MB for --serve (default %(default)s).")
+    args = parser.parse_args()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if args.clean_store:
+        freed = BlobStore(os.path.join(DOWNLOADS_DIR, BlobStore.DIR)).collect_garbage()
+        print(f"[INFO] Freed {freed / (1024 * 1024):.1f} MB")
+        return
+    if args.serve:
+        run_cache_server(args.port, args.cache_dir, args.cache_size * 1024 * 1024)
+        return
+    if args.select:
+        run_selection(args.select, merge_all=not args.no_merge, merge_amudim=args.dapim or args.spread,
+                      profile=args.profile, layout='spread' if args.spread else 'pages')
+        return
+    if args.prefetch:
+        run_prefetch_daemon(args.days)
+        return
     root = tk.Tk()
     app = MasechetDownloader(root)
     sv_ttk.set_theme("light")
@@ -588,7 +4076,8 @@ def main():
     root.mainloop()
 
 if __name__ == "__main__":
-    
+    multiprocessing.freeze_support() # the page recompression pool in a frozen (PyInstaller) build
+
     try:
         import pyi_splash # type: ignore
         # You can optionally update the splash screen text as things load
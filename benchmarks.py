@@ -0,0 +1,312 @@
+"""
+Benchmark suite for the download, chunking, merge, imposition and selection paths.
+
+Everything runs offline: downloads go to the local Drive stand-in from
+fake_drive_server.py, merges use synthetic amud PDFs.
+
+    python benchmarks.py                                  # run all, save JSON
+    python benchmarks.py --only merge selection
+    python benchmarks.py --compare benchmark_results/<older>.json
+
+Results are written to benchmark_results/<timestamp>_<commit>.json. With --compare,
+metrics that got worse by more than --threshold are reported and the exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import concurrent.futures
+
+from fake_drive_server import FakeDriveServer, FaultInjector, make_synthetic_corpus
+import DownloaderShasDriveGUI_new as app
+
+RESULTS_DIR = "benchmark_results"
+PAGE_BYTES = 150 * 1024 # Roughly the size of a scanned amud PDF
+MERGE_SIZES = (10, 100, 300)
+
+# Metric name suffix -> True if higher is better
+METRIC_DIRECTIONS = {
+    'pages_per_sec': True,
+    'mb_per_sec': True,
+    'seconds': False,
+    'peak_rss_mb': False,
+    'peak_alloc_mb': False,
+    'median_ms': False,
+}
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if unavailable."""
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def bench_download(pages=60, page_bytes=PAGE_BYTES, latency=0.0, error_rate=0.0):
+    """Downloads a synthetic masechet through DriveClient from the local Drive stand-in."""
+    masechta_name = "Brachos"
+    corpus_dir = tempfile.mkdtemp(prefix="bench_drive_")
+    out_dir = tempfile.mkdtemp(prefix="bench_out_")
+    try:
+        make_synthetic_corpus(corpus_dir, {masechta_name: pages}, page_bytes)
+        server = FakeDriveServer(corpus_dir, faults=FaultInjector(latency=latency, error_rate=error_rate, seed=0)).start()
+        try:
+            client = app.DriveClient(app.build_drive_service(endpoint=server.endpoint), backoff=0.01)
+            total_bytes = 0
+            start = time.perf_counter()
+            for page_num in range(1, pages + 1):
+                daf, amud = app.MasechetDownloader.daf_amud_calculator(page_num)
+                filename = f"{masechta_name}_Daf{daf}_Amud{amud}.pdf"
+                save_path = os.path.join(out_dir, filename)
+                client.download(masechta_name, filename, save_path)
+                total_bytes += os.path.getsize(save_path)
+            elapsed = time.perf_counter() - start
+            with server.stats_lock:
+                server_stats = dict(server.stats)
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return {
+        'pages': pages,
+        'bytes': total_bytes,
+        'seconds': elapsed,
+        'pages_per_sec': pages / elapsed,
+        'mb_per_sec': total_bytes / (1024 * 1024) / elapsed,
+        'requests_per_page': server_stats.get('requests', 0) / pages,
+        'server': server_stats,
+    }
+
+
+def bench_chunking(pages=20, page_bytes=PAGE_BYTES, large_mb=40, small_chunk=256 * 1024):
+    """Compares fixed small media requests against chunk_size_for, for amud-sized files and one large file."""
+    masechta_name = "Brachos"
+    corpus_dir = tempfile.mkdtemp(prefix="bench_drive_")
+    out_dir = tempfile.mkdtemp(prefix="bench_out_")
+    results = {}
+    try:
+        make_synthetic_corpus(corpus_dir, {masechta_name: pages}, page_bytes)
+        large_name = f"{masechta_name}_Full.pdf"
+        with open(os.path.join(corpus_dir, masechta_name, large_name), 'wb') as f:
+            f.write(os.urandom(large_mb * 1024 * 1024))
+        filenames = [f"{masechta_name}_Daf{d}_Amud{a}.pdf"
+                     for d, a in map(app.MasechetDownloader.daf_amud_calculator, range(1, pages + 1))]
+        server = FakeDriveServer(corpus_dir).start()
+        try:
+            for label, chunk_size in (('fixed', small_chunk), ('adaptive', 0)):
+                client = app.DriveClient(app.build_drive_service(endpoint=server.endpoint), backoff=0.01,
+                                         chunk_size=chunk_size)
+                client.list_masechta_files(masechta_name)
+                for case, names in (('pages', filenames), ('large', [large_name])):
+                    with server.stats_lock:
+                        before = server.stats.get('files.get_media', 0)
+                    total_bytes = 0
+                    start = time.perf_counter()
+                    for filename in names:
+                        save_path = os.path.join(out_dir, filename)
+                        client.download(masechta_name, filename, save_path)
+                        total_bytes += os.path.getsize(save_path)
+                        os.remove(save_path)
+                    elapsed = time.perf_counter() - start
+                    with server.stats_lock:
+                        media_requests = server.stats.get('files.get_media', 0) - before
+                    results[f'{case}_{label}'] = {
+                        'files': len(names),
+                        'seconds': elapsed,
+                        'mb_per_sec': total_bytes / (1024 * 1024) / elapsed,
+                        'requests_per_file': media_requests / len(names),
+                    }
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+
+def _merge_case(pdf_files, output_filename):
+    """Runs in a fresh process so that peak RSS belongs to this merge alone."""
+    import tracemalloc
+    baseline_rss = _peak_rss_mb()
+    tracemalloc.start()
+    start = time.perf_counter()
+    app.MasechetDownloader.merge_pdfs(None, pdf_files, output_filename)
+    elapsed = time.perf_counter() - start
+    _, peak_alloc = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'seconds': elapsed,
+        'peak_rss_mb': _peak_rss_mb(),
+        'baseline_rss_mb': baseline_rss,
+        'peak_alloc_mb': peak_alloc / (1024 * 1024),
+        'output_bytes': os.path.getsize(output_filename),
+    }
+
+
+def bench_merge(sizes=MERGE_SIZES, page_bytes=PAGE_BYTES):
+    """Times merge_pdfs over 10/100/300 synthetic amud PDFs, each in its own process."""
+    corpus_dir = tempfile.mkdtemp(prefix="bench_merge_")
+    results = {}
+    try:
+        make_synthetic_corpus(corpus_dir, {"Merge": max(sizes)}, page_bytes)
+        folder = os.path.join(corpus_dir, "Merge")
+        all_files = []
+        for page_num in range(1, max(sizes) + 1):
+            daf, amud = app.MasechetDownloader.daf_amud_calculator(page_num)
+            all_files.append(os.path.join(folder, f"Merge_Daf{daf}_Amud{amud}.pdf"))
+        for size in sizes:
+            output = os.path.join(corpus_dir, f"merged_{size}.pdf")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                results[f'{size}_pages'] = pool.submit(_merge_case, all_files[:size], output).result()
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+    return results
+
+
+def bench_impose(dapim=150, page_bytes=PAGE_BYTES):
+    """Times laying out a masechet's dapim as two-up spreads against concatenating each daf's amudim."""
+    corpus_dir = tempfile.mkdtemp(prefix="bench_impose_")
+    results = {}
+    try:
+        make_synthetic_corpus(corpus_dir, {"Impose": dapim * 2}, page_bytes)
+        folder = os.path.join(corpus_dir, "Impose")
+        jobs = [(os.path.join(folder, f"Impose_Daf{daf}_Amuda.pdf"), os.path.join(folder, f"Impose_Daf{daf}_Amudb.pdf"),
+                 os.path.join(corpus_dir, f"Impose_Daf{daf}.pdf")) for daf in range(2, dapim + 2)]
+        store = app.BlobStore(os.path.join(corpus_dir, app.BlobStore.DIR))
+        start = time.perf_counter()
+        list(store.impose(None, jobs))
+        elapsed = time.perf_counter() - start
+        results['spread'] = {'dapim': dapim, 'seconds': elapsed, 'pages_per_sec': dapim / elapsed}
+        start = time.perf_counter()
+        for amud_a, amud_b, output in jobs:
+            app.MasechetDownloader.merge_pdfs(None, [amud_a, amud_b], output)
+        elapsed = time.perf_counter() - start
+        results['pages'] = {'dapim': dapim, 'seconds': elapsed, 'pages_per_sec': 2 * dapim / elapsed}
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+    return results
+
+
+def bench_selection(masechta_name="Bava Basra", repeat=20):
+    """Measures calculate_pages latency for every selection mode on the largest masechet."""
+    _, total_pages = app.MasechetDownloader.masechtos_info_static[masechta_name]
+    max_daf = 2 + (total_pages - 1) // 2
+    amudim = [f"{d}{a}" for d, a in map(app.MasechetDownloader.daf_amud_calculator, range(1, total_pages + 1))]
+    cases = {
+        'all': ("All", "Dapim", "", "", ()),
+        'range_dapim': ("Range", "Dapim", "2", str(max_daf), ()),
+        'range_amudim': ("Range", "Amudim", amudim[0], amudim[-1], ()),
+        'individual_dapim': ("Individual", "Dapim", "", "", [str(d) for d in range(2, max_daf + 1)]),
+        'individual_amudim': ("Individual", "Amudim", "", "", amudim),
+    }
+    results = {}
+    for name, (mode, select_type, start, end, items) in cases.items():
+        timings = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            pages = app.MasechetDownloader.calculate_pages(masechta_name, mode, select_type, start, end, items)
+            timings.append(time.perf_counter() - t0)
+        results[name] = {'pages': len(pages), 'median_ms': statistics.median(timings) * 1000}
+    return results
+
+
+BENCHMARKS = {
+    'download': bench_download,
+    'chunking': bench_chunking,
+    'merge': bench_merge,
+    'impose': bench_impose,
+    'selection': bench_selection,
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _flatten(results, prefix=''):
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, name + '.')
+        elif isinstance(value, (int, float)) and value is not None:
+            yield name, value
+
+
+def compare(current, baseline, threshold):
+    """Returns a list of (metric, old, new, change) for metrics that regressed."""
+    old_metrics = dict(_flatten(baseline.get('results', {})))
+    regressions = []
+    for name, new in _flatten(current['results']):
+        suffix = name.rsplit('.', 1)[-1]
+        if suffix not in METRIC_DIRECTIONS or name not in old_metrics or not old_metrics[name]:
+            continue
+        old = old_metrics[name]
+        change = (new - old) / old
+        worse = -change if METRIC_DIRECTIONS[suffix] else change
+        if worse > threshold:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the Shas downloader.")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help="Run only these benchmarks.")
+    parser.add_argument('--output', help="Where to write the JSON results.")
+    parser.add_argument('--compare', metavar='BASELINE_JSON', help="Report regressions against an earlier run.")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Allowed relative slowdown (default 10%%).")
+    args = parser.parse_args()
+
+    commit = _git_commit()
+    report = {
+        'meta': {
+            'commit': commit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': {},
+    }
+    for name in args.only or BENCHMARKS:
+        print(f"[INFO] Running {name} benchmark...")
+        report['results'][name] = BENCHMARKS[name]()
+
+    for name, value in _flatten(report['results']):
+        if name.rsplit('.', 1)[-1] in METRIC_DIRECTIONS:
+            print(f"  {name:<45} {value:12.3f}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{commit}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for name, old, new, change in regressions:
+            print(f"[WARN] Regression in {name}: {old:.3f} -> {new:.3f} ({change:+.1%})")
+        if regressions:
+            return 1
+        print(f"[INFO] No regressions against {args.compare}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,421 @@
+"""
+A local stand-in for the subset of the Google Drive v3 API used by the downloader.
+
+It serves a directory tree as if it were a Drive folder: every sub-directory is a
+folder, every file is a file. Supported calls:
+    GET /drive/v3/files?q=...&pageSize=...&pageToken=...    (files.list)
+    GET /drive/v3/files/<id>                                 (files.get metadata)
+    GET /drive/v3/files/<id>?alt=media  (Range supported)    (files.get_media)
+
+Latency, bandwidth and 429/5xx errors can be injected so that throughput and retry
+logic can be measured offline. Point the app at it with:
+
+    python fake_drive_server.py --root downloads --port 8765
+    set SHAS_DRIVE_ENDPOINT=http://127.0.0.1:8765/drive/v3/
+    python DownloaderShasDriveGUI_new.py
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+DEFAULT_ROOT_ID = '1L94Vy-FQblxPG7XoqIjPWe-ebhRYIs3x' # Same as DRIVE_FOLDER_ID in the app
+DEFAULT_PAGE_SIZE = 100
+
+
+class DriveQuery:
+    """Parses and evaluates the small subset of the Drive query language the app uses.
+
+    Supported terms, joined with 'and':
+        name = 'x'    name != 'x'    name contains 'x'
+        mimeType = 'x'    mimeType != 'x'
+        'id' in parents
+        trashed = true|false
+    """
+    TERM_RE = re.compile(
+        r"\s*(?:"
+        r"(?P<field>name|mimeType|trashed)\s*(?P<op>!=|=|contains)\s*(?P<value>'(?:\\.|[^'])*'|true|false)"
+        r"|'(?P<parent>(?:\\.|[^'])*)'\s+in\s+parents"
+        r")\s*(?:and\b|$)",
+        re.IGNORECASE)
+
+    def __init__(self, q):
+        self.terms = []
+        q = (q or '').strip()
+        pos = 0
+        while pos < len(q):
+            match = self.TERM_RE.match(q, pos)
+            if not match or match.end() == pos:
+                raise ValueError(f"Unsupported query near: {q[pos:]!r}")
+            if match.group('parent') is not None:
+                self.terms.append(('parents', 'in', self._unquote(f"'{match.group('parent')}'")))
+            else:
+                self.terms.append((match.group('field'), match.group('op').lower(), self._unquote(match.group('value'))))
+            pos = match.end()
+
+    @staticmethod
+    def _unquote(value):
+        if value.startswith("'"):
+            return value[1:-1].replace("\\'", "'").replace('\\\\', '\\')
+        return value.lower() == 'true'
+
+    def matches(self, item):
+        for field, op, value in self.terms:
+            if field == 'parents':
+                if value not in item['parents']:
+                    return False
+            elif field == 'trashed':
+                if item.get('trashed', False) != value:
+                    return False
+            else:
+                actual = item[field]
+                if op == '=' and actual != value: return False
+                if op == '!=' and actual == value: return False
+                if op == 'contains' and value not in actual: return False
+        return True
+
+
+class FakeDriveStore:
+    """Indexes a local directory tree as Drive files, with stable ids."""
+
+    def __init__(self, root_dir, root_id=DEFAULT_ROOT_ID):
+        self.root_dir = os.path.abspath(root_dir)
+        self.root_id = root_id
+        self.items = {}
+        self.refresh()
+
+    @staticmethod
+    def _make_id(rel_path):
+        return 'fake-' + hashlib.sha1(rel_path.encode('utf-8')).hexdigest()[:24]
+
+    def refresh(self):
+        """Re-scans the backing directory."""
+        items = {}
+        ids_by_dir = {self.root_dir: self.root_id}
+        for dirpath, dirnames, filenames in os.walk(self.root_dir):
+            dirnames.sort()
+            parent_id = ids_by_dir[dirpath]
+            for dirname in dirnames:
+                full = os.path.join(dirpath, dirname)
+                file_id = self._make_id(os.path.relpath(full, self.root_dir))
+                ids_by_dir[full] = file_id
+                items[file_id] = {'id': file_id, 'name': dirname, 'mimeType': FOLDER_MIME,
+                                  'parents': [parent_id], 'path': full}
+            for filename in sorted(filenames):
+                full = os.path.join(dirpath, filename)
+                file_id = self._make_id(os.path.relpath(full, self.root_dir))
+                items[file_id] = {'id': file_id, 'name': filename,
+                                  'mimeType': 'application/pdf' if filename.lower().endswith('.pdf') else 'application/octet-stream',
+                                  'parents': [parent_id], 'path': full,
+                                  'size': str(os.path.getsize(full))}
+        self.items = items
+
+    def md5(self, item):
+        if 'md5Checksum' not in item:
+            h = hashlib.md5()
+            with open(item['path'], 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            item['md5Checksum'] = h.hexdigest()
+        return item['md5Checksum']
+
+    def public(self, item, fields=None):
+        """Returns the JSON representation of an item, honouring a simple fields mask."""
+        data = {k: v for k, v in item.items() if k != 'path'}
+        if item['mimeType'] != FOLDER_MIME:
+            data['md5Checksum'] = self.md5(item)
+        if fields:
+            wanted = set(re.findall(r'[A-Za-z0-9]+', fields)) - {'files', 'nextPageToken'}
+            if wanted:
+                data = {k: v for k, v in data.items() if k in wanted}
+        return data
+
+    def list(self, q):
+        query = DriveQuery(q)
+        return [item for item in sorted(self.items.values(), key=lambda i: (i['name'], i['id'])) if query.matches(item)]
+
+
+class FaultInjector:
+    """Adds latency, bandwidth limits and transient errors to responses."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=429,
+                 bandwidth=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.bandwidth = bandwidth # bytes per second, 0 = unlimited
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            extra = self._random.uniform(0, self.jitter) if self.jitter else 0.0
+        if self.latency or extra:
+            time.sleep(self.latency + extra)
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeDrive/1.0'
+    disable_nagle_algorithm = True # Otherwise delayed ACKs add ~40 ms per keep-alive request
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _count(self, key):
+        with self.server.stats_lock:
+            self.server.stats[key] = self.server.stats.get(key, 0) + 1
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message, reason='error'):
+        self._send_json(status, {'error': {'code': status, 'message': message,
+                                           'errors': [{'message': message, 'reason': reason}]}})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        self._count('requests')
+
+        if url.path == '/_stats':
+            with self.server.stats_lock:
+                stats = dict(self.server.stats)
+            return self._send_json(200, stats)
+
+        faults = self.server.faults
+        faults.delay()
+        if faults.should_fail():
+            self._count(f'errors_{faults.error_status}')
+            return self._send_error(faults.error_status, 'Injected failure', 'rateLimitExceeded')
+
+        match = re.fullmatch(r'/drive/v3/files(?:/([^/]+))?', url.path)
+        if not match:
+            return self._send_error(404, f'Unknown path {url.path}', 'notFound')
+
+        file_id = match.group(1)
+        if file_id is None:
+            return self._list_files(params)
+        item = self.server.store.items.get(file_id)
+        if item is None:
+            return self._send_error(404, f'File not found: {file_id}', 'notFound')
+        if params.get('alt') == 'media':
+            return self._send_media(item)
+        self._count('files.get')
+        return self._send_json(200, self.server.store.public(item, params.get('fields')))
+
+    def _list_files(self, params):
+        self._count('files.list')
+        try:
+            results = self.server.store.list(params.get('q'))
+        except ValueError as e:
+            return self._send_error(400, str(e), 'invalidQuery')
+        page_size = max(1, min(int(params.get('pageSize', DEFAULT_PAGE_SIZE)), 1000))
+        start = int(params.get('pageToken') or 0)
+        page = results[start:start + page_size]
+        fields = params.get('fields')
+        payload = {'files': [self.server.store.public(item, fields) for item in page]}
+        if start + page_size < len(results):
+            payload['nextPageToken'] = str(start + page_size)
+        self._send_json(200, payload)
+
+    def _send_media(self, item):
+        self._count('files.get_media')
+        if item['mimeType'] == FOLDER_MIME:
+            return self._send_error(403, 'Folders have no media', 'fileNotDownloadable')
+        total = int(item['size'])
+        start, end = 0, total - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header:
+            match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+            if not match:
+                return self._send_error(400, f'Bad Range header {range_header}', 'badRequest')
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), total - 1)
+            elif match.group(2): # suffix range: bytes=-N
+                start = max(0, total - int(match.group(2)))
+            if start >= total:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{total}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header('Content-Type', item['mimeType'])
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{total}')
+        self.end_headers()
+
+        bandwidth = self.server.faults.bandwidth
+        block = 64 * 1024
+        with open(item['path'], 'rb') as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(block, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+                if bandwidth:
+                    time.sleep(len(data) / bandwidth)
+        with self.server.stats_lock:
+            self.server.stats['bytes_sent'] = self.server.stats.get('bytes_sent', 0) + length
+
+
+class FakeDriveServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the store, fault settings and request statistics."""
+    daemon_threads = True
+
+    def __init__(self, root_dir, host='127.0.0.1', port=0, root_id=DEFAULT_ROOT_ID,
+                 faults=None, verbose=False):
+        super().__init__((host, port), FakeDriveHandler)
+        self.store = FakeDriveStore(root_dir, root_id)
+        self.faults = faults or FaultInjector()
+        self.verbose = verbose
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        """The value to use for SHAS_DRIVE_ENDPOINT / build_drive_service(endpoint=...)."""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/drive/v3/'
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {}
+
+    def start(self):
+        """Serves in a background daemon thread and returns self."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+def make_synthetic_corpus(root_dir, masechtos, page_bytes=0, scan_dpi=0):
+    """Creates a Drive-like folder of amud PDFs for testing and benchmarking.
+
+    masechtos maps a masechet name to a page count. Each page is a one-page PDF
+    whose content stream is padded with a (poorly compressible) comment to roughly
+    page_bytes, so sizes resemble scanned pages. With scan_dpi, each page is also
+    covered by an 8-bit grey, Flate-compressed image of that resolution, like a scan.
+    """
+    import zlib
+    from PyPDF2 import PdfWriter, PageObject
+    from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject, StreamObject
+
+    for masechta_name, total_pages in masechtos.items():
+        folder = os.path.join(root_dir, masechta_name)
+        os.makedirs(folder, exist_ok=True)
+        for page_num in range(1, total_pages + 1):
+            daf = 2 + (page_num - 1) // 2
+            amud = "a" if page_num % 2 != 0 else "b"
+            path = os.path.join(folder, f"{masechta_name}_Daf{daf}_Amud{amud}.pdf")
+            if os.path.exists(path):
+                continue
+            writer = PdfWriter()
+            page = PageObject.create_blank_page(None, 612, 792)
+            content = DecodedStreamObject()
+            text = f"BT /F1 24 Tf 72 720 Td ({masechta_name} {daf}{amud}) Tj ET\n".encode('ascii')
+            if page_bytes > len(text):
+                text += b'%' + bytes(33 + b % 90 for b in os.urandom(page_bytes - len(text))) + b'\n'
+            if scan_dpi:
+                width, height = 612 * scan_dpi // 72, 792 * scan_dpi // 72
+                gradient = bytes(range(256)) * (width // 256 + 2)
+                scan = StreamObject()
+                scan._data = zlib.compress(b''.join(gradient[y % 256:y % 256 + width] for y in range(height)))
+                scan.update({
+                    NameObject('/Type'): NameObject('/XObject'), NameObject('/Subtype'): NameObject('/Image'),
+                    NameObject('/Width'): NumberObject(width), NameObject('/Height'): NumberObject(height),
+                    NameObject('/ColorSpace'): NameObject('/DeviceGray'),
+                    NameObject('/BitsPerComponent'): NumberObject(8), NameObject('/Filter'): NameObject('/FlateDecode'),
+                })
+                page[NameObject('/Resources')] = DictionaryObject({
+                    NameObject('/XObject'): DictionaryObject({NameObject('/Scan'): writer._add_object(scan)})})
+                text = b"q 612 0 0 792 0 0 cm /Scan Do Q\n" + text
+            content.set_data(text)
+            page[NameObject('/Contents')] = writer._add_object(content)
+            writer.add_page(page)
+            with open(path, 'wb') as f:
+                writer.write(f)
+    return root_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Google Drive v3 API.")
+    parser.add_argument('--root', default='downloads', help="Directory served as the Drive root folder.")
+    parser.add_argument('--root-id', default=DEFAULT_ROOT_ID, help="Folder id reported for --root.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every request.")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random extra seconds (0..jitter) per request.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests that fail.")
+    parser.add_argument('--error-status', type=int, default=429, help="HTTP status used for injected failures.")
+    parser.add_argument('--bandwidth', type=int, default=0, help="Media bytes per second per request (0 = unlimited).")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--generate', metavar='MASECHET:PAGES', action='append', default=[],
+                        help="Create synthetic amud PDFs under --root before serving.")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.generate:
+        corpus = {}
+        for spec in args.generate:
+            name, _, pages = spec.rpartition(':')
+            corpus[name] = int(pages)
+        make_synthetic_corpus(args.root, corpus)
+
+    faults = FaultInjector(args.latency, args.jitter, args.error_rate, args.error_status,
+                           args.bandwidth, args.seed)
+    server = FakeDriveServer(args.root, args.host, args.port, args.root_id, faults, args.verbose)
+    print(f"[INFO] Serving '{os.path.abspath(args.root)}' as Drive folder {args.root_id}")
+    print(f"[INFO] Set SHAS_DRIVE_ENDPOINT={server.endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
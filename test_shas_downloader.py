@@ -0,0 +1,1069 @@
+import os
+import json
+import datetime
+import functools
+import shutil
+import tempfile
+import threading
+import time
+import concurrent.futures
+import unittest
+import unittest.mock
+import urllib.request
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from googleapiclient.errors import HttpError
+
+import DownloaderShasDriveGUI_new as app
+from fake_drive_server import FakeDriveServer, FaultInjector, DriveQuery, make_synthetic_corpus
+
+
+class TestFakeDriveServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus_dir = tempfile.mkdtemp()
+        make_synthetic_corpus(cls.corpus_dir, {"Makkos": 6})
+        cls.server = FakeDriveServer(cls.corpus_dir).start()
+        cls.service = app.build_drive_service(endpoint=cls.server.endpoint)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        shutil.rmtree(cls.corpus_dir)
+
+    def setUp(self):
+        self.server.faults = FaultInjector()
+        self.out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out_dir)
+
+    def test_query_parsing(self):
+        query = DriveQuery("name = 'a b' and 'root' in parents and trashed = false")
+        self.assertTrue(query.matches({'name': 'a b', 'parents': ['root'], 'mimeType': 'x'}))
+        self.assertFalse(query.matches({'name': 'a b', 'parents': ['other'], 'mimeType': 'x'}))
+        with self.assertRaises(ValueError):
+            DriveQuery("modifiedTime > '2020-01-01'")
+
+    def test_download_via_client(self):
+        client = app.DriveClient(self.service)
+        save_path = os.path.join(self.out_dir, "Makkos_Daf2_Amuda.pdf")
+        client.download("Makkos", "Makkos_Daf2_Amuda.pdf", save_path)
+        source = os.path.join(self.corpus_dir, "Makkos", "Makkos_Daf2_Amuda.pdf")
+        with open(source, 'rb') as a, open(save_path, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertNotEqual(client.folder_ids["Makkos"], app.DRIVE_FOLDER_ID)
+
+    def test_chunked_download(self):
+        self.assertEqual(app.chunk_size_for(150 * 1024), 150 * 1024)
+        self.assertEqual(app.chunk_size_for(400 * 1024 * 1024), app.DOWNLOAD_MAX_CHUNK_SIZE)
+        source = os.path.join(self.corpus_dir, "Makkos", "Makkos_Daf4_Amuda.pdf")
+        size = os.path.getsize(source)
+        for chunk_size, expected_requests in ((0, 1), (1000, -(-size // 1000))):
+            client = app.DriveClient(self.service, chunk_size=chunk_size)
+            client.list_masechta_files("Makkos")
+            with self.server.stats_lock:
+                before = self.server.stats.get('files.get_media', 0)
+            save_path = os.path.join(self.out_dir, f"chunk{chunk_size}.pdf")
+            client.download("Makkos", "Makkos_Daf4_Amuda.pdf", save_path)
+            with self.server.stats_lock:
+                self.assertEqual(self.server.stats['files.get_media'] - before, expected_requests)
+            with open(source, 'rb') as a, open(save_path, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_missing_file(self):
+        client = app.DriveClient(self.service)
+        with self.assertRaises(FileNotFoundError):
+            client.download("Makkos", "Makkos_Daf99_Amuda.pdf", os.path.join(self.out_dir, "x.pdf"))
+
+    def test_pagination(self):
+        query = "name contains 'Makkos_Daf'"
+        first = self.service.files().list(q=query, pageSize=1, fields='nextPageToken, files(id)').execute()
+        self.assertEqual(len(first['files']), 1)
+        self.assertIn('nextPageToken', first)
+
+    def test_retries_throttled_requests(self):
+        self.server.faults = FaultInjector(error_rate=0.5, seed=1)
+        client = app.DriveClient(self.service, max_retries=10, backoff=0)
+        client.download("Makkos", "Makkos_Daf3_Amudb.pdf", os.path.join(self.out_dir, "x.pdf"))
+
+        self.server.faults = FaultInjector(error_rate=1.0)
+        client = app.DriveClient(self.service, max_retries=1, backoff=0)
+        with self.assertRaises(HttpError):
+            client.download("Makkos", "Makkos_Daf3_Amudb.pdf", os.path.join(self.out_dir, "y.pdf"))
+
+
+class RecordingReporter(app.ProgressAggregator):
+    def __init__(self, on_progress=None):
+        super().__init__()
+        self.statuses = []
+        self.on_progress = on_progress
+
+    def set_status(self, text):
+        super().set_status(text)
+        self.statuses.append(text)
+
+    def page_finished(self, nbytes=0, ok=True):
+        super().page_finished(nbytes, ok)
+        if self.on_progress:
+            self.on_progress(self.done)
+
+
+class TestDownloadJob(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus_dir = tempfile.mkdtemp()
+        make_synthetic_corpus(cls.corpus_dir, {"Makkos": 8})
+        cls.server = FakeDriveServer(cls.corpus_dir).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        shutil.rmtree(cls.corpus_dir)
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out_dir)
+        patcher = unittest.mock.patch.object(app, 'DOWNLOADS_DIR', self.out_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.DriveClient(app.build_drive_service(endpoint=self.server.endpoint))
+
+    def test_full_run_merges_and_cleans_up(self):
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merge_amudim=True, merged_suffix="All")
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        self.assertEqual(job.stage, 'done')
+        self.assertTrue(os.path.exists(job.merged_filename))
+        self.assertEqual(sorted(os.listdir(job.download_dir)),
+                         sorted(f"Makkos_Daf{d}.pdf" for d in range(2, 6)))
+
+    def test_store_dedups_redownloads_and_remerges(self):
+        job = app.DownloadJob("Makkos", range(1, 5), merge_all=True, merge_amudim=True, merged_suffix="All")
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        os.remove(job.merged_filename)
+        self.server.reset_stats()
+
+        instrumentation = app.Instrumentation()
+        again = app.DownloadJob("Makkos", range(1, 5), merge_all=True, merge_amudim=True, merged_suffix="All",
+                                keep_individuals=True)
+        again.run(self.client, app.JobControl(), RecordingReporter(), instrumentation)
+        # The amudim cleaned up after the first run were collected; the daf merges still link to the store
+        self.assertEqual(self.server.stats['files.get_media'], 4)
+        self.assertEqual(instrumentation.counters['merge_cache_hits'], 3)
+        daf_file = os.path.join(job.download_dir, "Makkos_Daf2.pdf")
+        stored = [os.path.join(folder, name) for folder, _, names in os.walk(os.path.join(self.out_dir, app.BlobStore.DIR))
+                  for name in names]
+        self.assertTrue(any(os.path.samefile(daf_file, path) for path in stored))
+
+        os.remove(again.merged_filename)
+        self.server.reset_stats()
+        instrumentation = app.Instrumentation()
+        third = app.DownloadJob("Makkos", range(1, 5), merge_all=True, merge_amudim=True, merged_suffix="All")
+        third.run(self.client, app.JobControl(), RecordingReporter(), instrumentation)
+        self.assertNotIn('files.get_media', self.server.stats)
+        self.assertEqual(instrumentation.counters['pages_existing'], 4)
+        self.assertEqual(instrumentation.counters['merge_cache_hits'], 3)
+
+    def test_store_is_collected_and_skipped_without_hard_links(self):
+        job = app.DownloadJob("Makkos", range(1, 5), merge_all=True, merge_amudim=True, merged_suffix="All")
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        objects_dir = os.path.join(self.out_dir, app.BlobStore.DIR, 'objects')
+
+        def stored():
+            return [name for _, _, names in os.walk(objects_dir) for name in names]
+        self.assertEqual(len(stored()), 3) # the two daf merges and the final merge; the amudim were released
+        os.remove(job.merged_filename)
+        self.assertGreater(job.store.collect_garbage(), 0)
+        self.assertEqual(len(stored()), 2)
+        self.assertEqual(len([n for _, _, names in os.walk(os.path.join(self.out_dir, app.BlobStore.DIR, 'merges'))
+                              for n in names]), 2)
+
+        shutil.rmtree(self.out_dir)
+        os.makedirs(self.out_dir)
+        with unittest.mock.patch.object(app.os, 'link', side_effect=OSError("not supported")):
+            job = app.DownloadJob("Makkos", range(1, 5), merge_all=True, merged_suffix="All")
+            job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        self.assertEqual(len(app.PdfReader(job.merged_filename).pages), 4)
+        self.assertEqual(stored(), [])
+
+    def test_edited_pdf_is_not_reused_from_the_store(self):
+        job = app.DownloadJob("Makkos", range(1, 5), merge_all=True, merged_suffix="All", keep_individuals=True)
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        with open(job.page_path(1), 'ab') as f: # e.g. an annotation saved in place
+            f.write(b'%edited\n')
+        with open(job.merged_filename, 'ab') as f:
+            f.write(b'%edited\n')
+        os.remove(job.page_path(1))
+        os.remove(job.merged_filename)
+
+        self.server.reset_stats()
+        instrumentation = app.Instrumentation()
+        again = app.DownloadJob("Makkos", range(1, 5), merge_all=True, merged_suffix="All")
+        again.run(self.client, app.JobControl(), RecordingReporter(), instrumentation)
+        self.assertEqual(self.server.stats['files.get_media'], 1)
+        self.assertEqual(instrumentation.counters['merge_cache_misses'], 1)
+        with open(again.page_path(1), 'rb') as a, open(os.path.join(self.corpus_dir, "Makkos", "Makkos_Daf2_Amuda.pdf"), 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        with open(again.merged_filename, 'rb') as f:
+            self.assertNotIn(b'%edited', f.read())
+
+    def test_merge_profiles(self):
+        corpus_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_dir)
+        make_synthetic_corpus(corpus_dir, {"Makkos": 4}, page_bytes=20 * 1024)
+        pages = sorted(os.path.join(corpus_dir, "Makkos", name) for name in os.listdir(os.path.join(corpus_dir, "Makkos")))
+        store = app.BlobStore(os.path.join(self.out_dir, app.BlobStore.DIR))
+        archival, screen = (os.path.join(self.out_dir, f"{name}.pdf") for name in ('archival', 'screen'))
+        self.assertFalse(store.merge(None, pages, archival))
+        self.assertFalse(store.merge(None, pages, screen, profile='screen'))
+        self.assertTrue(store.merge(None, pages, os.path.join(self.out_dir, "again.pdf"), profile='screen'))
+        self.assertLess(os.path.getsize(screen), os.path.getsize(archival))
+        self.assertEqual(len(app.PdfReader(screen).pages), 4)
+
+    def test_scanned_pages_keep_or_recompress_their_images(self):
+        corpus_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_dir)
+        make_synthetic_corpus(corpus_dir, {"Makkos": 2}, scan_dpi=200)
+        pages = sorted(os.path.join(corpus_dir, "Makkos", name) for name in os.listdir(os.path.join(corpus_dir, "Makkos")))
+        store = app.BlobStore(os.path.join(self.out_dir, app.BlobStore.DIR))
+        screen = os.path.join(self.out_dir, "screen.pdf")
+        store.merge(None, pages, screen, profile='screen')
+        reader = app.PdfReader(screen)
+        self.assertEqual(len(reader.pages), 2)
+        scan = reader.pages[0]['/Resources']['/XObject']['/Scan'].get_object()
+        self.assertEqual(app._image_mode(scan), ('L', None))
+        if app.Image is None:
+            self.assertEqual((scan['/Filter'], scan['/Width']), ('/FlateDecode', 1700))
+        else:
+            self.assertEqual((scan['/Filter'], scan['/Width']), ('/DCTDecode', 1275))
+            self.assertLess(os.path.getsize(screen), sum(map(os.path.getsize, pages)))
+
+    def test_images_kept_as_they_are(self):
+        def image(**entries):
+            fields = {'/Subtype': '/Image', '/BitsPerComponent': 8, '/ColorSpace': '/DeviceGray'}
+            fields.update(entries)
+            return app.DictionaryObject({app.NameObject(k): app.NameObject(v) if isinstance(v, str) else v
+                                         for k, v in fields.items()})
+        icc = app.StreamObject()
+        icc[app.NameObject('/N')] = app.NumberObject(3)
+        cmyk_icc = app.StreamObject()
+        cmyk_icc[app.NameObject('/N')] = app.NumberObject(4)
+        self.assertEqual(app._image_mode(image(**{'/ColorSpace': app.ArrayObject([app.NameObject('/ICCBased'), icc])})),
+                         ('RGB', None))
+        self.assertEqual(app._image_mode(image(**{'/Filter': app.ArrayObject([app.NameObject('/DCTDecode')])})),
+                         ('L', None))
+        for kept in (image(**{'/BitsPerComponent': 1, '/Filter': '/CCITTFaxDecode'}),
+                     image(**{'/Filter': '/JBIG2Decode'}),
+                     image(**{'/ColorSpace': app.ArrayObject([app.NameObject('/ICCBased'), cmyk_icc])}),
+                     image(**{'/ColorSpace': '/DeviceCMYK'}),
+                     image(**{'/Filter': app.ArrayObject([app.NameObject('/ASCII85Decode'), app.NameObject('/LZWDecode')])})):
+            mode, reason = app._image_mode(kept)
+            self.assertIsNone(mode)
+            self.assertTrue(reason)
+
+    def test_spread_layout(self):
+        job = app.DownloadJob("Makkos", range(1, 8), merge_all=True, merge_amudim=True, merged_suffix="All",
+                              layout='spread')
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        self.assertEqual(len(app.PdfReader(job.merged_filename).pages), 4)
+        spread = app.PdfReader(os.path.join(job.download_dir, "Makkos_Daf2.pdf")).pages[0]
+        self.assertEqual((spread.mediabox.width, spread.mediabox.height), (1224, 792))
+        self.assertEqual(sorted(spread['/Resources']['/XObject']), ['/AmudA', '/AmudB'])
+        self.assertIn("Makkos 2b", spread['/Resources']['/XObject']['/AmudB'].get_data().decode('ascii'))
+        last = app.PdfReader(os.path.join(job.download_dir, "Makkos_Daf5.pdf")).pages[0]
+        self.assertEqual(list(last['/Resources']['/XObject']), ['/AmudA'])
+
+        os.remove(job.merged_filename)
+        instrumentation = app.Instrumentation()
+        again = app.DownloadJob("Makkos", range(1, 8), merge_all=True, merge_amudim=True, merged_suffix="All",
+                                layout='spread')
+        again.run(self.client, app.JobControl(), RecordingReporter(), instrumentation)
+        self.assertEqual(instrumentation.counters['merge_cache_hits'], 5)
+
+    def test_cancel_during_spread_layout_cancels_pending_spreads(self):
+        class RecordingPool(concurrent.futures.ThreadPoolExecutor):
+            def __init__(self):
+                super().__init__(max_workers=1)
+                self.futures = []
+
+            def submit(self, *args):
+                future = super().submit(*args)
+                self.futures.append(future)
+                return future
+
+        pool = RecordingPool()
+        impose_spread = app._impose_spread
+        def slow_impose_spread(*args):
+            time.sleep(0.2)
+            impose_spread(*args)
+        control = app.JobControl()
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=False, merge_amudim=True, layout='spread')
+        daf_merged = job._daf_merged
+        def cancel_after_first_daf(*args):
+            daf_merged(*args)
+            control.cancel()
+        job._daf_merged = cancel_after_first_daf
+        with unittest.mock.patch.object(app, '_pdf_pool', lambda: pool), \
+                unittest.mock.patch.object(app, '_impose_spread', slow_impose_spread):
+            with self.assertRaises(app.JobCancelled):
+                job.run(self.client, control, RecordingReporter(), app.Instrumentation())
+            self.assertTrue(pool.futures[-1].cancelled())
+            pool.shutdown(wait=True)
+        self.assertEqual(list(job.merged_dapim), [2])
+        self.assertFalse([name for name in os.listdir(job.download_dir) if name.endswith('.part')])
+        self.assertFalse(os.path.exists(os.path.join(job.download_dir, "Makkos_Daf5.pdf")))
+
+    def test_cancel_then_resume_without_relisting(self):
+        control = app.JobControl()
+        reporter = RecordingReporter(on_progress=lambda value: value == 3 and control.cancel())
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merged_suffix="All")
+        journal_path = os.path.join(self.out_dir, "job.journal")
+        app.JobJournal.create(journal_path, job)
+        with self.assertRaises(app.JobCancelled):
+            job.run(self.client, control, reporter, app.Instrumentation())
+        job.journal.close()
+        self.assertEqual(sorted(job.completed), [1, 2, 3])
+        self.assertFalse([f for f in os.listdir(job.download_dir) if f.endswith('.part')])
+
+        resumed = app.JobJournal.replay(journal_path)
+        self.assertEqual(sorted(resumed.completed), [1, 2, 3])
+        fresh_client = app.DriveClient(app.build_drive_service(endpoint=self.server.endpoint))
+        self.server.reset_stats()
+        resumed.run(fresh_client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        self.assertEqual(resumed.stage, 'done')
+        self.assertEqual(sorted(resumed.completed), list(range(1, 9)))
+        self.assertNotIn('files.list', self.server.stats)
+
+    def test_journal_replay_after_crash(self):
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=False, merge_amudim=True)
+        journal_path = os.path.join(self.out_dir, "job.journal")
+        app.JobJournal.create(journal_path, job)
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        job.journal.close()
+        self.assertIsNone(app.JobJournal.replay(journal_path))
+
+        # Cut the journal off just after the merges, leaving a torn half-record behind
+        with open(journal_path) as f:
+            lines = f.readlines()
+        last_merge = max(i for i, line in enumerate(lines) if '"daf_merged"' in line)
+        with open(journal_path, 'w') as f:
+            f.writelines(lines[:last_merge + 1])
+            f.write('{"op": "stage", "sta')
+        for daf in range(2, 6):
+            for amud in "ab":
+                open(os.path.join(job.download_dir, f"Makkos_Daf{daf}_Amud{amud}.pdf"), 'w').close()
+
+        resumed = app.JobJournal.replay(journal_path)
+        self.assertEqual(resumed.stage, 'merge')
+        self.assertEqual(len(resumed.files_to_delete), 8)
+        resumed.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        self.assertEqual(sorted(os.listdir(job.download_dir)),
+                         sorted(f"Makkos_Daf{d}.pdf" for d in range(2, 6)))
+
+    def test_journal_keeps_the_queue_of_a_selection(self):
+        jobs = app.selection_jobs(app.parse_selection("Makkos 2-3; Horyos 5; Makkos 10"))
+        journal_path = os.path.join(self.out_dir, "job.journal")
+        app.JobJournal.create(journal_path, jobs[0], jobs[1:])
+        jobs[0].run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        jobs[0].journal.close()
+        self.assertIsNone(app.JobJournal.replay(journal_path))
+        queued = app.JobJournal.replay_queue(journal_path)
+        self.assertEqual([(j.masechta_name, list(j.pages), j.merged_suffix, j.stage) for j in queued],
+                         [("Horyos", [7, 8], "Selection_5", 'download')])
+        self.assertEqual(app.JobJournal.replay_queue(os.path.join(self.out_dir, "missing.journal")), [])
+
+    def test_rerun_checks_pages_without_a_stat_each(self):
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merged_suffix="All")
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        stats = []
+        real_stat = os.stat
+
+        def counting_stat(path, *args, **kwargs):
+            if str(path).startswith((job.download_dir, job.store.root)):
+                stats.append(path)
+            return real_stat(path, *args, **kwargs)
+        again = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merged_suffix="All")
+        with unittest.mock.patch('os.stat', counting_stat):
+            again.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        self.assertEqual(sorted(again.completed), list(range(1, 9)))
+        # os.makedirs, and checking the stored merge before reusing it; nothing else in the store
+        merged_md5 = app.file_md5(again.merged_filename)
+        self.assertEqual(stats, [job.download_dir, job.store.object_path(merged_md5)])
+
+    def test_catalog_tracks_downloads(self):
+        catalog = app.PageCatalog(os.path.join(self.out_dir, app.PageCatalog.FILE), self.out_dir)
+        self.addCleanup(catalog.close)
+        job = app.DownloadJob("Makkos", [1, 2, 3], merge_all=False)
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation(), catalog)
+        row = catalog.get("Makkos", 1)
+        self.assertEqual(row['size'], os.path.getsize(row['path']))
+        self.assertEqual(row['md5'], self.client.file_md5s[row['file_id']])
+
+        os.remove(row['path'])
+        open(os.path.join(job.download_dir, "Makkos_Daf5_Amuda.pdf"), 'wb').close()
+        catalog.reconcile("Makkos", job.download_dir)
+        self.assertEqual(sorted(catalog.present_pages("Makkos")), [2, 3, 7])
+
+    def test_catalog_is_kept_per_downloads_folder(self):
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        legacy = os.path.join(self.out_dir, app.PageCatalog.LEGACY_FILE)
+        open(legacy, 'wb').close()
+        with unittest.mock.patch.object(app, 'get_app_data_path', lambda name: os.path.join(data_dir, name)):
+            catalog = app.PageCatalog.open()
+        self.addCleanup(catalog.close)
+        self.assertEqual(catalog.path, os.path.join(data_dir, app.PageCatalog.FILE))
+        self.assertFalse(os.path.exists(legacy))
+        job = app.DownloadJob("Makkos", [1, 2], merge_all=False)
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation(), catalog)
+        self.assertEqual(sorted(catalog.present_pages("Makkos")), [1, 2])
+
+        other = app.PageCatalog(catalog.path, os.path.join(self.out_dir, "elsewhere"))
+        self.addCleanup(other.close)
+        self.assertEqual(other.present_pages("Makkos"), {})
+        self.assertIsNone(other.get("Makkos", 1))
+
+    def test_only_stale_part_files_are_swept(self):
+        folder = os.path.join(self.out_dir, "Makkos")
+        os.makedirs(folder)
+        stale, fresh = (os.path.join(folder, f"Makkos_Daf{d}_Amuda.pdf.part") for d in (2, 3))
+        for path in (stale, fresh):
+            open(path, 'wb').close()
+        old = time.time() - app.STALE_PART_FILE_AGE - 60
+        os.utime(stale, (old, old))
+        job = app.DownloadJob("Makkos", [5, 6], merge_all=False)
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_page_deleted_after_reconcile_is_downloaded_again(self):
+        catalog = app.PageCatalog(os.path.join(self.out_dir, app.PageCatalog.FILE), self.out_dir)
+        self.addCleanup(catalog.close)
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merged_suffix="All")
+        job.run(self.client, app.JobControl(), RecordingReporter(), app.Instrumentation(), catalog)
+        os.remove(job.page_path(3))
+
+        instrumentation = app.Instrumentation()
+        again = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merged_suffix="All")
+        again.run(self.client, app.JobControl(), RecordingReporter(), instrumentation, catalog)
+        self.assertEqual(instrumentation.counters['pages_existing'], 7)
+        self.assertEqual(len(app.PdfReader(again.merged_filename).pages), 8)
+
+    def test_parallel_download_reports_prefixes_in_order(self):
+        factory = functools.partial(app.build_drive_service, endpoint=self.server.endpoint)
+        client = app.DriveClient(factory(), service_factory=factory)
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merged_suffix="All")
+        prefixes = []
+        job.on_prefix_ready = lambda paths: prefixes.append(len(paths))
+        job.run(client, app.JobControl(), RecordingReporter(), app.Instrumentation(), workers=4)
+        self.assertEqual(job.stage, 'done')
+        self.assertEqual(sorted(job.completed), list(range(1, 9)))
+        self.assertEqual(prefixes, sorted(prefixes))
+        self.assertEqual(prefixes[-1], 8)
+
+    def test_first_daf_ready_skips_failed_amudim(self):
+        corpus_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_dir)
+        make_synthetic_corpus(corpus_dir, {"Makkos": 8})
+        for name in ("Makkos_Daf2_Amuda.pdf", "Makkos_Daf3_Amuda.pdf", "Makkos_Daf3_Amudb.pdf"):
+            os.remove(os.path.join(corpus_dir, "Makkos", name))
+        server = FakeDriveServer(corpus_dir).start()
+        self.addCleanup(server.stop)
+        client = app.DriveClient(app.build_drive_service(endpoint=server.endpoint))
+        for pages, expected in ((range(1, 9), ["Makkos_Daf2_Amudb.pdf"]),
+                                (range(3, 9), ["Makkos_Daf4_Amuda.pdf", "Makkos_Daf4_Amudb.pdf"]),
+                                ([3], None)):
+            job = app.DownloadJob("Makkos", pages, merge_all=False)
+            ready = []
+            job.on_prefix_ready = lambda paths: ready.append(job.first_daf_ready())
+            job.run(client, app.JobControl(), RecordingReporter(), app.Instrumentation())
+            first = next(filter(None, ready), None)
+            self.assertEqual(first and [os.path.basename(p) for p in first], expected)
+
+    def test_bundles_replace_per_page_downloads(self):
+        corpus_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_dir)
+        make_synthetic_corpus(corpus_dir, {"Makkos": 46, "Horyos": 25}, page_bytes=1024)
+        amudim = {m: [os.path.join(corpus_dir, m, f"{m}_Daf{d}_Amud{a}.pdf")
+                      for d, a in map(app.MasechetDownloader.daf_amud_calculator, range(1, n + 1))]
+                  for m, n in (("Makkos", 46), ("Horyos", 25))}
+        with zipfile.ZipFile(os.path.join(corpus_dir, "Makkos", "Makkos.zip"), 'w') as bundle:
+            for path in amudim["Makkos"]:
+                bundle.write(path, os.path.basename(path))
+        app.MasechetDownloader.merge_pdfs(None, amudim["Horyos"], os.path.join(corpus_dir, "Horyos", "Horyos_Full.pdf"))
+        for path in amudim["Makkos"] + amudim["Horyos"]:
+            os.remove(path)
+        server = FakeDriveServer(corpus_dir).start()
+        self.addCleanup(server.stop)
+        client = app.DriveClient(app.build_drive_service(endpoint=server.endpoint))
+
+        self.assertFalse(app.wants_bundle("Makkos", range(1, 10)))
+        for masechta_name, pages in (("Makkos", range(1, 41)), ("Horyos", range(5, 25))):
+            server.reset_stats()
+            instrumentation = app.Instrumentation()
+            job = app.DownloadJob(masechta_name, pages, merge_all=False, use_bundle=app.wants_bundle(masechta_name, pages))
+            job.run(client, app.JobControl(), RecordingReporter(), instrumentation)
+            self.assertEqual(sorted(job.completed), list(pages))
+            self.assertEqual(server.stats['files.get_media'], 1)
+            self.assertEqual(instrumentation.counters['pages_from_bundle'], len(pages))
+            self.assertEqual(len(app.PdfReader(job.page_path(pages[0])).pages), 1)
+            self.assertFalse([n for n in app.bundle_names(masechta_name) if os.path.exists(os.path.join(job.download_dir, n))])
+
+    def test_reads_page_ranges_from_full_pdf(self):
+        corpus_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_dir)
+        make_synthetic_corpus(corpus_dir, {"Horyos": 25}, page_bytes=100 * 1024)
+        amudim = [os.path.join(corpus_dir, "Horyos", f"Horyos_Daf{d}_Amud{a}.pdf")
+                  for d, a in map(app.MasechetDownloader.daf_amud_calculator, range(1, 26))]
+        full_pdf = os.path.join(corpus_dir, "Horyos", "Horyos_Full.pdf")
+        app.MasechetDownloader.merge_pdfs(None, amudim, full_pdf)
+        for path in amudim:
+            os.remove(path)
+        server = FakeDriveServer(corpus_dir).start()
+        self.addCleanup(server.stop)
+
+        job = app.DownloadJob("Horyos", range(11, 15), merge_all=False)
+        job.run(app.DriveClient(app.build_drive_service(endpoint=server.endpoint)), app.JobControl(),
+                RecordingReporter(), app.Instrumentation())
+        self.assertEqual(sorted(job.completed), [11, 12, 13, 14])
+        self.assertLess(server.stats['bytes_sent'], os.path.getsize(full_pdf) / 2)
+        contents = app.PdfReader(job.page_path(11)).pages[0].get_contents().get_data()
+        self.assertIn(b"(Horyos 7a)", contents)
+
+    def test_scheduler_puts_pinned_dapim_first(self):
+        scheduler = app.PageScheduler(range(1, 11), pinned_dapim=[4])
+        self.assertEqual([scheduler.get(), scheduler.get(), scheduler.get()], [5, 6, 1])
+        scheduler.pin([6])
+        self.assertEqual([scheduler.get(), scheduler.get(), scheduler.get()], [9, 10, 2])
+        scheduler.close()
+        self.assertIsNone(scheduler.get())
+
+    def test_pause_blocks_until_resumed(self):
+        control = app.JobControl()
+        paused = []
+        control.on_pause = lambda: paused.append(True)
+        control.pause()
+        worker = threading.Thread(target=control.checkpoint)
+        worker.start()
+        worker.join(0.2)
+        self.assertTrue(worker.is_alive())
+        control.resume()
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(paused, [True])
+
+
+class TestCacheServer(unittest.TestCase):
+
+    def setUp(self):
+        self.corpus_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.out_dir = tempfile.mkdtemp()
+        for path in (self.corpus_dir, self.cache_dir, self.out_dir):
+            self.addCleanup(shutil.rmtree, path)
+        make_synthetic_corpus(self.corpus_dir, {"Makkos": 8}, page_bytes=4096)
+        self.drive = FakeDriveServer(self.corpus_dir, faults=FaultInjector(latency=0.05)).start()
+        self.addCleanup(self.drive.stop)
+        factory = functools.partial(app.build_drive_service, endpoint=self.drive.endpoint)
+        client = app.DriveClient(factory(), service_factory=factory)
+        self.server = app.CacheServer(client, app.DiskLRUCache(self.cache_dir), host='127.0.0.1', port=0).start()
+        self.addCleanup(self.server.stop)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def test_concurrent_requests_share_one_drive_download(self):
+        proxy = app.ProxyClient(self.url)
+        proxy.list_masechta_files("Makkos")
+        paths = [os.path.join(self.out_dir, f"{i}.pdf") for i in range(6)]
+        threads = [threading.Thread(target=proxy.download, args=("Makkos", "Makkos_Daf2_Amuda.pdf", path)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.drive.stats['files.get_media'], 1)
+        with open(paths[0], 'rb') as a, open(paths[-1], 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        with self.assertRaises(FileNotFoundError):
+            proxy.download("Makkos", "Makkos_Daf99_Amuda.pdf", os.path.join(self.out_dir, "x.pdf"))
+
+    def test_download_job_through_proxy_and_merged_range(self):
+        patcher = unittest.mock.patch.object(app, 'DOWNLOADS_DIR', self.out_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merged_suffix="All")
+        job.run(app.ProxyClient(self.url), app.JobControl(), RecordingReporter(), app.Instrumentation())
+        self.assertEqual(job.stage, 'done')
+        self.drive.reset_stats()
+        info = app.ProxyClient(self.url).download_merged("Makkos", [1, 2, 3, 4], os.path.join(self.out_dir, "m.pdf"))
+        self.assertGreater(info['size'], 0)
+        self.assertEqual(self.drive.stats, {})
+
+    def test_bundle_through_proxy(self):
+        corpus_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_dir)
+        make_synthetic_corpus(corpus_dir, {"Makkos": 46}, page_bytes=1024)
+        folder = os.path.join(corpus_dir, "Makkos")
+        with zipfile.ZipFile(os.path.join(folder, "Makkos.zip"), 'w') as bundle:
+            for name in sorted(os.listdir(folder)):
+                if name.endswith('.pdf'):
+                    bundle.write(os.path.join(folder, name), name)
+                    os.remove(os.path.join(folder, name))
+        drive = FakeDriveServer(corpus_dir).start()
+        self.addCleanup(drive.stop)
+        server = app.CacheServer(app.DriveClient(app.build_drive_service(endpoint=drive.endpoint)),
+                                 app.DiskLRUCache(os.path.join(self.cache_dir, "bundle")), host='127.0.0.1', port=0).start()
+        self.addCleanup(server.stop)
+        patcher = unittest.mock.patch.object(app, 'DOWNLOADS_DIR', self.out_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        class Unused(app.PageSource):
+            name = 'unused'
+
+            def download(self, masechta_name, filename, save_path, control=None):
+                raise AssertionError(filename)
+        source = app.FailoverSource([app.ProxyClient(f"http://127.0.0.1:{server.server_address[1]}/"), Unused()])
+        instrumentation = source.instrumentation = app.Instrumentation()
+        job = app.DownloadJob("Makkos", range(1, 41), merge_all=False, use_bundle=True)
+        job.run(source, app.JobControl(), RecordingReporter(), instrumentation)
+        self.assertEqual(sorted(job.completed), list(range(1, 41)))
+        self.assertEqual(instrumentation.counters['pages_from_bundle'], 40)
+        self.assertEqual(drive.stats['files.get_media'], 1)
+
+        # A request the server rejects is not held against it
+        with self.assertRaises(urllib.error.HTTPError):
+            source.download("Makkos", "Makkos.exe", os.path.join(self.out_dir, "x"))
+        self.assertTrue(source.health['cache_server'].available)
+
+    def test_clients_share_downloads_of_one_file_id(self):
+        factory = functools.partial(app.build_drive_service, endpoint=self.drive.endpoint)
+        first, second = app.DriveClient(factory()), app.DriveClient(factory())
+        file_id = first.find_file_id("Makkos", "Makkos_Daf3_Amuda.pdf")
+        self.drive.reset_stats()
+        paths = [os.path.join(self.out_dir, "first.pdf"), os.path.join(self.out_dir, "second.pdf")]
+        threads = [threading.Thread(target=client.download_file, args=(file_id, path))
+                   for client, path in zip((first, second), paths)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.drive.stats['files.get_media'], 1)
+        self.assertEqual(first.instrumentation.counters.get('coalesced', 0) +
+                         second.instrumentation.counters.get('coalesced', 0), 1)
+        with open(paths[0], 'rb') as a, open(paths[1], 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_hedged_download_beats_a_stalled_request(self):
+        class StallOnce(FaultInjector):
+            stalls = 0
+
+            def delay(self):
+                with self._lock:
+                    stall, self.stalls = self.stalls > 0, max(0, self.stalls - 1)
+                if stall:
+                    time.sleep(1.5)
+
+        faults = self.drive.faults = StallOnce()
+        tracker = app.LatencyTracker()
+        for _ in range(app.HEDGE_MIN_SAMPLES):
+            tracker.record(0.01)
+        patcher = unittest.mock.patch.object(app, 'HEDGE_MIN_DELAY', 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        factory = functools.partial(app.build_drive_service, endpoint=self.drive.endpoint)
+        client = app.DriveClient(factory(), service_factory=factory, latency=tracker)
+        file_id = client.find_file_id("Makkos", "Makkos_Daf4_Amuda.pdf")
+        faults.stalls = 1
+        save_path = os.path.join(self.out_dir, "hedged.pdf")
+        start = time.perf_counter()
+        client.download_file(file_id, save_path)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(client.instrumentation.counters['hedged'], 1)
+        self.assertEqual(client.instrumentation.counters['hedge_wins'], 1)
+        with open(os.path.join(self.corpus_dir, "Makkos", "Makkos_Daf4_Amuda.pdf"), 'rb') as a, open(save_path, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertFalse(os.path.exists(save_path + '.1'))
+
+        # Bundles and files over one request are never hedged
+        file_id = client.find_file_id("Makkos", "Makkos_Daf4_Amudb.pdf")
+        for size_limit, hedge in ((app.DOWNLOAD_SINGLE_REQUEST_LIMIT, False), (1024, True)):
+            with unittest.mock.patch.object(app, 'DOWNLOAD_SINGLE_REQUEST_LIMIT', size_limit):
+                faults.stalls = 1
+                client.download_file(file_id, os.path.join(self.out_dir, f"unhedged{size_limit}.pdf"), hedge=hedge)
+        self.assertEqual(client.instrumentation.counters['hedged'], 1)
+
+    def test_lru_eviction(self):
+        cache = app.DiskLRUCache(os.path.join(self.cache_dir, "lru"), max_bytes=250)
+
+        def fill(part_path):
+            with open(part_path, 'wb') as f:
+                f.write(b'x' * 100)
+        for key in ("a", "b"):
+            cache.fetch(key, fill)
+        cache.get("a")
+        cache.fetch("c", fill)
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+
+    def test_merged_range_bigger_than_the_cache(self):
+        self.server.cache.max_bytes = 3 * 4096
+        info = app.ProxyClient(self.url).download_merged("Makkos", range(1, 9), os.path.join(self.out_dir, "m.pdf"))
+        self.assertGreater(info['size'], 0)
+        self.assertEqual(len(app.PdfReader(os.path.join(self.out_dir, "m.pdf")).pages), 8)
+        self.assertLessEqual(len(self.server.cache._entries), 3) # unpinned once the merge was done
+
+    def test_eviction_survives_files_it_cannot_remove(self):
+        cache = app.DiskLRUCache(os.path.join(self.cache_dir, "lru"), max_bytes=150)
+
+        def fill(part_path):
+            with open(part_path, 'wb') as f:
+                f.write(b'x' * 100)
+        cache.fetch("a", fill)
+        with unittest.mock.patch.object(app.os, 'remove', side_effect=PermissionError("in use")):
+            cache.fetch("b", fill)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.size, 100)
+
+    def test_parse_pages(self):
+        self.assertEqual(list(app.parse_pages(app.format_pages([7, 1, 2, 3]), 10)), [1, 2, 3, 7])
+        for spec in ("1-5000000", "0-3", "5-4", "x"):
+            with self.assertRaises(ValueError):
+                app.parse_pages(spec, 10)
+        with self.assertRaises(urllib.error.HTTPError) as caught:
+            urllib.request.urlopen(f"{self.url}merged/Makkos?pages=1-5000000")
+        self.assertEqual(caught.exception.code, 400)
+
+
+class QuietFileHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPageSources(unittest.TestCase):
+
+    def setUp(self):
+        self.corpus_dir = tempfile.mkdtemp()
+        self.feed_dir = tempfile.mkdtemp()
+        self.out_dir = tempfile.mkdtemp()
+        for path in (self.corpus_dir, self.feed_dir, self.out_dir):
+            self.addCleanup(shutil.rmtree, path)
+        make_synthetic_corpus(self.corpus_dir, {"Makkos": 8})
+        # The same pages, laid out like HebrewBooks' page feed
+        masechta_id = app.MasechetDownloader.masechtos_info_static["Makkos"][0]
+        os.makedirs(os.path.join(self.feed_dir, "pagefeed"))
+        for page in range(1, 9):
+            daf, amud = app.MasechetDownloader.daf_amud_calculator(page)
+            shutil.copy(os.path.join(self.corpus_dir, "Makkos", f"Makkos_Daf{daf}_Amud{amud}.pdf"),
+                        os.path.join(self.feed_dir, "pagefeed", f"hebrewbooks_org_{masechta_id}_{page}.pdf"))
+        feed = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietFileHandler, directory=self.feed_dir))
+        threading.Thread(target=feed.serve_forever, daemon=True).start()
+        self.addCleanup(feed.server_close)
+        self.addCleanup(feed.shutdown)
+        self.feed_url = f"http://127.0.0.1:{feed.server_address[1]}/pagefeed/hebrewbooks_org_{{id}}_{{page}}.pdf"
+        self.drive = FakeDriveServer(self.corpus_dir).start()
+        self.addCleanup(self.drive.stop)
+        patcher = unittest.mock.patch.object(app, 'DOWNLOADS_DIR', self.out_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pagefeed_source(self):
+        source = app.PagefeedSource(self.feed_url)
+        info = source.download("Makkos", "Makkos_Daf3_Amudb.pdf", os.path.join(self.out_dir, "p.pdf"))
+        self.assertEqual(info['file_id'], f"hebrewbooks:{app.MasechetDownloader.masechtos_info_static['Makkos'][0]}_4")
+        with self.assertRaises(FileNotFoundError):
+            source.download("Makkos", "Makkos_Daf30_Amuda.pdf", os.path.join(self.out_dir, "q.pdf"))
+
+    def test_fails_over_while_drive_is_throttled(self):
+        self.drive.faults = FaultInjector(error_rate=1.0)
+        factory = functools.partial(app.build_drive_service, endpoint=self.drive.endpoint)
+        drive = app.DriveClient(factory(), service_factory=factory, max_retries=0, backoff=0)
+        source = app.FailoverSource([drive, app.PagefeedSource(self.feed_url)])
+        instrumentation = source.instrumentation = app.Instrumentation()
+        job = app.DownloadJob("Makkos", range(1, 9), merge_all=True, merged_suffix="All")
+        job.run(source, app.JobControl(), RecordingReporter(), instrumentation)
+        self.assertEqual(sorted(job.completed), list(range(1, 9)))
+        self.assertEqual(instrumentation.counters['pages_from_hebrewbooks'], 8)
+        self.assertFalse(source.health['drive'].available)
+
+
+class TestSelectionExpressions(unittest.TestCase):
+
+    def test_parse_and_format(self):
+        plan = app.parse_selection("Brachos 2-10, 15a, 20b-22a, 9-12; shabbos all\nbava kamma 5b")
+        self.assertEqual(plan, {'Brachos': [(1, 22), (27, 27), (38, 41)], 'Shabbos': [(1, 312)], 'Bava Kamma': [(8, 8)]})
+        self.assertEqual(app.format_selection(plan), "Brachos 2-12, 15a, 20b-22a; Shabbos all; Bava Kamma 5b")
+        self.assertEqual(app.parse_selection(app.format_selection(plan)), plan)
+        # Brachos ends on 64a, so daf 64 is a single amud
+        self.assertEqual(app.parse_selection("Brachos 64"), {'Brachos': [(125, 125)]})
+        for bad in ("Foo 2", "Brachos 1", "Brachos 64b", "Brachos 10-5", "Brachos x", " ; "):
+            with self.assertRaises(ValueError):
+                app.parse_selection(bad)
+
+    def test_page_sets(self):
+        pages = app.PageSet.from_intervals([(1, 22), (27, 27), (38, 41)])
+        self.assertEqual(pages, app.PageSet(list(range(1, 23)) + [27, 38, 39, 40, 41]))
+        self.assertEqual(pages.intervals(), [[1, 22], [27, 27], [38, 41]])
+        self.assertEqual(len(pages), 27)
+        on_disk = app.PageSet(range(1, 11))
+        self.assertEqual(list(pages - on_disk)[:3], [11, 12, 13])
+        self.assertEqual((pages | on_disk).intervals(), [[1, 22], [27, 27], [38, 41]])
+        self.assertEqual(list(pages.below(28)), list(range(1, 23)) + [27])
+        self.assertNotIn(0, pages)
+
+    def test_masechet_tables(self):
+        table = app.masechet_table("Brachos")
+        self.assertIs(table, app.masechet_table("Brachos"))
+        self.assertEqual((table.labels[1], table.labels[125], table.filenames[4]), ("2a", "64a", "Brachos_Daf3_Amudb.pdf"))
+        self.assertEqual((table.dafs[125], table.page("3b")), (64, 4))
+        with self.assertRaises(ValueError):
+            table.page("64b")
+        # Brachos ends on 64a; daf 64 must still be offered
+        self.assertEqual(app.MasechetDownloader.selection_labels("Brachos", "Dapim")[-1], "64")
+        self.assertEqual(len(app.MasechetDownloader.calculate_pages("Brachos", "Range", "Dapim", "60", "64")), 9)
+
+    def test_jobs_per_masechet(self):
+        jobs = app.selection_jobs(app.parse_selection("Makkos 3-4; Horyos all"))
+        self.assertEqual([(j.masechta_name, list(j.pages), j.merged_suffix) for j in jobs],
+                         [("Makkos", [3, 4, 5, 6], "Selection_3-4"), ("Horyos", list(range(1, 26)), "All")])
+
+        # Every amud a of Bava Basra: a long selection still makes a short, unique filename
+        spec = "Bava Basra " + ", ".join(f"{daf}a" for daf in range(2, 177))
+        jobs = app.selection_jobs(app.parse_selection(spec)) + app.selection_jobs(app.parse_selection(spec + ", 176b"))
+        self.assertNotEqual(jobs[0].merged_suffix, jobs[1].merged_suffix)
+        for job in jobs:
+            self.assertTrue(job.merged_suffix.startswith("Selection_2a_3a_"))
+            self.assertLessEqual(len(job.merged_suffix), app.SELECTION_SUFFIX_MAX)
+            self.assertLess(len(os.path.basename(job.merged_filename) + ".part"), 255)
+
+
+class TestDafYomi(unittest.TestCase):
+
+    def test_schedule(self):
+        self.assertEqual(app.daf_yomi(datetime.date(2020, 1, 5)), ("Brachos", 2))
+        self.assertEqual(app.daf_yomi(datetime.date(2020, 3, 8)), ("Shabbos", 2))
+        self.assertEqual(app.daf_yomi(datetime.date(2027, 6, 7)), ("Nidah", 73))
+        self.assertEqual(app.daf_yomi(datetime.date(2027, 6, 8)), ("Brachos", 2))
+        self.assertEqual(app.daf_pages("Brachos", 64), [125])
+        meilah_start = datetime.date(2020, 1, 5)
+        while app.daf_yomi(meilah_start) != ("Meilah", 2):
+            meilah_start += datetime.timedelta(days=1)
+        self.assertEqual(app.daf_yomi(meilah_start + datetime.timedelta(days=35)), ("Meilah", 37))
+        self.assertEqual(app.daf_pages("Meilah", 37), [])
+
+    def test_prefetch_merges_upcoming_dapim(self):
+        corpus_dir = tempfile.mkdtemp()
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_dir)
+        self.addCleanup(shutil.rmtree, out_dir)
+        make_synthetic_corpus(corpus_dir, {"Makkos": 46})
+        server = FakeDriveServer(corpus_dir).start()
+        self.addCleanup(server.stop)
+        patcher = unittest.mock.patch.object(app, 'DOWNLOADS_DIR', out_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        day = datetime.date(2020, 1, 5)
+        while app.daf_yomi(day) != ("Makkos", 23):
+            day += datetime.timedelta(days=1)
+        factory = functools.partial(app.build_drive_service, endpoint=server.endpoint)
+        prefetcher = app.DafYomiPrefetcher(app.DriveClient(factory(), service_factory=factory), days=2)
+        created = prefetcher.run_once(day)
+        folder = os.path.join(out_dir, "Makkos")
+        self.assertEqual(created, [os.path.join(folder, "Makkos_Daf23.pdf"), os.path.join(folder, "Makkos_Daf24.pdf")])
+        self.assertIn("Makkos_Daf24_Amuda.pdf", os.listdir(folder))
+        server.reset_stats()
+        self.assertEqual(prefetcher.run_once(day), [])
+        self.assertEqual(server.stats.get('requests', 0), 0)
+
+    def test_prefetch_yields_to_a_user_job(self):
+        corpus_dir = tempfile.mkdtemp()
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_dir)
+        self.addCleanup(shutil.rmtree, out_dir)
+        make_synthetic_corpus(corpus_dir, {"Makkos": 46})
+        server = FakeDriveServer(corpus_dir, faults=FaultInjector(latency=0.2)).start()
+        self.addCleanup(server.stop)
+        patcher = unittest.mock.patch.object(app, 'DOWNLOADS_DIR', out_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        day = datetime.date(2020, 1, 5)
+        while app.daf_yomi(day) != ("Makkos", 23):
+            day += datetime.timedelta(days=1)
+        busy = threading.Event()
+        prefetcher = app.DafYomiPrefetcher(app.DriveClient(app.build_drive_service(endpoint=server.endpoint)),
+                                           days=2, is_busy=busy.is_set)
+        created = []
+        thread = threading.Thread(target=lambda: created.extend(prefetcher.run_once(day)))
+        thread.start()
+        time.sleep(0.3)
+        busy.set()
+        prefetcher.yield_to_user()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(created, [])
+        self.assertTrue(prefetcher.interrupted)
+        self.assertFalse(os.path.exists(os.path.join(out_dir, "Makkos", "Makkos_Daf24.pdf")))
+
+        # Once the user's download is over, prefetching resumes without waiting out the interval
+        server.faults = FaultInjector()
+        prefetcher.busy_poll = 0.05
+        with unittest.mock.patch.object(app, 'daf_yomi', lambda date, real=app.daf_yomi: real(day + (date - datetime.date.today()))):
+            prefetcher.start()
+            self.addCleanup(prefetcher.stop)
+            time.sleep(0.2)
+            self.assertFalse(os.path.exists(os.path.join(out_dir, "Makkos", "Makkos_Daf23.pdf")))
+            busy.clear()
+            deadline = time.time() + 10
+            while not os.path.exists(os.path.join(out_dir, "Makkos", "Makkos_Daf24.pdf")) and time.time() < deadline:
+                time.sleep(0.05)
+        self.assertTrue(os.path.exists(os.path.join(out_dir, "Makkos", "Makkos_Daf24.pdf")))
+
+
+class FakeListbox:
+    """Stands in for the tk.Listbox inside VirtualListbox, so it can be tested without a display."""
+
+    def __init__(self):
+        self.delete()
+
+    def delete(self, first=0, last=None):
+        self.rows, self.selection, self.colors = [], set(), {}
+
+    def insert(self, index, *items):
+        self.rows[index:index] = items
+
+    def selection_set(self, row):
+        self.selection.add(row)
+
+    def itemconfig(self, row, foreground):
+        self.colors[row] = foreground
+
+    def curselection(self):
+        return tuple(sorted(self.selection))
+
+
+class TestVirtualListbox(unittest.TestCase):
+
+    def setUp(self):
+        self.box = app.VirtualListbox.__new__(app.VirtualListbox) # no Tk: widgets are faked below
+        self.box.items, self.box.selected, self.box.highlighted = (), set(), frozenset()
+        self.box.highlight_color, self.box.top, self.box.visible_rows = 'green', 0, 5
+        self.box._line_height = 10
+        self.box.listbox = FakeListbox()
+        self.box.scrollbar = unittest.mock.Mock()
+        self.box.set_items(tuple(f"{d}{a}" for d in range(2, 14) for a in "ab")) # 24 items
+
+    def test_set_items_renders_the_first_window(self):
+        self.assertEqual(self.box.listbox.rows, ["2a", "2b", "3a", "3b", "4a"])
+        self.box.scrollbar.set.assert_called_with(0.0, 5 / 24)
+        self.assertEqual((self.box.size(), self.box.get(23)), (24, "13b"))
+        self.box.set_items(())
+        self.assertEqual(self.box.listbox.rows, [])
+        self.box.scrollbar.set.assert_called_with(0.0, 1.0)
+
+    def test_selection_maps_rows_to_items_across_scrolling(self):
+        self.box.listbox.selection = {1, 3}
+        self.box._on_select()
+        self.box._scroll_by(100) # clamped to the last window
+        self.assertEqual(self.box.top, 19)
+        self.assertEqual(self.box.listbox.rows, ["11b", "12a", "12b", "13a", "13b"])
+        self.box.scrollbar.set.assert_called_with(19 / 24, 1.0)
+        self.box.listbox.selection.add(4)
+        self.box._on_select()
+        self.assertEqual(self.box.curselection(), (1, 3, 23))
+        # Deselecting a visible row leaves selections outside the window alone
+        self.box.listbox.selection.discard(4)
+        self.box._on_select()
+        self.assertEqual(self.box.curselection(), (1, 3))
+        self.box._on_scroll("moveto", "0.0")
+        self.assertEqual(self.box.listbox.selection, {1, 3})
+
+    def test_highlight_and_resize_at_the_window_edge(self):
+        self.box.set_highlighted([0, 22, 23])
+        self.box._on_scroll("moveto", "0.99")
+        self.assertEqual(self.box.top, 19)
+        self.assertEqual(self.box.listbox.colors, {3: 'green', 4: 'green'})
+        self.box._on_resize(unittest.mock.Mock(height=80)) # 8 rows
+        self.assertEqual((self.box.top, len(self.box.listbox.rows)), (16, 8))
+        self.box._on_scroll("scroll", "-1", "pages")
+        self.assertEqual(self.box.top, 8)
+
+
+class TestProgressAggregator(unittest.TestCase):
+
+    def test_snapshot_reports_rates_and_eta(self):
+        progress = app.ProgressAggregator()
+        progress.start(10, done=2)
+        for _ in range(3):
+            progress.page_started()
+        progress.page_finished(1024 * 1024)
+        progress.page_finished(0, ok=False)
+        progress.set_status("first")
+        progress.set_status("latest")
+        done, total, status, stats = progress.snapshot()
+        self.assertEqual((done, total, status), (4, 10, "latest"))
+        self.assertIn("4/10 pages", stats)
+        self.assertIn("ETA", stats)
+        self.assertIn("1 in flight", stats)
+        self.assertIn("1 failed", stats)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_phases_counters_and_trace(self):
+        trace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trace_dir)
+        trace_path = os.path.join(trace_dir, "trace.jsonl")
+        instrumentation = app.Instrumentation(trace_path)
+        with instrumentation.phase('page', page=1):
+            with instrumentation.phase('download'):
+                pass
+        with self.assertRaises(RuntimeError):
+            with instrumentation.phase('page', page=2):
+                raise RuntimeError
+        instrumentation.count('bytes', 10)
+        instrumentation.count('bytes', 5)
+        instrumentation.close()
+
+        self.assertEqual(instrumentation.timers['page'][0], 2)
+        self.assertEqual(instrumentation.counters['bytes'], 15)
+        self.assertIn('download', instrumentation.summary_table())
+        with open(trace_path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([e['phase'] for e in events], ['download', 'page', 'page'])
+        self.assertFalse(events[-1]['ok'])
+
+        long_lived = app.Instrumentation()
+        for _ in range(app.PHASE_SAMPLE_WINDOW + 10):
+            with long_lived.phase('download'):
+                pass
+        self.assertEqual(long_lived.timers['download'][0], app.PHASE_SAMPLE_WINDOW + 10)
+        self.assertEqual(len(long_lived.samples['download']), app.PHASE_SAMPLE_WINDOW)
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+
+    def test_metrics_are_exposed(self):
+        registry = app.MetricsRegistry()
+        instrumentation = app.Instrumentation(metrics=registry)
+        instrumentation.count('pages_downloaded')
+        instrumentation.count('http_429', 2)
+        instrumentation.count('cache_hits', 3)
+        instrumentation.count('cache_misses')
+        with instrumentation.phase('merge'):
+            pass
+
+        server = app.start_metrics_server(0, registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        text = urllib.request.urlopen(url).read().decode('utf-8')
+
+        self.assertIn('shas_pages_total{result="downloaded"} 1', text)
+        self.assertIn('shas_drive_errors_total{status="429"} 2', text)
+        self.assertIn('shas_cache_hit_ratio{cache="folder_ids"} 0.75', text)
+        self.assertIn('shas_phase_duration_seconds_count{phase="merge"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()